@@ -1,18 +1,29 @@
-from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, BackgroundTasks
+from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, BackgroundTasks, Query, Response, Header
+from fastapi.encoders import jsonable_encoder
 from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne, ReplaceOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from bson import ObjectId
 import os
+import asyncio
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from enum import Enum
 import pandas as pd
+import numpy as np
 import io
+import json
+import base64
+import hashlib
+from collections import OrderedDict
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -109,6 +120,7 @@ class RawMaterial(BaseModel):
     pieces_count: int  # عدد القطع
     unit_code: str  # كود الوحدة
     cost_per_mm: float  # تكلفة الملي الواحد
+    priority: Optional[int] = None  # ترتيب نوع الخامة في القوائم
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 class MaterialPricing(BaseModel):
@@ -189,6 +201,7 @@ class InvoiceItem(BaseModel):
     material_details: Optional[Dict[str, Any]] = None  # تفاصيل الخامة المختارة
     selected_materials: Optional[List[Dict[str, Any]]] = None  # الخامات المتعددة المختارة
     notes: Optional[str] = None  # ملاحظات على المنتج
+    cost: Optional[float] = None  # تكلفة البند - set by the server when the sale is recorded
 
 class Invoice(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -211,6 +224,11 @@ class Invoice(BaseModel):
     status: InvoiceStatus
     date: datetime = Field(default_factory=datetime.utcnow)
     notes: Optional[str] = None
+    cost_of_goods: Optional[float] = None  # تكلفة البضاعة المباعة
+    gross_profit: Optional[float] = None  # الإجمالي بعد الخصم ناقص التكلفة
+    cost_rolled_up: Optional[float] = None  # cost_of_goods already counted in daily_rollups
+    material_ledger: bool = False  # material deductions are recorded in raw_material_movements
+    quote_id: Optional[str] = None  # حجز الخامات الذي تحول إلى هذه الفاتورة
     
     class Config:
         use_enum_values = True
@@ -228,6 +246,7 @@ class Payment(BaseModel):
 
 class Expense(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    company_id: Optional[str] = None  # Multi-tenant support - Optional for migration
     description: str
     amount: float
     category: ExpenseCategory
@@ -236,6 +255,7 @@ class Expense(BaseModel):
 class WorkOrder(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     company_id: Optional[str] = None  # Multi-tenant support - Optional for migration
+    work_order_number: Optional[str] = None  # رقم أمر الشغل
     title: Optional[str] = None
     description: Optional[str] = None
     supervisor_name: Optional[str] = None  # اسم المشرف على التصنيع
@@ -251,6 +271,59 @@ class WorkOrder(BaseModel):
     invoice_id: Optional[str] = None
     items: List[Dict[str, Any]] = Field(default_factory=list)
 
+class OutboxTask(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    task_type: str  # deduct_materials, record_local_sales, post_invoice_income, add_to_daily_work_order
+    invoice_id: str
+    payload: Dict[str, Any] = Field(default_factory=dict)
+    status: str = "pending"  # pending, processing, done, failed, cancelled
+    attempts: int = 0
+    next_attempt_at: datetime = Field(default_factory=datetime.utcnow)
+    last_error: Optional[str] = None
+    completed_steps: List[str] = Field(default_factory=list)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    completed_at: Optional[datetime] = None
+
+class RawMaterialMovement(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    company_id: Optional[str] = None
+    material_id: str
+    unit_code: Optional[str] = None
+    movement_type: str  # deduction, restoration
+    height_change: float  # بالملي - negative for deductions
+    seals: int = 0
+    reference_invoice_id: Optional[str] = None
+    item_index: Optional[int] = None
+    token: str  # the token that guarded the height update; unique per movement
+    status: str = "applied"  # pending while its height update is not settled
+    created_by: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+class MaterialHold(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    quote_id: str  # الفاتورة قيد الإعداد التي تحجز الخامة
+    height: float  # الملي المحجوز
+    seals: int = 0
+    created_by: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    expires_at: datetime
+
+class MaterialReservationCreate(BaseModel):
+    quote_id: str
+    material_id: str
+    seals_count: int = Field(..., ge=1)
+    seal_height: float = Field(..., gt=0)
+    created_by: Optional[str] = None
+
+class TreasurySnapshot(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    snapshot_type: str  # closing, opening (written by a treasury reset)
+    closed_at: datetime  # covers postings dated before this moment
+    ledger_balances: List[Dict[str, Any]] = Field(default_factory=list)  # treasury transactions only
+    balances: List[Dict[str, Any]] = Field(default_factory=list)  # including deferred invoices and expenses
+    created_by: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
 # Request Models
 class CustomerCreate(BaseModel):
     name: str
@@ -285,10 +358,14 @@ class InvoiceCreate(BaseModel):
     discount_type: Optional[str] = "amount"  # نوع الخصم: amount أو percentage
     discount_value: Optional[float] = 0.0  # القيمة المدخلة للخصم
     notes: Optional[str] = None
+    quote_id: Optional[str] = None  # حجز الخامات الذي تم أثناء إعداد الفاتورة
     
     class Config:
         use_enum_values = True
 
+class InvoiceBatchCreate(BaseModel):
+    invoices: List[Dict[str, Any]]  # InvoiceCreate payloads, validated one by one
+
 class PaymentCreate(BaseModel):
     invoice_id: str
     amount: float
@@ -306,6 +383,7 @@ class TreasuryTransaction(BaseModel):
     amount: float
     description: str
     reference: Optional[str] = None
+    unique_reference: Optional[bool] = None  # system references that may only be posted once
     related_transaction_id: Optional[str] = None  # للتحويلات
     date: datetime = Field(default_factory=datetime.utcnow)
     created_at: datetime = Field(default_factory=datetime.utcnow)
@@ -344,6 +422,7 @@ class SupplierTransaction(BaseModel):
     quantity: Optional[int] = None  # للمشتريات
     unit_price: Optional[float] = None  # للمشتريات
     payment_method: Optional[str] = None  # للدفعات
+    payment_number: Optional[str] = None  # رقم سند الدفع
     reference_invoice_id: Optional[str] = None  # مرجع الفاتورة إذا كان من بيع منتج محلي
     date: datetime = Field(default_factory=datetime.utcnow)
     created_at: datetime = Field(default_factory=datetime.utcnow)
@@ -358,6 +437,7 @@ class InventoryItem(BaseModel):
     min_stock_level: Optional[int] = 2  # الحد الأدنى 2 قطعة
     # إزالة max_stock_level و unit_code
     notes: Optional[str] = None
+    priority: Optional[int] = None  # ترتيب نوع الخامة في القوائم
     created_at: datetime = Field(default_factory=datetime.utcnow)
     last_updated: datetime = Field(default_factory=datetime.utcnow)
 
@@ -442,6 +522,18 @@ class CompatibilityCheck(BaseModel):
     outer_diameter: float
     height: float
     material_type: Optional[MaterialType] = None
+    quote_id: Optional[str] = None  # holds of this quote still count as available
+
+class CuttingPlanRequest(BaseModel):
+    inner_diameter: float
+    outer_diameter: float
+    height: float = Field(..., gt=0)
+    quantity: int = Field(..., ge=1, le=5000)
+    material_type: Optional[MaterialType] = None
+    quote_id: Optional[str] = None  # holds of this quote still count as available
+    
+    class Config:
+        use_enum_values = True
 
 # Auth endpoints
 @api_router.post("/auth/login")
@@ -522,32 +614,92 @@ async def delete_user(user_id: str):
     return {"message": "تم حذف المستخدم بنجاح"}
 
 # Dashboard endpoints
-@api_router.get("/dashboard/stats")
-async def get_dashboard_stats():
-    # Get totals from database
-    invoices = list(await db.invoices.find().to_list(1000))
-    expenses = list(await db.expenses.find().to_list(1000))
-    customers = list(await db.customers.find().to_list(1000))
+# The stats come from one aggregation per company: invoices with expenses and
+# customers appended by $unionWith, split into totals by $facet. Results are cached
+# for a few seconds in each worker. Every invoice, expense and customer write bumps
+# a version counter in MongoDB, and a cached result is only served while the
+# counter still matches, so a write in one worker drops the stats in all of them.
+DASHBOARD_STATS_TTL_SECONDS = int(os.environ.get("DASHBOARD_STATS_TTL_SECONDS", 30))
+DASHBOARD_STATS_VERSION_KEY = "dashboard_stats_version"
+
+_dashboard_stats_cache: Dict[Optional[str], tuple] = {}
+
+async def invalidate_dashboard_stats() -> None:
+    await db.counters.update_one(
+        {"_id": DASHBOARD_STATS_VERSION_KEY},
+        {"$inc": {"seq": 1}, "$setOnInsert": {"sequence_type": "dashboard_stats"}},
+        upsert=True
+    )
+
+async def compute_dashboard_stats(company_id: Optional[str] = None) -> Dict[str, Any]:
+    match: Dict[str, Any] = {"company_id": company_id} if company_id else {}
+    results = await db.invoices.aggregate([
+        {"$match": match},
+        {"$project": {"_id": 0, "source": {"$literal": "invoice"}, "total_amount": 1, "remaining_amount": 1}},
+        {"$unionWith": {"coll": "expenses", "pipeline": [
+            {"$match": match},
+            {"$project": {"_id": 0, "source": {"$literal": "expense"}, "amount": 1}}
+        ]}},
+        {"$unionWith": {"coll": "customers", "pipeline": [
+            {"$match": match},
+            {"$project": {"_id": 0, "source": {"$literal": "customer"}}}
+        ]}},
+        {"$facet": {
+            "invoices": [
+                {"$match": {"source": "invoice"}},
+                {"$group": {
+                    "_id": None,
+                    "total_sales": {"$sum": "$total_amount"},
+                    "total_unpaid": {"$sum": {"$cond": [{"$gt": ["$remaining_amount", 0]}, "$remaining_amount", 0]}},
+                    "invoice_count": {"$sum": 1}
+                }}
+            ],
+            "expenses": [
+                {"$match": {"source": "expense"}},
+                {"$group": {"_id": None, "total_expenses": {"$sum": "$amount"}}}
+            ],
+            "customers": [
+                {"$match": {"source": "customer"}},
+                {"$count": "customer_count"}
+            ]
+        }}
+    ]).to_list(1)
     
-    total_sales = sum(invoice.get("total_amount", 0) for invoice in invoices)
-    total_expenses = sum(expense.get("amount", 0) for expense in expenses)
-    total_unpaid = sum(invoice.get("remaining_amount", 0) for invoice in invoices if invoice.get("remaining_amount", 0) > 0)
+    facets = results[0] if results else {}
+    invoices = (facets.get("invoices") or [{}])[0]
+    expenses = (facets.get("expenses") or [{}])[0]
+    customers = (facets.get("customers") or [{}])[0]
     
+    total_sales = invoices.get("total_sales", 0)
+    total_expenses = expenses.get("total_expenses", 0)
     return {
         "total_sales": total_sales,
         "total_expenses": total_expenses,
         "net_profit": total_sales - total_expenses,
-        "total_unpaid": total_unpaid,
-        "invoice_count": len(invoices),
-        "customer_count": len(customers)
+        "total_unpaid": invoices.get("total_unpaid", 0),
+        "invoice_count": invoices.get("invoice_count", 0),
+        "customer_count": customers.get("customer_count", 0)
     }
 
+@api_router.get("/dashboard/stats")
+async def get_dashboard_stats(company_id: Optional[str] = None):
+    version = await db.counters.find_one({"_id": DASHBOARD_STATS_VERSION_KEY}, {"_id": 0, "seq": 1})
+    seq = (version or {}).get("seq", 0)
+    cached = _dashboard_stats_cache.get(company_id)
+    if cached and cached[0] == seq and cached[1] > datetime.utcnow():
+        return cached[2]
+    
+    stats = await compute_dashboard_stats(company_id)
+    _dashboard_stats_cache[company_id] = (seq, datetime.utcnow() + timedelta(seconds=DASHBOARD_STATS_TTL_SECONDS), stats)
+    return stats
+
 # Customer endpoints
 @api_router.post("/customers", response_model=Customer)
-async def create_customer(customer: CustomerCreate):
+async def create_customer(customer: CustomerCreate, company_id: Optional[str] = None):
     customer_dict = customer.dict()
-    customer_obj = Customer(**customer_dict)
+    customer_obj = Customer(**customer_dict, company_id=company_id)
     await db.customers.insert_one(customer_obj.dict())
+    await invalidate_dashboard_stats()
     return customer_obj
 
 @api_router.get("/customers", response_model=List[Customer])
@@ -565,6 +717,7 @@ async def get_customer(customer_id: str):
 @api_router.delete("/customers/clear-all")
 async def clear_all_customers():
     result = await db.customers.delete_many({})
+    await invalidate_dashboard_stats()
     return {"message": f"تم حذف {result.deleted_count} عميل", "deleted_count": result.deleted_count}
 
 @api_router.delete("/customers/{customer_id}")
@@ -572,44 +725,129 @@ async def delete_customer(customer_id: str):
     result = await db.customers.delete_one({"id": customer_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="العميل غير موجود")
+    await invalidate_dashboard_stats()
     return {"message": "تم حذف العميل بنجاح"}
 
 # Raw materials endpoints
-# Material code generation helper
-async def generate_unit_code(material_type: str, inner_diameter: float, outer_diameter: float):
-    """Generate automatic unit code based on material type and specifications"""
-    # Material type to prefix mapping
-    type_prefix = {
-        "BUR": "B",
-        "NBR": "N", 
-        "BT": "T",
-        "VT": "V",
-        "BOOM": "M"
-    }
-    
-    prefix = type_prefix.get(material_type, "X")  # Default to X if type not found
+# Material listing order
+# Raw materials and inventory items are listed BUR, NBR, BT, BOOM, VT, then by size.
+# The type rank is stored on each document as `priority` so the listings can be
+# read in order straight from the (company_id, priority, inner, outer) indexes.
+MATERIAL_TYPE_PRIORITY = {'BUR': 1, 'NBR': 2, 'BT': 3, 'BOOM': 4, 'VT': 5}
+MATERIAL_DEFAULT_PRIORITY = 6
+MATERIAL_PAGE_MAX_LIMIT = 1000
+MATERIAL_LISTING_KEYS = ["priority", "inner_diameter", "outer_diameter", "id"]
+
+def material_priority(material_type: Any) -> int:
+    return MATERIAL_TYPE_PRIORITY.get(getattr(material_type, "value", material_type), MATERIAL_DEFAULT_PRIORITY)
+
+def keyset_after(cursor: Dict[str, Any], keys: List[str]) -> Dict[str, Any]:
+    """Condition for rows after `cursor` in ascending order of `keys`"""
+    return {"$or": [
+        {**{key: cursor[key] for key in keys[:position]}, keys[position]: {"$gt": cursor[keys[position]]}}
+        for position in range(len(keys))
+    ]}
+
+async def backfill_material_priorities() -> None:
+    """One-time migration: store `priority` on raw materials and inventory items"""
+    if await db.job_checkpoints.find_one({"_id": "material_priorities_backfilled"}):
+        return
+    for collection in (db.raw_materials, db.inventory_items):
+        for material_type, priority in MATERIAL_TYPE_PRIORITY.items():
+            await collection.update_many({"material_type": material_type}, {"$set": {"priority": priority}})
+        await collection.update_many(
+            {"material_type": {"$nin": list(MATERIAL_TYPE_PRIORITY)}},
+            {"$set": {"priority": MATERIAL_DEFAULT_PRIORITY}}
+        )
+    await db.job_checkpoints.update_one(
+        {"_id": "material_priorities_backfilled"},
+        {"$set": {"backfilled_at": datetime.utcnow()}},
+        upsert=True
+    )
+
+async def list_materials_in_order(collection, query: Dict[str, Any], response: Response, limit: Optional[int], after: Optional[str]) -> List[Dict[str, Any]]:
+    """Read a material listing in index order; with `limit`, one page plus X-Next-Cursor"""
+    if after:
+        query = {**query, **keyset_after(decode_page_cursor(after, MATERIAL_LISTING_KEYS), MATERIAL_LISTING_KEYS)}
     
-    # Find existing materials with same specifications
-    existing_materials = await db.raw_materials.find({
-        "material_type": material_type,
-        "inner_diameter": inner_diameter,
-        "outer_diameter": outer_diameter
-    }).to_list(None)
+    cursor = collection.find(query, {"_id": 0}).sort([(key, 1) for key in MATERIAL_LISTING_KEYS])
+    if limit is None:
+        return await cursor.to_list(None)
     
-    # Get the highest sequence number
-    max_sequence = 0
-    for mat in existing_materials:
-        unit_code = mat.get("unit_code", "")
-        if unit_code.startswith(f"{prefix}-"):
-            try:
-                sequence = int(unit_code.split("-")[1])
-                max_sequence = max(max_sequence, sequence)
-            except (IndexError, ValueError):
-                continue
+    materials = await cursor.limit(limit + 1).to_list(limit + 1)
+    if len(materials) > limit:
+        materials = materials[:limit]
+        last = materials[-1]
+        response.headers["X-Next-Cursor"] = encode_page_cursor({key: last.get(key) for key in MATERIAL_LISTING_KEYS})
+    return materials
+
+# Material code generation helper
+# Unit codes run per (material type, inner, outer) spec, e.g. N-1, N-2. The next
+# number comes from a counter document in the counters collection advanced with a
+# single findOneAndUpdate $inc; seed_unit_code_counters raises the counters past
+# the codes already in use.
+UNIT_CODE_PREFIXES = {
+    "BUR": "B",
+    "NBR": "N",
+    "BT": "T",
+    "VT": "V",
+    "BOOM": "M"
+}
+
+def unit_code_counter_key(material_type: Any, inner_diameter: float, outer_diameter: float) -> str:
+    material_type = getattr(material_type, "value", material_type)
+    return f"unit_code:{material_type}:{float(inner_diameter):g}:{float(outer_diameter):g}"
+
+def unit_code_sequence(material_type: Any, unit_code: Optional[str]) -> Optional[int]:
+    """Sequence number of a unit code like N-12, or None if it does not follow the pattern"""
+    prefix = UNIT_CODE_PREFIXES.get(getattr(material_type, "value", material_type), "X")
+    if not unit_code or not unit_code.startswith(f"{prefix}-"):
+        return None
+    try:
+        return int(unit_code.split("-")[1])
+    except (IndexError, ValueError):
+        return None
+
+async def raise_unit_code_counters(materials: List[Dict[str, Any]]) -> None:
+    """Make sure each spec's counter is at least the highest sequence among `materials`"""
+    highest: Dict[str, int] = {}
+    for material in materials:
+        sequence = unit_code_sequence(material.get("material_type"), material.get("unit_code"))
+        if sequence is None:
+            continue
+        key = unit_code_counter_key(material.get("material_type"), material.get("inner_diameter", 0), material.get("outer_diameter", 0))
+        highest[key] = max(highest.get(key, 0), sequence)
     
-    # Generate new code with next sequence number
-    new_sequence = max_sequence + 1
-    return f"{prefix}-{new_sequence}"
+    if highest:
+        await db.counters.bulk_write([
+            UpdateOne({"_id": key}, {"$max": {"seq": sequence}, "$setOnInsert": {"sequence_type": "unit_code"}}, upsert=True)
+            for key, sequence in highest.items()
+        ], ordered=False)
+
+async def seed_unit_code_counters() -> None:
+    """One-time migration: start every spec's counter after the codes already issued"""
+    if await db.job_checkpoints.find_one({"_id": "unit_code_counters_seeded"}):
+        return
+    materials = await db.raw_materials.find(
+        {}, {"_id": 0, "material_type": 1, "inner_diameter": 1, "outer_diameter": 1, "unit_code": 1}
+    ).to_list(None)
+    await raise_unit_code_counters(materials)
+    await db.job_checkpoints.update_one(
+        {"_id": "unit_code_counters_seeded"},
+        {"$set": {"seeded_at": datetime.utcnow(), "materials": len(materials)}},
+        upsert=True
+    )
+
+async def generate_unit_code(material_type: str, inner_diameter: float, outer_diameter: float):
+    """Generate automatic unit code based on material type and specifications"""
+    prefix = UNIT_CODE_PREFIXES.get(getattr(material_type, "value", material_type), "X")  # Default to X if type not found
+    counter = await db.counters.find_one_and_update(
+        {"_id": unit_code_counter_key(material_type, inner_diameter, outer_diameter)},
+        {"$inc": {"seq": 1}, "$setOnInsert": {"sequence_type": "unit_code"}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return f"{prefix}-{counter['seq']}"
 
 @api_router.post("/raw-materials", response_model=RawMaterial)
 async def create_raw_material(material: RawMaterialCreate, company_id: str):
@@ -617,13 +855,6 @@ async def create_raw_material(material: RawMaterialCreate, company_id: str):
     try:
         company_id = get_company_id_from_request(company_id)
         
-        # Generate automatic unit code
-        auto_unit_code = await generate_unit_code(
-            material.material_type,
-            material.inner_diameter, 
-            material.outer_diameter
-        )
-        
         # Check inventory availability
         inventory_check = await check_inventory_availability(
             material_type=material.material_type,
@@ -638,12 +869,21 @@ async def create_raw_material(material: RawMaterialCreate, company_id: str):
                 detail=f"لا يمكن إضافة المادة الخام. {inventory_check['message']}. المطلوب: {material.pieces_count} قطعة، المتاح: {inventory_check['available_pieces']} قطعة"
             )
         
+        # Generate automatic unit code
+        auto_unit_code = await generate_unit_code(
+            material.material_type,
+            material.inner_diameter, 
+            material.outer_diameter
+        )
+        
         # Create raw material with auto-generated unit code
         material_dict = material.dict()
         material_dict["unit_code"] = auto_unit_code  # Override with auto-generated code
         material_dict['company_id'] = company_id  # Add company_id
+        material_dict['priority'] = material_priority(material.material_type)
         material_obj = RawMaterial(**material_dict)
         await db.raw_materials.insert_one(material_obj.dict())
+        mark_materials_changed([material_obj.id])
         
         # Deduct from inventory
         deduction_amount = material.height * material.pieces_count
@@ -669,37 +909,63 @@ async def create_raw_material(material: RawMaterialCreate, company_id: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.get("/raw-materials", response_model=List[RawMaterial])
-async def get_raw_materials(company_id: str):
-    """Get raw materials for specific company"""
-    company_id = get_company_id_from_request(company_id)
-    # Define material type priority order: BUR-NBR-BT-BOOM-VT
-    material_priority = {'BUR': 1, 'NBR': 2, 'BT': 3, 'BOOM': 4, 'VT': 5}
-    
-    # Get all materials first
-    materials = await db.raw_materials.find({"company_id": company_id}).to_list(1000)
-    
-    # Sort by material type priority, then by diameter
-    sorted_materials = sorted(materials, key=lambda x: (
-        material_priority.get(x.get('material_type', ''), 6),  # Material priority
-        x.get('inner_diameter', 0),  # Then inner diameter
-        x.get('outer_diameter', 0)   # Then outer diameter
-    ))
+async def get_raw_materials(
+    company_id: str,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MATERIAL_PAGE_MAX_LIMIT),
+    after: Optional[str] = None
+):
+    """Get raw materials for specific company sorted by material type priority then size.
     
-    return [RawMaterial(**material) for material in sorted_materials]
+    Without `limit` the whole list is returned; with it, one page and the cursor of the
+    next page in the X-Next-Cursor header, to be passed back as `after`.
+    """
+    company_id = get_company_id_from_request(company_id)
+    materials = await list_materials_in_order(db.raw_materials, {"company_id": company_id}, response, limit, after)
+    return [RawMaterial(**material) for material in materials]
 
 @api_router.put("/raw-materials/{material_id}")
 async def update_raw_material(material_id: str, material: RawMaterialCreate):
     result = await db.raw_materials.update_one(
         {"id": material_id},
-        {"$set": material.dict()}
+        {"$set": {**material.dict(), "priority": material_priority(material.material_type)}}
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="المادة غير موجودة")
+    mark_materials_changed([material_id])
+    await raise_unit_code_counters([material.dict()])
     return {"message": "تم تحديث المادة بنجاح"}
 
+@api_router.get("/raw-materials/{material_id}/movements")
+async def get_raw_material_movements(
+    material_id: str,
+    response: Response,
+    limit: int = Query(100, ge=1, le=500),
+    after: Optional[str] = None
+):
+    """Deductions and restorations of a raw material, newest first; continue with X-Next-Cursor"""
+    query: Dict[str, Any] = {"material_id": material_id, "status": {"$ne": "pending"}}
+    if after:
+        cursor = decode_page_cursor(after, ["created_at", "id"])
+        query["$or"] = [
+            {"created_at": {"$lt": cursor["created_at"]}},
+            {"created_at": cursor["created_at"], "id": {"$lt": cursor["id"]}}
+        ]
+    
+    movements = await db.raw_material_movements.find(query, {"_id": 0}).sort(
+        [("created_at", -1), ("id", -1)]
+    ).limit(limit + 1).to_list(limit + 1)
+    if len(movements) > limit:
+        movements = movements[:limit]
+        response.headers["X-Next-Cursor"] = encode_page_cursor({
+            "created_at": movements[-1]["created_at"], "id": movements[-1]["id"]
+        })
+    return movements
+
 @api_router.delete("/raw-materials/clear-all")
 async def clear_all_raw_materials():
     result = await db.raw_materials.delete_many({})
+    invalidate_material_index()
     return {"message": f"تم حذف {result.deleted_count} مادة خام", "deleted_count": result.deleted_count}
 
 @api_router.delete("/raw-materials/{material_id}")
@@ -707,6 +973,7 @@ async def delete_raw_material(material_id: str):
     result = await db.raw_materials.delete_one({"id": material_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="المادة غير موجودة")
+    mark_materials_changed([material_id])
     return {"message": "تم حذف المادة بنجاح"}
 
 # Finished products endpoints
@@ -759,44 +1026,160 @@ async def update_finished_product(product_id: str, product_update: FinishedProdu
     
     return updated_product
 
+# Compatibility index
+# The compatibility check runs as the cashier types, so each company's raw materials are
+# kept in memory as NumPy arrays sorted by inner diameter: a lookup is one searchsorted
+# plus vectorised masks over outer diameter and type (by its listing priority).
+# Writes in this process mark the materials they touch and the next lookup reloads only
+# those. Other workers' writes are not seen until the TTL, so the index never filters
+# on height: the height and holds of the candidates are re-read from MongoDB and the
+# height checks run on those, and a material refilled elsewhere is not hidden. The TTL
+# only bounds how long a material added or resized elsewhere can be missed.
+MATERIAL_INDEX_TTL_SECONDS = int(os.environ.get("MATERIAL_INDEX_TTL_SECONDS", 60))
+MATERIAL_INDEX_PROJECTION = {"_id": 0, "deduction_tokens": 0}
+
+_material_indexes: Dict[Optional[str], Dict[str, Any]] = {}
+_material_index_changes: Dict[Optional[str], set] = {}
+
+def mark_materials_changed(material_ids) -> None:
+    for changed in _material_index_changes.values():
+        changed.update(material_ids)
+
+def invalidate_material_index() -> None:
+    _material_indexes.clear()
+
+def build_material_index(materials: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    rows = sorted(materials.values(), key=lambda m: m.get("inner_diameter", 0))
+    return {
+        "expires_at": datetime.utcnow() + timedelta(seconds=MATERIAL_INDEX_TTL_SECONDS),
+        "materials": materials,
+        "rows": rows,
+        "position": {material["id"]: position for position, material in enumerate(rows)},
+        "inner_diameter": np.array([m.get("inner_diameter", 0) for m in rows], dtype=float),
+        "outer_diameter": np.array([m.get("outer_diameter", 0) for m in rows], dtype=float),
+        "priority": np.array([material_priority(m.get("material_type")) for m in rows], dtype=np.int8)
+    }
+
+def apply_material_changes(index: Dict[str, Any], material_ids: List[str], materials: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Swap in fresh copies of changed materials; re-sort only when rows come, go or move"""
+    fresh = {material["id"]: material for material in materials}
+    resort = False
+    for material_id in material_ids:
+        old, new = index["materials"].get(material_id), fresh.get(material_id)
+        if new is None:
+            if index["materials"].pop(material_id, None) is not None:
+                resort = True
+            continue
+        index["materials"][material_id] = new
+        if (old is None or old.get("inner_diameter") != new.get("inner_diameter") or
+                old.get("material_type") != new.get("material_type")):
+            resort = True
+        elif not resort:
+            position = index["position"][material_id]
+            index["rows"][position] = new
+            index["outer_diameter"][position] = new.get("outer_diameter", 0)
+    
+    if resort:
+        expires_at = index["expires_at"]
+        index = build_material_index(index["materials"])
+        index["expires_at"] = expires_at
+    return index
+
+async def get_material_index(company_id: Optional[str] = None) -> Dict[str, Any]:
+    """The compatibility index of a company, or of all materials when company_id is None"""
+    changed = _material_index_changes.setdefault(company_id, set())
+    index = _material_indexes.get(company_id)
+    query: Dict[str, Any] = {"company_id": company_id} if company_id else {}
+    
+    if index is None or index["expires_at"] <= datetime.utcnow():
+        changed.clear()
+        materials = await db.raw_materials.find(query, MATERIAL_INDEX_PROJECTION).to_list(None)
+        index = build_material_index({material["id"]: material for material in materials})
+    
+    # Also picks up writes that landed while the full load above was running
+    if changed:
+        material_ids = list(changed)
+        changed.clear()
+        materials = await db.raw_materials.find({**query, "id": {"$in": material_ids}}, MATERIAL_INDEX_PROJECTION).to_list(None)
+        index = apply_material_changes(index, material_ids, materials)
+    
+    _material_indexes[company_id] = index
+    return index
+
+def material_index_candidates(index: Dict[str, Any], max_inner: float, min_outer: float,
+                              material_type: Optional[str] = None) -> List[Dict[str, Any]]:
+    end = int(np.searchsorted(index["inner_diameter"], max_inner, side="right"))
+    mask = index["outer_diameter"][:end] >= min_outer
+    if material_type:
+        mask &= index["priority"][:end] == material_priority(material_type)
+    return [index["rows"][position] for position in np.flatnonzero(mask)]
+
+async def refresh_material_candidates(candidates: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Copies of the candidates with current height and holds; materials deleted since are dropped"""
+    if not candidates:
+        return []
+    current = {
+        material["id"]: material
+        async for material in db.raw_materials.find(
+            {"id": {"$in": [candidate["id"] for candidate in candidates]}},
+            {"_id": 0, "id": 1, "height": 1, "holds": 1}
+        )
+    }
+    # Let the next lookup reload whatever another worker changed
+    mark_materials_changed([
+        candidate["id"] for candidate in candidates
+        if candidate["id"] not in current or current[candidate["id"]].get("height") != candidate.get("height")
+    ])
+    return [
+        {**candidate, "height": current[candidate["id"]].get("height", 0), "holds": current[candidate["id"]].get("holds", [])}
+        for candidate in candidates if candidate["id"] in current
+    ]
+
 # Compatibility check endpoint
+COMPATIBILITY_TOLERANCE = 0.1  # diameter window around the requested size
+
 @api_router.post("/compatibility-check")
-async def check_compatibility(check: CompatibilityCheck):
-    # Get raw materials
-    raw_materials = await db.raw_materials.find().to_list(1000)
-    finished_products = await db.finished_products.find().to_list(1000)
-    
+async def check_compatibility(check: CompatibilityCheck, company_id: Optional[str] = None):
     compatible_materials = []
     compatible_products = []
     
     # Define tolerance ranges for better compatibility matching
     # Especially important for converted measurements from inches
-    tolerance_percentage = 0.1  # 10% tolerance
+    tolerance_percentage = COMPATIBILITY_TOLERANCE  # 10% tolerance
     
     inner_tolerance = check.inner_diameter * tolerance_percentage
     outer_tolerance = check.outer_diameter * tolerance_percentage
     height_tolerance = max(5.0, check.height * tolerance_percentage)  # Minimum 5mm or 10%
+    now = datetime.utcnow()
+    
+    # Narrow down by diameter window and type from the in-memory index; heights are
+    # checked below on the values refreshed from MongoDB
+    index = await get_material_index(company_id)
+    candidates = await refresh_material_candidates(material_index_candidates(
+        index,
+        max_inner=check.inner_diameter + inner_tolerance,
+        min_outer=check.outer_diameter - outer_tolerance,
+        material_type=check.material_type
+    ))
     
     # Check raw materials
-    for material in raw_materials:
-        # Remove MongoDB ObjectId if present
-        if "_id" in material:
-            del material["_id"]
-            
-        # Material type filter - if specified, only show materials of that type
-        if check.material_type and material.get("material_type") != check.material_type:
-            continue
+    for material in candidates:
+        
+        # Height held by other cashiers' quotes is not available
+        material["reserved_height"] = held_height(material, now, {check.quote_id})
+        material["available_height"] = material.get("height", 0) - material["reserved_height"]
+        material.pop("holds", None)
             
         # CRITICAL: Filter materials based on usability after consumption
         # Don't show materials if using them would leave < 15mm (unusable waste)
-        if material.get("height", 0) <= 15:
+        if material["available_height"] <= 15:
             continue
             
         # Calculate required material height for one seal
         required_height_per_seal = check.height + 2
         
         # Check if material can produce at least 1 seal AND remain >= 15mm or become 0
-        material_height = material.get("height", 0)
+        material_height = material["available_height"]
         remaining_after_one_seal = material_height - required_height_per_seal
         
         # Skip material if it would leave unusable waste (1-14mm range)
@@ -813,7 +1196,7 @@ async def check_compatibility(check: CompatibilityCheck):
             compatibility_score = 100
             
             # Calculate compatibility warnings and scoring
-            if material["height"] < (check.height + 5):
+            if material_height < (check.height + 5):
                 warning = "تحذير: الارتفاع قريب من الحد الأدنى"
                 compatibility_score -= 10
             
@@ -836,7 +1219,7 @@ async def check_compatibility(check: CompatibilityCheck):
                 **material,
                 "warning": warning.strip(" -"),
                 "compatibility_score": compatibility_score,
-                "low_stock": material.get("height", 0) < 20,
+                "low_stock": material_height < 20,
                 "tolerance_used": {
                     "inner_tolerance": inner_tolerance,
                     "outer_tolerance": outer_tolerance,
@@ -848,6 +1231,12 @@ async def check_compatibility(check: CompatibilityCheck):
     compatible_materials.sort(key=lambda x: x.get("compatibility_score", 0), reverse=True)
     
     # Check finished products (keep exact matching for finished products)
+    finished_products = await db.finished_products.find({
+        "seal_type": getattr(check.seal_type, "value", check.seal_type),
+        "inner_diameter": {"$gte": check.inner_diameter - 1, "$lte": check.inner_diameter + 1},
+        "outer_diameter": {"$gte": check.outer_diameter - 1, "$lte": check.outer_diameter + 1},
+        "height": {"$gte": check.height - 1, "$lte": check.height + 1}
+    }).to_list(None)
     for product in finished_products:
         # Remove MongoDB ObjectId if present
         if "_id" in product:
@@ -877,13 +1266,1983 @@ async def check_compatibility(check: CompatibilityCheck):
         }
     }
 
-# Invoice endpoints
-@api_router.post("/invoices", response_model=Invoice)
-async def create_invoice(invoice: InvoiceCreate, supervisor_name: str = ""):
-    # Generate invoice number
-    invoice_count = await db.invoices.count_documents({})
-    invoice_number = f"INV-{invoice_count + 1:06d}"
+# Document number sequences
+# Numbers are handed out from blocks reserved atomically in the counters collection,
+# so each worker only hits the database once per SEQUENCE_BLOCK_SIZE numbers.
+SEQUENCE_BLOCK_SIZE = int(os.environ.get('SEQUENCE_BLOCK_SIZE', '20'))
+
+SEQUENCE_TYPES = {
+    "invoice": {"prefix": "INV", "collection": "invoices", "field": "invoice_number"},
+    "work_order": {"prefix": "WO", "collection": "work_orders", "field": "work_order_number"},
+    "supplier_payment": {"prefix": "SP", "collection": "supplier_transactions", "field": "payment_number"}
+}
+
+_sequence_blocks: Dict[str, List[int]] = {}  # key -> [next_number, last_number]
+_sequence_locks: Dict[str, asyncio.Lock] = {}
+_seeded_sequences: set = set()
+
+def format_sequence_number(sequence_type: str, number: int) -> str:
+    """Format a sequence number with its document prefix, e.g. INV-000042"""
+    return f"{SEQUENCE_TYPES[sequence_type]['prefix']}-{number:06d}"
+
+async def seed_sequence_counter(key: str, company_id: Optional[str], sequence_type: str):
+    """Make sure a new counter starts after the highest number already issued"""
+    spec = SEQUENCE_TYPES[sequence_type]
+    prefix = f"{spec['prefix']}-"
     
+    # Legacy numbers were allocated globally, so seed from the global maximum.
+    # Compare the numeric part: as strings "INV-999999" sorts after "INV-1000000"
+    latest = await db[spec["collection"]].aggregate([
+        {"$match": {spec["field"]: {"$regex": f"^{prefix}[0-9]+$"}}},
+        {"$group": {
+            "_id": None,
+            "highest": {"$max": {"$toLong": {"$substrCP": [f"${spec['field']}", len(prefix), {"$strLenCP": f"${spec['field']}"}]}}}
+        }}
+    ]).to_list(1)
+    
+    highest = latest[0]["highest"] if latest else 0
+    
+    await db.counters.update_one(
+        {"_id": key},
+        {
+            "$max": {"seq": highest},
+            "$setOnInsert": {"company_id": company_id, "sequence_type": sequence_type}
+        },
+        upsert=True
+    )
+
+async def allocate_sequence_numbers(company_id: Optional[str], sequence_type: str, count: int = 1) -> List[int]:
+    """Allocate `count` unique, increasing numbers for a company's document type.
+    
+    Blocks are reserved with a single findOneAndUpdate $inc, so numbers stay unique
+    across workers; numbers left in a block when a worker stops are skipped.
+    """
+    key = f"{company_id or 'default'}:{sequence_type}"
+    lock = _sequence_locks.setdefault(key, asyncio.Lock())
+    
+    async with lock:
+        if key not in _seeded_sequences:
+            await seed_sequence_counter(key, company_id, sequence_type)
+            _seeded_sequences.add(key)
+        
+        numbers = []
+        while len(numbers) < count:
+            block = _sequence_blocks.get(key)
+            if not block or block[0] > block[1]:
+                block_size = max(SEQUENCE_BLOCK_SIZE, count - len(numbers))
+                counter = await db.counters.find_one_and_update(
+                    {"_id": key},
+                    {"$inc": {"seq": block_size}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+                block = [counter["seq"] - block_size + 1, counter["seq"]]
+                _sequence_blocks[key] = block
+            
+            take = min(count - len(numbers), block[1] - block[0] + 1)
+            numbers.extend(range(block[0], block[0] + take))
+            block[0] += take
+        
+        return numbers
+
+async def next_sequence_number(company_id: Optional[str], sequence_type: str) -> str:
+    """Get the next formatted document number, e.g. INV-000042"""
+    numbers = await allocate_sequence_numbers(company_id, sequence_type)
+    return format_sequence_number(sequence_type, numbers[0])
+
+# Material deduction planning
+# Every seal consumes its height + 2 mm from the raw material it is cut from.
+SEAL_CUTTING_ALLOWANCE = 2
+MIN_USABLE_REMAINDER = 15  # remainders of 1-14 mm are unusable waste
+
+def _material_key(unit_code, inner_diameter, outer_diameter):
+    return (unit_code, inner_diameter, outer_diameter)
+
+def _spec_key(material_type, inner_diameter, outer_diameter):
+    return (material_type, inner_diameter, outer_diameter)
+
+async def resolve_invoice_materials(invoices: List[Dict[str, Any]]) -> Dict[str, Dict]:
+    """Load every raw material referenced by the invoices' items in a single query"""
+    unit_codes = set()
+    specs = set()
+    
+    for invoice in invoices:
+        for item in invoice.get("items", []):
+            if item.get("product_type") == "local":
+                continue
+            for material_info in item.get("selected_materials") or []:
+                if material_info.get("unit_code"):
+                    unit_codes.add(material_info["unit_code"])
+            material_details = item.get("material_details") or {}
+            if material_details.get("unit_code"):
+                unit_codes.add(material_details["unit_code"])
+            if material_details.get("material_type"):
+                specs.add(_spec_key(
+                    material_details.get("material_type"),
+                    material_details.get("inner_diameter"),
+                    material_details.get("outer_diameter")
+                ))
+            if item.get("material_used"):
+                unit_codes.add(item["material_used"])
+    
+    clauses = []
+    if unit_codes:
+        clauses.append({"unit_code": {"$in": sorted(unit_codes)}})
+    for material_type, inner_diameter, outer_diameter in specs:
+        clauses.append({
+            "material_type": material_type,
+            "inner_diameter": inner_diameter,
+            "outer_diameter": outer_diameter
+        })
+    
+    lookup = {"by_code": {}, "by_spec": {}, "by_unit_code": {}}
+    if not clauses:
+        return lookup
+    
+    materials = await db.raw_materials.find({"$or": clauses}, {"_id": 0}).to_list(None)
+    
+    # Keep the first match for each key, like the find_one lookups this replaces
+    for material in materials:
+        lookup["by_code"].setdefault(_material_key(
+            material.get("unit_code"), material.get("inner_diameter"), material.get("outer_diameter")
+        ), material)
+        lookup["by_spec"].setdefault(_spec_key(
+            material.get("material_type"), material.get("inner_diameter"), material.get("outer_diameter")
+        ), material)
+        lookup["by_unit_code"].setdefault(material.get("unit_code"), material)
+    
+    return lookup
+
+def _plan_deduction(plan, projected_heights, item_result, material, seals, consumption, token_prefix):
+    """Record one planned deduction against the projected material height"""
+    deduction = {
+        "material_id": material["id"],
+        "company_id": material.get("company_id"),
+        "unit_code": material.get("unit_code"),
+        "seals": seals,
+        "consumption": consumption,
+        "cost_per_mm": material.get("cost_per_mm", 0),
+        "quote_id": item_result.get("quote_id"),
+        "available_height": projected_heights[material["id"]],
+        "status": "planned",
+        "token": f"{token_prefix}:{plan['operation_count']}"
+    }
+    projected_heights[material["id"]] -= consumption
+    deduction["remaining_height"] = projected_heights[material["id"]]
+    item_result["deductions"].append(deduction)
+    plan["operation_count"] += 1
+    return deduction
+
+async def plan_material_deductions(invoices: List[Dict[str, Any]], token_prefix: Optional[str] = None) -> Dict[str, Any]:
+    """Work out the height deductions for every manufactured item of the given invoices.
+    
+    Materials are resolved with one query and checked against projected heights, so
+    several items cutting from the same material see each other's consumption.
+    Heights held for other quotes are not counted as available.
+    A stable token_prefix makes re-applying the same plan a no-op.
+    """
+    token_prefix = token_prefix or str(uuid.uuid4())
+    lookup = await resolve_invoice_materials(invoices)
+    plan = {"operation_count": 0, "results": []}
+    projected_heights: Dict[str, float] = {}
+    now = datetime.utcnow()
+    quote_ids = {invoice.get("quote_id") for invoice in invoices if invoice.get("quote_id")}
+    
+    def projected(material):
+        if material["id"] not in projected_heights:
+            projected_heights[material["id"]] = material.get("height", 0) - held_height(material, now, quote_ids)
+        return projected_heights[material["id"]]
+    
+    for invoice in invoices:
+        for item_index, item in enumerate(invoice.get("items", [])):
+            if item.get("product_type") == "local":
+                continue
+            
+            seal_consumption_per_piece = (item.get("height") or 0) + SEAL_CUTTING_ALLOWANCE
+            item_result = {
+                "invoice_id": invoice.get("id"),
+                "quote_id": invoice.get("quote_id"),
+                "item_index": item_index,
+                "source": None,
+                "seals_requested": item.get("quantity", 0),
+                "deductions": [],
+                "errors": []
+            }
+            material_deducted = False
+            
+            # Prioritize multi-material selection over single material selection
+            if item.get("selected_materials"):
+                item_result["source"] = "selected_materials"
+                for material_info in item["selected_materials"]:
+                    material = lookup["by_code"].get(_material_key(
+                        material_info.get("unit_code"),
+                        material_info.get("inner_diameter"),
+                        material_info.get("outer_diameter")
+                    ))
+                    if not material:
+                        item_result["errors"].append({"unit_code": material_info.get("unit_code"), "reason": "not_found"})
+                        continue
+                    
+                    seals_to_produce = material_info.get("seals_count", 0)
+                    material_consumption = seals_to_produce * seal_consumption_per_piece
+                    if projected(material) >= material_consumption:
+                        _plan_deduction(plan, projected_heights, item_result, material, seals_to_produce, material_consumption, token_prefix)
+                    else:
+                        item_result["errors"].append({
+                            "unit_code": material.get("unit_code"),
+                            "reason": "insufficient_height",
+                            "required": material_consumption,
+                            "available": projected(material)
+                        })
+                material_deducted = True
+            
+            # Single material selection
+            elif item.get("material_details"):
+                material_details = item["material_details"]
+                if not material_details.get("is_finished_product", False):
+                    item_result["source"] = "material_details"
+                    material = None
+                    if (material_details.get("inner_diameter") and
+                        material_details.get("outer_diameter") and
+                        material_details.get("unit_code")):
+                        material = lookup["by_code"].get(_material_key(
+                            material_details.get("unit_code"),
+                            material_details.get("inner_diameter"),
+                            material_details.get("outer_diameter")
+                        ))
+                    if not material and material_details.get("material_type"):
+                        material = lookup["by_spec"].get(_spec_key(
+                            material_details.get("material_type"),
+                            material_details.get("inner_diameter"),
+                            material_details.get("outer_diameter")
+                        ))
+                    
+                    if material:
+                        material_height = projected(material)
+                        max_possible_seals = int(material_height // seal_consumption_per_piece) if seal_consumption_per_piece > 0 else 0
+                        
+                        # Leave either nothing or a usable remainder
+                        remaining_after_max = material_height - (max_possible_seals * seal_consumption_per_piece)
+                        if 0 < remaining_after_max < MIN_USABLE_REMAINDER and max_possible_seals > 0:
+                            max_possible_seals -= 1
+                        
+                        actual_seals_to_produce = min(item.get("quantity", 0), max_possible_seals)
+                        material_consumption = actual_seals_to_produce * seal_consumption_per_piece
+                        
+                        if actual_seals_to_produce > 0 and material_height >= material_consumption:
+                            _plan_deduction(plan, projected_heights, item_result, material, actual_seals_to_produce, material_consumption, token_prefix)
+                            material_deducted = True
+                        else:
+                            item_result["errors"].append({
+                                "unit_code": material.get("unit_code"),
+                                "reason": "insufficient_height",
+                                "required": seal_consumption_per_piece,
+                                "available": material_height
+                            })
+                    else:
+                        item_result["errors"].append({"unit_code": material_details.get("unit_code"), "reason": "not_found"})
+            
+            # Fallback to material_used only if no deduction was planned above
+            if item.get("material_used") and not material_deducted:
+                item_result["source"] = item_result["source"] or "material_used"
+                material = lookup["by_unit_code"].get(item["material_used"])
+                if material:
+                    material_consumption = seal_consumption_per_piece * item.get("quantity", 0)
+                    if projected(material) >= material_consumption:
+                        _plan_deduction(plan, projected_heights, item_result, material, item.get("quantity", 0), material_consumption, token_prefix)
+                    else:
+                        item_result["errors"].append({
+                            "unit_code": item["material_used"],
+                            "reason": "insufficient_height",
+                            "required": material_consumption,
+                            "available": projected(material)
+                        })
+                else:
+                    item_result["errors"].append({"unit_code": item["material_used"], "reason": "not_found"})
+            
+            item_result["seals_planned"] = sum(d["seals"] for d in item_result["deductions"])
+            plan["results"].append(item_result)
+    
+    return plan
+
+async def apply_material_deductions(plan: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Apply all planned deductions with one bulk_write and return the per-item results.
+    
+    Each update only matches while the material still has enough height outside
+    other quotes' holds, so a concurrent sale can never drive a material negative
+    or into reserved mm; such deductions are reported with status "conflict".
+    The same update drops the invoice's own hold, converting it into the deduction.
+    Each deduction is recorded as a movement under its token and applied only once.
+    """
+    now = datetime.utcnow()
+    deductions = [(item_result, deduction) for item_result in plan["results"] for deduction in item_result["deductions"]]
+    if deductions:
+        applied_tokens = await apply_material_movements(
+            [
+                RawMaterialMovement(
+                    company_id=deduction.get("company_id"),
+                    material_id=deduction["material_id"],
+                    unit_code=deduction.get("unit_code"),
+                    movement_type="deduction",
+                    height_change=-deduction["consumption"],
+                    seals=deduction["seals"],
+                    reference_invoice_id=item_result["invoice_id"],
+                    item_index=item_result["item_index"],
+                    token=deduction["token"]
+                )
+                for item_result, deduction in deductions
+            ],
+            conditions=[available_height_filter(deduction["consumption"], now, deduction.get("quote_id")) for _, deduction in deductions],
+            updates=[{"$pull": {"holds": spent_holds_condition(now, deduction.get("quote_id"))}} for _, deduction in deductions]
+        )
+        for _, deduction in deductions:
+            deduction["status"] = "applied" if deduction["token"] in applied_tokens else "conflict"
+    
+    # Holds the invoice did not cut from are released with the sale
+    for quote_id in {item_result.get("quote_id") for item_result in plan["results"]} - {None}:
+        await release_material_reservations(quote_id)
+    
+    for item_result in plan["results"]:
+        if item_result["errors"] or any(d["status"] != "applied" for d in item_result["deductions"]):
+            logger.warning(f"Material deduction incomplete for invoice {item_result['invoice_id']} item {item_result['item_index']}: {item_result}")
+    
+    return plan["results"]
+
+# Material reservations
+# While a cashier builds an invoice, mm of specific raw materials can be held under the
+# quote's id. Holds live on the raw material document itself, so reserving and selling
+# check the height left outside other quotes' holds in the same single-document update
+# that changes it. A hold lapses at expires_at: lapsed holds are ignored everywhere and
+# pruned the next time the material is reserved or cut.
+MATERIAL_RESERVATION_TTL_SECONDS = int(os.environ.get('MATERIAL_RESERVATION_TTL_SECONDS', '900'))
+
+def held_height(material: Dict[str, Any], now: datetime, exclude_quote_ids=()) -> float:
+    """mm of a material held by active holds of quotes other than exclude_quote_ids"""
+    return sum(
+        hold.get("height", 0) for hold in material.get("holds") or []
+        if hold.get("expires_at") and hold["expires_at"] > now and hold.get("quote_id") not in exclude_quote_ids
+    )
+
+def available_height_filter(height: float, now: datetime, quote_id: Optional[str] = None) -> Dict[str, Any]:
+    """Match materials with at least `height` mm outside the active holds of other quotes"""
+    conditions = [{"$gt": ["$$hold.expires_at", now]}]
+    if quote_id:
+        conditions.append({"$ne": ["$$hold.quote_id", quote_id]})
+    held = {"$sum": {"$map": {
+        "input": {"$filter": {"input": {"$ifNull": ["$holds", []]}, "as": "hold", "cond": {"$and": conditions}}},
+        "as": "hold",
+        "in": "$$hold.height"
+    }}}
+    return {
+        "height": {"$gte": height},
+        "$expr": {"$gte": [{"$subtract": ["$height", held]}, height]}
+    }
+
+def spent_holds_condition(now: datetime, quote_id: Optional[str] = None) -> Dict[str, Any]:
+    """$pull condition for lapsed holds and, when given, the holds of quote_id"""
+    if quote_id:
+        return {"$or": [{"quote_id": quote_id}, {"expires_at": {"$lte": now}}]}
+    return {"expires_at": {"$lte": now}}
+
+async def release_material_reservations(quote_id: str) -> int:
+    material_ids = await db.raw_materials.distinct("id", {"holds.quote_id": quote_id})
+    if not material_ids:
+        return 0
+    result = await db.raw_materials.update_many(
+        {"id": {"$in": material_ids}},
+        {"$pull": {"holds": {"quote_id": quote_id}}}
+    )
+    mark_materials_changed(material_ids)
+    return result.modified_count
+
+@api_router.post("/material-reservations")
+async def reserve_material(reservation: MaterialReservationCreate):
+    """Hold the mm for `seals_count` seals of a raw material for an invoice being prepared.
+    
+    There is one hold per quote and material: reserving again replaces it and restarts
+    its time limit.
+    """
+    try:
+        now = datetime.utcnow()
+        hold = MaterialHold(
+            quote_id=reservation.quote_id,
+            height=reservation.seals_count * (reservation.seal_height + SEAL_CUTTING_ALLOWANCE),
+            seals=reservation.seals_count,
+            created_by=reservation.created_by,
+            expires_at=now + timedelta(seconds=MATERIAL_RESERVATION_TTL_SECONDS)
+        )
+        
+        # One update swaps the quote's previous hold for the new one and drops lapsed holds
+        material = await db.raw_materials.find_one_and_update(
+            {"id": reservation.material_id, **available_height_filter(hold.height, now, reservation.quote_id)},
+            [{"$set": {"holds": {"$concatArrays": [
+                {"$filter": {
+                    "input": {"$ifNull": ["$holds", []]},
+                    "as": "hold",
+                    "cond": {"$and": [
+                        {"$gt": ["$$hold.expires_at", now]},
+                        {"$ne": ["$$hold.quote_id", reservation.quote_id]}
+                    ]}
+                }},
+                [{"$literal": hold.dict()}]
+            ]}}}],
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if not material:
+            material = await db.raw_materials.find_one({"id": reservation.material_id}, {"_id": 0})
+            if not material:
+                raise HTTPException(status_code=404, detail="المادة غير موجودة")
+            available = material.get("height", 0) - held_height(material, now, {reservation.quote_id})
+            raise HTTPException(
+                status_code=409,
+                detail=f"الارتفاع المتاح {available} مم لا يكفي لحجز {hold.height} مم من الخامة {material.get('unit_code')}"
+            )
+        mark_materials_changed([reservation.material_id])
+        
+        return {
+            **hold.dict(),
+            "material_id": reservation.material_id,
+            "unit_code": material.get("unit_code"),
+            "available_height": material.get("height", 0) - held_height(material, now, {reservation.quote_id}) - hold.height
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/material-reservations/{quote_id}")
+async def get_material_reservations(quote_id: str):
+    """Active holds of a quote"""
+    now = datetime.utcnow()
+    materials = await db.raw_materials.find(
+        {"holds.quote_id": quote_id},
+        {"_id": 0, "id": 1, "unit_code": 1, "holds": 1}
+    ).to_list(None)
+    return [
+        {**hold, "material_id": material["id"], "unit_code": material.get("unit_code")}
+        for material in materials
+        for hold in material.get("holds", [])
+        if hold.get("quote_id") == quote_id and hold.get("expires_at") and hold["expires_at"] > now
+    ]
+
+@api_router.delete("/material-reservations/{quote_id}")
+async def delete_material_reservations(quote_id: str):
+    """Release every hold of a quote, e.g. when the invoice is abandoned"""
+    released = await release_material_reservations(quote_id)
+    return {"message": f"تم إلغاء حجز {released} خامة", "released": released}
+
+# Cutting plan
+# Picks how many seals to cut from each compatible raw material. A material cut for k
+# seals keeps height - k * (seal height + 2) mm, which must be 0 or a usable remainder.
+# The plan minimises the height left on the materials it cuts, so short pieces are used
+# up before fresh ones are opened; ties go to fewer materials and closer diameters.
+# A knapsack-style DP over the seal count runs one vectorised step per material, in a
+# worker thread so the event loop keeps serving requests meanwhile.
+CUTTING_PLAN_TIE_BREAK = 1e-3  # per material cut, scaled by how loosely it fits
+CUTTING_PLAN_MAX_CELLS = 50_000_000  # DP cells (seal counts x order size) per plan
+CUTTING_PLAN_STEP_CELLS = 1_000_000  # cells evaluated at once within one material's step
+
+def select_cutting_candidates(available: np.ndarray, consumption: float, quantity: int, fit: np.ndarray) -> np.ndarray:
+    """Indices of the materials to plan over: all that fit a seal while the DP stays within
+    CUTTING_PLAN_MAX_CELLS, otherwise the best-fitting, then longest, pieces that do"""
+    capacity = np.minimum(np.floor(available / consumption + 1e-9), quantity)
+    usable = np.flatnonzero(capacity >= 1)
+    order = usable[np.lexsort((-available[usable], fit[usable]))]
+    cells = np.cumsum(capacity[order] * (quantity + 1))
+    return np.sort(order[:max(1, int(np.searchsorted(cells, CUTTING_PLAN_MAX_CELLS, side="right")))])
+
+def solve_cutting_plan(available: np.ndarray, consumption: float, quantity: int, fit: np.ndarray) -> np.ndarray:
+    """Seals to cut from each material: as many as possible up to quantity, least leftover first"""
+    seals_range = np.arange(quantity + 1)
+    best = np.full(quantity + 1, np.inf)
+    best[0] = 0.0
+    choices = np.zeros((len(available), quantity + 1), dtype=np.int64)
+    step = max(1, CUTTING_PLAN_STEP_CELLS // (quantity + 1))
+    
+    for index, height in enumerate(available):
+        # Seal counts this material can give without leaving an unusable remainder
+        counts = np.arange(1, min(quantity, int(height // consumption + 1e-9)) + 1)
+        leftover = np.round(height - counts * consumption, 6)
+        usable = (leftover == 0) | (leftover >= MIN_USABLE_REMAINDER)
+        counts, leftover = counts[usable], leftover[usable]
+        if not len(counts):
+            continue
+        costs = leftover + CUTTING_PLAN_TIE_BREAK * (1 + fit[index])
+        
+        # candidates[c, j]: reach j seals by cutting counts[c] from this material, built
+        # a slice of counts at a time so a tall piece and a large order stay in memory
+        previous = best
+        for start in range(0, len(counts), step):
+            sources = seals_range[None, :] - counts[start:start + step, None]
+            candidates = np.where(sources >= 0, previous[np.clip(sources, 0, None)] + costs[start:start + step, None], np.inf)
+            pick = candidates.argmin(axis=0)
+            cut = candidates[pick, seals_range]
+            improved = cut < best
+            choices[index, improved] = counts[start + pick[improved]]
+            best = np.where(improved, cut, best)
+    
+    # Fill as much of the order as possible, then trace the choices back
+    seals = int(np.flatnonzero(np.isfinite(best)).max())
+    assignment = np.zeros(len(available), dtype=np.int64)
+    for index in range(len(available) - 1, -1, -1):
+        assignment[index] = choices[index, seals]
+        seals -= assignment[index]
+    return assignment
+
+@api_router.post("/cutting-plan")
+async def create_cutting_plan(request: CuttingPlanRequest, company_id: Optional[str] = None):
+    """Plan which raw materials to cut an order line from, as selected_materials for the invoice item"""
+    try:
+        consumption = request.height + SEAL_CUTTING_ALLOWANCE
+        query: Dict[str, Any] = {
+            "inner_diameter": {"$lte": request.inner_diameter * (1 + COMPATIBILITY_TOLERANCE)},
+            "outer_diameter": {"$gte": request.outer_diameter * (1 - COMPATIBILITY_TOLERANCE)},
+            "height": {"$gte": consumption}
+        }
+        if company_id:
+            query["company_id"] = company_id
+        if request.material_type:
+            query["material_type"] = request.material_type
+        
+        materials = await db.raw_materials.find(
+            query,
+            {"_id": 0, "id": 1, "unit_code": 1, "material_type": 1, "inner_diameter": 1, "outer_diameter": 1, "height": 1, "holds": 1}
+        ).to_list(None)
+        
+        now = datetime.utcnow()
+        available = np.array([m.get("height", 0) - held_height(m, now, {request.quote_id}) for m in materials], dtype=float)
+        fit = np.array([
+            abs(m["inner_diameter"] - request.inner_diameter) + abs(m["outer_diameter"] - request.outer_diameter)
+            for m in materials
+        ], dtype=float)
+        
+        # No plan can cut more seals than the candidates hold in total
+        quantity = min(request.quantity, int(np.floor(available / consumption + 1e-9).clip(min=0).sum()))
+        assignment = np.zeros(len(materials), dtype=np.int64)
+        if quantity > 0:
+            chosen = select_cutting_candidates(available, consumption, quantity, fit)
+            assignment[chosen] = await run_in_threadpool(solve_cutting_plan, available[chosen], consumption, quantity, fit[chosen])
+        
+        selected_materials = []
+        for material, height, seals in zip(materials, available, assignment):
+            if seals == 0:
+                continue
+            selected_materials.append({
+                "id": material["id"],
+                "unit_code": material.get("unit_code"),
+                "material_type": material.get("material_type"),
+                "inner_diameter": material["inner_diameter"],
+                "outer_diameter": material["outer_diameter"],
+                "height": float(height),
+                "seals_count": int(seals),
+                "remaining_height": round(float(height - seals * consumption), 6)
+            })
+        
+        seals_planned = sum(m["seals_count"] for m in selected_materials)
+        return {
+            "selected_materials": selected_materials,
+            "seals_requested": request.quantity,
+            "seals_planned": seals_planned,
+            "shortfall": request.quantity - seals_planned,
+            "consumption_per_seal": consumption,
+            "total_consumption": seals_planned * consumption,
+            "total_leftover": sum(m["remaining_height"] for m in selected_materials),
+            "materials_used_up": sum(1 for m in selected_materials if m["remaining_height"] == 0),
+            "candidates": len(materials)
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Raw material movements
+# Every deduction and restoration is recorded under the token that guards its height
+# update, so a cancellation gives back exactly what was deducted. The movement is
+# written as pending before the update, and the update pushes the token onto the
+# material; settling then marks the movement applied (or drops it if the update did
+# not land) and pulls the token again. Whether an update landed can always be told,
+# and a settled movement is never applied a second time.
+async def settle_pending_movements(query: Dict[str, Any]) -> Dict[str, bool]:
+    """Settle the pending movements matching `query`; returns whether each token was applied"""
+    pending = await db.raw_material_movements.find(
+        {**query, "status": "pending"}, {"_id": 0, "token": 1, "material_id": 1}
+    ).to_list(None)
+    if not pending:
+        return {}
+    tokens = [movement["token"] for movement in pending]
+    material_ids = list({movement["material_id"] for movement in pending})
+    landed = set()
+    async for material in db.raw_materials.find(
+        {"id": {"$in": material_ids}, "deduction_tokens": {"$in": tokens}}, {"_id": 0, "deduction_tokens": 1}
+    ):
+        landed.update(token for token in material["deduction_tokens"] if token in tokens)
+    
+    if landed:
+        await db.raw_material_movements.update_many(
+            {"token": {"$in": list(landed)}, "status": "pending"}, {"$set": {"status": "applied"}}
+        )
+        # The applied movement guards its token from now on
+        await db.raw_materials.update_many(
+            {"id": {"$in": material_ids}}, {"$pull": {"deduction_tokens": {"$in": list(landed)}}}
+        )
+    dropped = [token for token in tokens if token not in landed]
+    if dropped:
+        await db.raw_material_movements.delete_many({"token": {"$in": dropped}, "status": "pending"})
+    mark_materials_changed(material_ids)
+    return {token: token in landed for token in tokens}
+
+async def apply_material_movements(
+    movements: List[RawMaterialMovement],
+    conditions: Optional[List[Dict[str, Any]]] = None,
+    updates: Optional[List[Dict[str, Any]]] = None
+) -> set:
+    """Apply each movement's height change once; returns the tokens applied now or earlier.
+    
+    `conditions` and `updates` add a filter and update operators per movement; a
+    movement whose filter does not match is dropped and can be attempted again.
+    """
+    if not movements:
+        return set()
+    tokens = [movement.token for movement in movements]
+    try:
+        await db.raw_material_movements.insert_many(
+            [{**movement.dict(), "status": "pending"} for movement in movements], ordered=False
+        )
+    except BulkWriteError as e:
+        # Movements written by an earlier attempt keep their token and status
+        if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+            raise
+    
+    recorded = {
+        movement["token"]: movement.get("status", "applied")
+        async for movement in db.raw_material_movements.find({"token": {"$in": tokens}}, {"_id": 0, "token": 1, "status": 1})
+    }
+    due = [index for index, movement in enumerate(movements) if recorded.get(movement.token) == "pending"]
+    settled = {}
+    if due:
+        await db.raw_materials.bulk_write([
+            UpdateOne(
+                {
+                    "id": movements[index].material_id,
+                    "deduction_tokens": {"$ne": movements[index].token},
+                    **(conditions[index] if conditions else {})
+                },
+                {
+                    "$inc": {"height": movements[index].height_change},
+                    "$push": {"deduction_tokens": movements[index].token},
+                    **(updates[index] if updates else {})
+                }
+            )
+            for index in due
+        ], ordered=True)
+        settled = await settle_pending_movements({"token": {"$in": [movements[index].token for index in due]}})
+    
+    return {token for token, status in recorded.items() if status != "pending"} | {
+        token for token, applied in settled.items() if applied
+    }
+
+async def restore_invoice_materials(invoice: Dict[str, Any], username: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Give back every recorded deduction of an invoice; restorations already made are skipped"""
+    # Settle what an interrupted deduction or restoration left pending first
+    await settle_pending_movements({"reference_invoice_id": invoice["id"]})
+    movements = await db.raw_material_movements.find({"reference_invoice_id": invoice["id"]}, {"_id": 0}).to_list(None)
+    restored_tokens = {movement["token"] for movement in movements if movement["movement_type"] == "restoration"}
+    deductions = [
+        movement for movement in movements
+        if movement["movement_type"] == "deduction" and f"restore:{movement['token']}" not in restored_tokens
+    ]
+    if not deductions:
+        return []
+    
+    restorations = [
+        RawMaterialMovement(
+            company_id=deduction.get("company_id"),
+            material_id=deduction["material_id"],
+            unit_code=deduction.get("unit_code"),
+            movement_type="restoration",
+            height_change=-deduction["height_change"],
+            seals=deduction.get("seals", 0),
+            reference_invoice_id=invoice["id"],
+            item_index=deduction.get("item_index"),
+            token=f"restore:{deduction['token']}",
+            created_by=username
+        )
+        for deduction in deductions
+    ]
+    applied_tokens = await apply_material_movements(restorations)
+    return [restoration.dict() for restoration in restorations if restoration.token in applied_tokens]
+
+async def restore_legacy_invoice_materials(invoice: Dict[str, Any], username: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Invoices from before the movement ledger: restore what their items say was used"""
+    await settle_pending_movements({"reference_invoice_id": invoice["id"]})
+    restored_tokens = set(await db.raw_material_movements.distinct("token", {"reference_invoice_id": invoice["id"]}))
+    restorations = []
+    for item_index, item in enumerate(invoice.get("items", [])):
+        if item.get("product_type") != "manufactured":
+            continue
+        consumption_per_seal = (item.get("height") or 0) + SEAL_CUTTING_ALLOWANCE
+        
+        if item.get("selected_materials"):
+            sources = [
+                (material_info, material_info.get("seals_count", 0))
+                for material_info in item["selected_materials"]
+            ]
+        elif item.get("material_details"):
+            sources = [(item["material_details"], item.get("quantity", 0))]
+        else:
+            sources = []
+        
+        for material_info, seals in sources:
+            raw_material = await db.raw_materials.find_one({
+                "unit_code": material_info.get("unit_code"),
+                "inner_diameter": material_info.get("inner_diameter"),
+                "outer_diameter": material_info.get("outer_diameter")
+            }, {"_id": 0, "id": 1, "company_id": 1, "unit_code": 1})
+            if not raw_material:
+                continue
+            
+            restoration = RawMaterialMovement(
+                company_id=raw_material.get("company_id"),
+                material_id=raw_material["id"],
+                unit_code=raw_material.get("unit_code"),
+                movement_type="restoration",
+                height_change=seals * consumption_per_seal,
+                seals=seals,
+                reference_invoice_id=invoice["id"],
+                item_index=item_index,
+                token=f"restore:{invoice['id']}:{item_index}:{raw_material['id']}",
+                created_by=username
+            )
+            if restoration.token in restored_tokens:
+                continue
+            restorations.append(restoration)
+    
+    applied_tokens = await apply_material_movements(restorations)
+    return [restoration.dict() for restoration in restorations if restoration.token in applied_tokens]
+
+# Daily work orders
+def build_work_order_entry(invoice: Dict[str, Any]) -> Dict[str, Any]:
+    """Copy an invoice for a work order, enriching manufactured items with material usage"""
+    entry = dict(invoice)
+    entry.pop("_id", None)
+    
+    enhanced_items = []
+    for item in entry.get("items", []):
+        enhanced_item = dict(item)
+        
+        # Add material consumption details for manufactured products
+        if item.get("product_type") == "manufactured":
+            seal_consumption = ((item.get("height") or 0) + SEAL_CUTTING_ALLOWANCE) * item.get("quantity", 0)
+            
+            # Build material info string based on selected materials
+            material_info = ""
+            unit_code_display = ""
+            
+            if item.get("selected_materials"):
+                # Multi-material case
+                material_parts = []
+                for mat in item.get("selected_materials", []):
+                    inner_dia = mat.get("inner_diameter", 0)
+                    outer_dia = mat.get("outer_diameter", 0)
+                    unit_code = mat.get("unit_code", "غير محدد")
+                    seals_count = mat.get("seals_count", 0)
+                    material_parts.append(f"{inner_dia}×{outer_dia} {unit_code} ({seals_count})")
+                
+                unit_code_display = " / ".join(material_parts)
+                material_info = f"مواد متعددة: {len(item.get('selected_materials', []))} خامة"
+                
+            elif item.get("material_details"):
+                # Single material case
+                mat_details = item.get("material_details")
+                inner_dia = mat_details.get("inner_diameter", 0)
+                outer_dia = mat_details.get("outer_diameter", 0)
+                unit_code = mat_details.get("unit_code", "غير محدد")
+                unit_code_display = f"{inner_dia}×{outer_dia} {unit_code} ({item.get('quantity', 0)})"
+                material_info = f"{unit_code} ({item.get('quantity', 0)} سيل)"
+                
+            elif item.get("material_used"):
+                # Fallback case
+                unit_code_display = f"{item.get('material_used')} ({item.get('quantity', 0)})"
+                material_info = f"{item.get('material_used')} ({item.get('quantity', 0)} سيل)"
+            
+            enhanced_item["material_consumption"] = seal_consumption
+            enhanced_item["material_info"] = material_info
+            enhanced_item["unit_code_display"] = unit_code_display  # This will be used in work order
+            enhanced_item["work_order_display"] = f"{item.get('seal_type', '')} {item.get('material_type', '')} {item.get('inner_diameter', 0)}×{item.get('outer_diameter', 0)}×{item.get('height', 0)} - {material_info} - استهلاك: {seal_consumption} مم"
+        
+        enhanced_items.append(enhanced_item)
+    
+    entry["items"] = enhanced_items
+    return entry
+
+async def get_or_create_daily_work_order_doc(work_date: str, supervisor_name: str = "") -> Dict[str, Any]:
+    """Get the daily work order for a date (YYYY-MM-DD), creating it if needed"""
+    existing_order = await db.work_orders.find_one(
+        {"is_daily": True, "work_date": work_date},
+        {"_id": 0, "invoices": 0}
+    )
+    if existing_order:
+        return existing_order
+    
+    work_date_obj = datetime.strptime(work_date, "%Y-%m-%d").date()
+    work_order = WorkOrder(
+        work_order_number=await next_sequence_number(None, "work_order"),
+        title=f"أمر شغل يومي - {work_date_obj.strftime('%d/%m/%Y')}",
+        description=f"أمر شغل يومي لجميع فواتير يوم {work_date_obj.strftime('%d/%m/%Y')}",
+        supervisor_name=supervisor_name,
+        is_daily=True,
+        work_date=work_date,  # Store as string
+        invoices=[],
+        total_amount=0.0,
+        total_items=0,
+        status="جديد"
+    )
+    
+    try:
+        await db.work_orders.insert_one(work_order.dict())
+    except DuplicateKeyError:
+        # Another request created today's work order first
+        return await db.work_orders.find_one(
+            {"is_daily": True, "work_date": work_date},
+            {"_id": 0, "invoices": 0}
+        )
+    
+    return work_order.dict()
+
+async def push_invoices_to_work_order(work_order_id: str, invoices: List[Dict[str, Any]], set_fields: Optional[Dict[str, Any]] = None) -> bool:
+    """Append invoices to a work order with a single atomic $push/$inc.
+    
+    Returns False if the work order does not exist or already holds one of the invoices.
+    """
+    if not invoices:
+        return True
+    
+    update = {
+        "$push": {"invoices": {"$each": invoices}},
+        "$inc": {
+            "total_amount": sum(invoice.get("total_amount", 0) for invoice in invoices),
+            "total_items": sum(len(invoice.get("items", [])) for invoice in invoices)
+        }
+    }
+    if set_fields:
+        update["$set"] = set_fields
+    
+    result = await db.work_orders.update_one(
+        {"id": work_order_id, "invoices.id": {"$nin": [invoice["id"] for invoice in invoices]}},
+        update
+    )
+    return result.matched_count > 0
+
+async def append_invoices_to_daily_work_order(invoices: List[Dict[str, Any]], supervisor_name: str = "", work_date: Optional[str] = None) -> Optional[str]:
+    """Add invoices to the daily work order (today by default) and return its id"""
+    work_date = work_date or datetime.now().date().isoformat()
+    daily_work_order = await get_or_create_daily_work_order_doc(work_date, supervisor_name)
+    
+    await push_invoices_to_work_order(
+        daily_work_order["id"],
+        [build_work_order_entry(invoice) for invoice in invoices],
+        {"supervisor_name": supervisor_name} if supervisor_name else None
+    )
+    return daily_work_order["id"]
+
+# Idempotency keys
+IDEMPOTENCY_KEY_TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_KEY_TTL_SECONDS", 24 * 3600))
+IDEMPOTENCY_LEASE_SECONDS = 60
+
+async def run_idempotent(scope: str, key: Optional[str], request_data: Any, handler):
+    """Run handler once per (scope, Idempotency-Key) and replay its stored response.
+    
+    A placeholder is claimed before the handler runs so a concurrent retry gets
+    409 instead of executing the writes a second time. The placeholder is
+    released when the handler fails, and can be taken over once its lease
+    expires if the process died mid-request.
+    """
+    if not key:
+        return await handler()
+    
+    record_id = f"{scope}:{key}"
+    request_hash = hashlib.sha256(
+        json.dumps(jsonable_encoder(request_data), sort_keys=True, ensure_ascii=False).encode()
+    ).hexdigest()
+    now = datetime.utcnow()
+    
+    try:
+        await db.idempotency_keys.insert_one({
+            "_id": record_id,
+            "scope": scope,
+            "request_hash": request_hash,
+            "status": "in_progress",
+            "created_at": now
+        })
+    except DuplicateKeyError:
+        record = await db.idempotency_keys.find_one({"_id": record_id})
+        if not record:
+            raise HTTPException(status_code=409, detail="الطلب قيد التنفيذ، أعد المحاولة")
+        if record["request_hash"] != request_hash:
+            raise HTTPException(status_code=422, detail="مفتاح الطلب مستخدم مع بيانات مختلفة")
+        if record["status"] == "completed":
+            return record["response"]
+        
+        # Take over a placeholder left behind by a crashed request
+        lease_expired = await db.idempotency_keys.update_one(
+            {
+                "_id": record_id,
+                "status": "in_progress",
+                "created_at": {"$lte": now - timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)}
+            },
+            {"$set": {"created_at": now}}
+        )
+        if lease_expired.modified_count == 0:
+            raise HTTPException(status_code=409, detail="الطلب قيد التنفيذ، أعد المحاولة")
+    
+    try:
+        result = await handler()
+    except Exception:
+        await db.idempotency_keys.delete_one({"_id": record_id, "status": "in_progress"})
+        raise
+    
+    await db.idempotency_keys.update_one(
+        {"_id": record_id},
+        {"$set": {
+            "status": "completed",
+            "response": jsonable_encoder(result),
+            "completed_at": datetime.utcnow()
+        }}
+    )
+    return result
+
+# Treasury balances
+# treasury_balances keeps one running balance per (company, account). Every posting
+# path applies its $inc right after writing the ledger, so reading balances is a
+# single indexed query; reconcile_treasury_balances rebuilds them from the ledger.
+# On a replica set the ledger rows and the $inc share a transaction. A standalone
+# server has none, so a crash between the two writes (and deferred or expense
+# adjustments, which are always their own write) can leave drift: there balances are
+# eventually consistent, and the closing worker reconciles them once a day.
+TREASURY_ACCOUNTS = ['cash', 'vodafone_elsawy', 'vodafone_wael', 'deferred', 'instapay', 'yad_elsawy']
+TRANSACTION_TYPE_SIGNS = {'income': 1, 'transfer_in': 1, 'expense': -1, 'transfer_out': -1}
+SIGNED_AMOUNT = {"$switch": {
+    "branches": [
+        {"case": {"$in": ["$transaction_type", ["income", "transfer_in"]]}, "then": "$amount"},
+        {"case": {"$in": ["$transaction_type", ["expense", "transfer_out"]]}, "then": {"$multiply": ["$amount", -1]}}
+    ],
+    "default": 0
+}}
+
+def treasury_balance_key(company_id: Optional[str], account_id: str) -> str:
+    return f"{company_id or 'default'}:{account_id}"
+
+async def adjust_treasury_balances(deltas: List[tuple], session=None) -> None:
+    """Apply (company_id, account_id, amount) deltas to the materialized balances"""
+    totals: Dict[str, Dict[str, Any]] = {}
+    for company_id, account_id, amount in deltas:
+        if not amount:
+            continue
+        key = treasury_balance_key(company_id, account_id)
+        entry = totals.setdefault(key, {"company_id": company_id, "account_id": account_id, "amount": 0})
+        entry["amount"] += amount
+    if not totals:
+        return
+    
+    now = datetime.utcnow()
+    await db.treasury_balances.bulk_write([
+        UpdateOne(
+            {"_id": key},
+            {
+                "$inc": {"balance": entry["amount"]},
+                "$set": {"company_id": entry["company_id"], "account_id": entry["account_id"], "updated_at": now}
+            },
+            upsert=True
+        )
+        for key, entry in totals.items()
+    ], ordered=False, session=session)
+
+def treasury_transaction_delta(transaction: Dict[str, Any]) -> tuple:
+    sign = TRANSACTION_TYPE_SIGNS.get(transaction.get("transaction_type"), 0)
+    return (transaction.get("company_id"), transaction.get("account_id"), sign * transaction.get("amount", 0))
+
+_transactions_supported: Optional[bool] = None
+
+async def supports_transactions() -> bool:
+    """Multi-document transactions need a replica set (or mongos); checked once"""
+    global _transactions_supported
+    if _transactions_supported is None:
+        try:
+            hello = await client.admin.command("hello")
+            _transactions_supported = bool(hello.get("setName")) or hello.get("msg") == "isdbgrid"
+        except Exception:
+            _transactions_supported = False
+    return _transactions_supported
+
+async def post_treasury_transactions(
+    transactions: List[TreasuryTransaction],
+    balanced: bool = False,
+    balance_deltas: Optional[List[tuple]] = None
+) -> None:
+    """Write a batch of treasury legs with one insert_many and update the account balances.
+    
+    balance_deltas are (company_id, account_id, amount) changes without a ledger row,
+    such as the deferred account, applied together with the legs. With balanced=True
+    the legs and those deltas must net to zero (transfers, payment method moves).
+    On a replica set the ledger rows and balances are written in one transaction,
+    so a batch is never applied halfway.
+    """
+    if not transactions and not balance_deltas:
+        return
+    documents = [transaction.dict() for transaction in transactions]
+    deltas = [treasury_transaction_delta(document) for document in documents] + list(balance_deltas or [])
+    if balanced and abs(sum(amount for _, _, amount in deltas)) > 0.005:
+        raise HTTPException(status_code=400, detail="قيود الخزينة غير متوازنة")
+    
+    if not await supports_transactions():
+        try:
+            if documents:
+                await db.treasury_transactions.insert_many(documents)
+        except BulkWriteError as e:
+            # Keep balances in step with the legs written before the duplicate
+            await adjust_treasury_balances(deltas[:e.details.get("nInserted", 0)])
+            if all(error.get("code") == 11000 for error in e.details.get("writeErrors", [])):
+                raise DuplicateKeyError(e.details["writeErrors"][0].get("errmsg", "duplicate reference"))
+            raise
+        await adjust_treasury_balances(deltas)
+        await invalidate_cashflow_cache([document["date"] for document in documents])
+        return
+    
+    async def write_batch(session):
+        if documents:
+            await db.treasury_transactions.insert_many(documents, session=session)
+        await adjust_treasury_balances(deltas, session=session)
+    
+    async with await client.start_session() as session:
+        try:
+            await session.with_transaction(write_batch)
+        except BulkWriteError as e:
+            if all(error.get("code") == 11000 for error in e.details.get("writeErrors", [])):
+                raise DuplicateKeyError(e.details["writeErrors"][0].get("errmsg", "duplicate reference"))
+            raise
+    await invalidate_cashflow_cache([document["date"] for document in documents])
+
+def deferred_invoice_deltas(invoice: Dict[str, Any], sign: int) -> List[tuple]:
+    """Deferred invoices count towards the deferred account without a ledger entry"""
+    if invoice.get("payment_method") == "آجل":
+        return [(invoice.get("company_id"), "deferred", sign * invoice.get("total_amount", 0))]
+    return []
+
+async def adjust_deferred_invoice_balance(invoice: Dict[str, Any], sign: int, session=None) -> None:
+    await adjust_treasury_balances(deferred_invoice_deltas(invoice, sign), session=session)
+
+def _add_balance(totals: Dict[str, Dict[str, Any]], company_id: Optional[str], account_id: str, amount: float) -> None:
+    key = treasury_balance_key(company_id, account_id)
+    entry = totals.setdefault(key, {"company_id": company_id, "account_id": account_id, "balance": 0})
+    entry["balance"] += amount
+
+def to_naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Stored dates are naive UTC; convert a query date sent with Z or an offset to match"""
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+def _date_range(since: Optional[datetime], until: Optional[datetime], inclusive: bool) -> Dict[str, datetime]:
+    date_filter = {}
+    if since:
+        date_filter["$gte"] = since
+    if until:
+        date_filter["$lte" if inclusive else "$lt"] = until
+    return date_filter
+
+async def find_latest_treasury_snapshot(until: Optional[datetime] = None) -> Optional[Dict[str, Any]]:
+    """Latest snapshot taken at or before `until` (or the latest overall)"""
+    query = {"closed_at": {"$lte": until}} if until else {}
+    snapshots = await db.treasury_snapshots.find(query, {"_id": 0}).sort([("closed_at", -1), ("created_at", -1)]).limit(1).to_list(1)
+    return snapshots[0] if snapshots else None
+
+async def compute_ledger_balances(
+    until: Optional[datetime] = None,
+    inclusive: bool = True,
+    company_id: Optional[str] = None,
+    include_archive: bool = False,
+    account_id: Optional[str] = None
+) -> Dict[str, Dict[str, Any]]:
+    """Ledger part of every (company, account) balance: the latest snapshot plus the postings after it.
+    
+    Postings made after the snapshot but dated inside its period are counted too.
+    Archived postings are only needed for dates before the latest reset.
+    """
+    totals: Dict[str, Dict[str, Any]] = {}
+    snapshot = await find_latest_treasury_snapshot(until)
+    if snapshot:
+        for entry in snapshot["ledger_balances"]:
+            if (not company_id or entry.get("company_id") == company_id) and (not account_id or entry["account_id"] == account_id):
+                _add_balance(totals, entry.get("company_id"), entry["account_id"], entry["balance"])
+    
+    match: Dict[str, Any] = {"company_id": company_id} if company_id else {}
+    if account_id:
+        match["account_id"] = account_id
+    date_filter = _date_range(None, until, inclusive)
+    if date_filter:
+        match["date"] = date_filter
+    if snapshot:
+        match["$or"] = [
+            {"date": {"$gte": snapshot["closed_at"]}},
+            {"created_at": {"$gt": snapshot["created_at"]}}
+        ]
+    
+    collections = [db.treasury_transactions] + ([db.treasury_transactions_archive] if include_archive else [])
+    for collection in collections:
+        async for row in collection.aggregate([
+            {"$match": match},
+            {"$group": {"_id": {"company_id": "$company_id", "account_id": "$account_id"}, "balance": {"$sum": SIGNED_AMOUNT}}}
+        ]):
+            _add_balance(totals, row["_id"].get("company_id"), row["_id"].get("account_id"), row["balance"])
+    
+    return totals
+
+async def add_invoice_and_expense_balances(
+    totals: Dict[str, Dict[str, Any]],
+    until: Optional[datetime] = None,
+    inclusive: bool = True,
+    company_id: Optional[str] = None
+) -> Dict[str, Dict[str, Any]]:
+    """Add deferred invoices and expenses, counted by their date with their current amounts"""
+    match: Dict[str, Any] = {"company_id": company_id} if company_id else {}
+    date_filter = _date_range(None, until, inclusive)
+    if date_filter:
+        match["date"] = date_filter
+    
+    async for row in db.invoices.aggregate([
+        {"$match": {**match, "payment_method": "آجل"}},
+        {"$group": {"_id": "$company_id", "total": {"$sum": "$total_amount"}}}
+    ]):
+        _add_balance(totals, row["_id"], "deferred", row["total"])
+    
+    async for row in db.expenses.aggregate([
+        {"$match": match},
+        {"$group": {"_id": "$company_id", "total": {"$sum": "$amount"}}}
+    ]):
+        _add_balance(totals, row["_id"], "cash", -row["total"])
+    
+    return totals
+
+async def compute_treasury_balances(
+    until: Optional[datetime] = None,
+    inclusive: bool = True,
+    company_id: Optional[str] = None,
+    include_archive: bool = False
+) -> Dict[str, Dict[str, Any]]:
+    """Rebuild every (company, account) balance from the ledger, deferred invoices and expenses"""
+    totals = await compute_ledger_balances(until, inclusive, company_id, include_archive)
+    return await add_invoice_and_expense_balances(totals, until, inclusive, company_id)
+
+async def reconcile_treasury_balances(apply: bool = True) -> List[Dict[str, Any]]:
+    """Compare stored balances with the ledger, optionally overwriting them. Returns the drift."""
+    expected = await compute_treasury_balances()
+    stored = {doc["_id"]: doc for doc in await db.treasury_balances.find().to_list(None)}
+    
+    drift = []
+    for key in set(expected) | set(stored):
+        expected_entry = expected.get(key) or {**stored[key], "balance": 0}
+        stored_balance = stored.get(key, {}).get("balance", 0)
+        if abs(expected_entry["balance"] - stored_balance) > 0.005:
+            drift.append({
+                "company_id": expected_entry.get("company_id"),
+                "account_id": expected_entry.get("account_id"),
+                "stored_balance": stored_balance,
+                "ledger_balance": expected_entry["balance"],
+                "drift": stored_balance - expected_entry["balance"]
+            })
+    
+    if apply and drift:
+        # Only overwrite balances no posting has moved since they were read; the next run fixes the rest
+        now = datetime.utcnow()
+        operations = []
+        for entry in drift:
+            key = treasury_balance_key(entry["company_id"], entry["account_id"])
+            operations.append(UpdateOne(
+                {"_id": key, "balance": stored[key].get("balance", 0)} if key in stored else {"_id": key},
+                {"$set": {
+                    "company_id": entry["company_id"],
+                    "account_id": entry["account_id"],
+                    "balance": entry["ledger_balance"],
+                    "updated_at": now
+                }},
+                upsert=key not in stored
+            ))
+        await db.treasury_balances.bulk_write(operations, ordered=False)
+    
+    return drift
+
+async def compute_account_balances_as_of(as_of: datetime, company_id: Optional[str] = None) -> Dict[str, float]:
+    """Account balances at the moment `as_of`, from the nearest snapshot plus the postings after it"""
+    account_balances = {account_id: 0 for account_id in TREASURY_ACCOUNTS}
+    totals = await compute_treasury_balances(as_of, company_id=company_id, include_archive=True)
+    for entry in totals.values():
+        if entry["account_id"] in account_balances:
+            account_balances[entry["account_id"]] += entry["balance"]
+    return account_balances
+
+# Treasury snapshots
+# A closing snapshot freezes every (company, account) balance for postings dated
+# before closed_at, so balance queries never replay the ledger from the start.
+# A reset writes an opening snapshot with an empty ledger and archives the old
+# postings instead of deleting them.
+TREASURY_ARCHIVE_BATCH_SIZE = 1000
+TREASURY_CLOSING_RETRY_SECONDS = 300
+
+def _snapshot_entries(totals: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [
+        {"company_id": entry["company_id"], "account_id": entry["account_id"], "balance": entry["balance"]}
+        for entry in totals.values()
+    ]
+
+async def create_treasury_snapshot(closed_at: datetime, snapshot_type: str = "closing", created_by: Optional[str] = None) -> Dict[str, Any]:
+    """Store the balances of all postings dated before closed_at"""
+    latest = await find_latest_treasury_snapshot()
+    if latest and latest["closed_at"] > closed_at:
+        raise HTTPException(status_code=400, detail="لا يمكن إنشاء إقفال قبل آخر إقفال مسجل")
+    
+    # An opening snapshot restarts the ledger from zero; deferred invoices and expenses carry over
+    ledger_balances = {} if snapshot_type == "opening" else await compute_ledger_balances(closed_at, inclusive=False)
+    balances = await add_invoice_and_expense_balances(
+        {key: dict(entry) for key, entry in ledger_balances.items()}, closed_at, inclusive=False
+    )
+    
+    snapshot = TreasurySnapshot(
+        snapshot_type=snapshot_type,
+        closed_at=closed_at,
+        ledger_balances=_snapshot_entries(ledger_balances),
+        balances=_snapshot_entries(balances),
+        created_by=created_by
+    )
+    try:
+        await db.treasury_snapshots.insert_one(snapshot.dict())
+    except DuplicateKeyError:
+        # Another worker already closed this day
+        return await db.treasury_snapshots.find_one({"snapshot_type": snapshot_type, "closed_at": closed_at}, {"_id": 0})
+    return snapshot.dict()
+
+async def archive_treasury_transactions(before: datetime, reset_id: str) -> int:
+    """Move postings dated before `before` to the archive in batches; safe to re-run"""
+    archived = 0
+    while True:
+        batch = await db.treasury_transactions.find({"date": {"$lt": before}}).limit(TREASURY_ARCHIVE_BATCH_SIZE).to_list(TREASURY_ARCHIVE_BATCH_SIZE)
+        if not batch:
+            return archived
+        for transaction in batch:
+            transaction["archived_by_snapshot"] = reset_id
+        try:
+            await db.treasury_transactions_archive.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # Rows copied by an interrupted earlier run are already in the archive
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+        result = await db.treasury_transactions.delete_many({"_id": {"$in": [transaction["_id"] for transaction in batch]}})
+        archived += result.deleted_count
+        await invalidate_cashflow_cache()
+
+async def run_treasury_closing_worker():
+    """Write a closing snapshot at every UTC midnight, catching up on start.
+    
+    Without transactions the stored balances are reconciled with the ledger on each run.
+    """
+    while True:
+        try:
+            today = datetime.combine(datetime.utcnow().date(), datetime.min.time())
+            latest = await find_latest_treasury_snapshot()
+            if not latest or latest["closed_at"] < today:
+                await create_treasury_snapshot(today, "closing", created_by="system")
+            
+            if not await supports_transactions():
+                drift = await reconcile_treasury_balances()
+                if drift:
+                    logger.warning(f"Treasury balances reconciled with the ledger: {drift}")
+            
+            await asyncio.sleep((today + timedelta(days=1) - datetime.utcnow()).total_seconds() + 1)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Treasury closing worker error: {str(e)}")
+            await asyncio.sleep(TREASURY_CLOSING_RETRY_SECONDS)
+
+# Treasury cash flow
+# Ledger postings summed per account into day, week or month buckets. A range that
+# ends before the latest closing only changes through backdated postings, so its
+# result is kept in a small in-process LRU. The cache key includes a version counter
+# in MongoDB that backdated postings bump, so every worker drops its stale ranges.
+CASHFLOW_CACHE_SIZE = 256
+CASHFLOW_WEEK_START = "saturday"
+CASHFLOW_VERSION_KEY = "cashflow_version"
+
+_cashflow_cache: "OrderedDict[tuple, List[Dict[str, Any]]]" = OrderedDict()
+
+async def invalidate_cashflow_cache(dates: Optional[List[datetime]] = None) -> None:
+    """Bump the cash flow version when postings dated before the latest closing change (or always without `dates`)"""
+    if dates is not None:
+        latest_closing = await db.treasury_snapshots.find_one(
+            {"snapshot_type": "closing"}, {"_id": 0, "closed_at": 1}, sort=[("closed_at", -1)]
+        )
+        if not latest_closing or all(to_naive_utc(date) >= latest_closing["closed_at"] for date in dates):
+            return
+    await db.counters.update_one(
+        {"_id": CASHFLOW_VERSION_KEY},
+        {"$inc": {"seq": 1}, "$setOnInsert": {"sequence_type": "cashflow"}},
+        upsert=True
+    )
+
+def _type_total(transaction_type: str) -> Dict[str, Any]:
+    return {"$sum": {"$cond": [{"$eq": ["$transaction_type", transaction_type]}, "$amount", 0]}}
+
+async def compute_cashflow(
+    granularity: str,
+    date_from: Optional[datetime],
+    date_to: Optional[datetime],
+    company_id: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    """Income, expense and transfer totals per (bucket, account), oldest bucket first"""
+    match: Dict[str, Any] = {"company_id": company_id} if company_id else {}
+    date_filter = _date_range(date_from, date_to, inclusive=True)
+    if date_filter:
+        match["date"] = date_filter
+    
+    bucket: Dict[str, Any] = {"date": "$date", "unit": granularity}
+    if granularity == "week":
+        bucket["startOfWeek"] = CASHFLOW_WEEK_START
+    
+    return await db.treasury_transactions.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": {"period": {"$dateTrunc": bucket}, "account_id": "$account_id"},
+            "income": _type_total("income"),
+            "expense": _type_total("expense"),
+            "transfer_in": _type_total("transfer_in"),
+            "transfer_out": _type_total("transfer_out"),
+            "count": {"$sum": 1}
+        }},
+        {"$sort": {"_id.period": 1, "_id.account_id": 1}},
+        {"$project": {
+            "_id": 0,
+            "period": "$_id.period",
+            "account_id": "$_id.account_id",
+            "income": 1,
+            "expense": 1,
+            "transfer_in": 1,
+            "transfer_out": 1,
+            "net": {"$subtract": [{"$add": ["$income", "$transfer_in"]}, {"$add": ["$expense", "$transfer_out"]}]},
+            "count": 1
+        }}
+    ]).to_list(None)
+
+async def get_cashflow(
+    granularity: str,
+    date_from: Optional[datetime],
+    date_to: Optional[datetime],
+    company_id: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    """Cash flow rows, served from the cache when the whole range is closed"""
+    latest_closing = await db.treasury_snapshots.find_one(
+        {"snapshot_type": "closing"}, {"_id": 0, "closed_at": 1}, sort=[("closed_at", -1)]
+    )
+    if not date_to or not latest_closing or date_to >= latest_closing["closed_at"]:
+        return await compute_cashflow(granularity, date_from, date_to, company_id)
+    
+    version = await db.counters.find_one({"_id": CASHFLOW_VERSION_KEY}, {"_id": 0, "seq": 1})
+    key = ((version or {}).get("seq", 0), company_id, granularity, date_from, date_to)
+    if key in _cashflow_cache:
+        _cashflow_cache.move_to_end(key)
+        return _cashflow_cache[key]
+    
+    rows = await compute_cashflow(granularity, date_from, date_to, company_id)
+    _cashflow_cache[key] = rows
+    if len(_cashflow_cache) > CASHFLOW_CACHE_SIZE:
+        _cashflow_cache.popitem(last=False)
+    return rows
+
+# Treasury duplicate detection
+# System postings (invoice income, payments, supplier payments) carry
+# unique_reference=True and a unique partial index on reference stops them from
+# being posted twice. The scan job below looks for duplicates the index cannot
+# prevent: legacy rows and repeated postings with the same account, type, amount
+# and description. It only reads transactions inserted since its checkpoint.
+DUPLICATE_SCAN_BATCH_SIZE = 500
+DUPLICATE_SCAN_INTERVAL_SECONDS = int(os.environ.get("DUPLICATE_SCAN_INTERVAL_SECONDS", 600))
+DUPLICATE_SCAN_LOOKBACK_SECONDS = 60  # ObjectIds from different servers are only roughly ordered
+SYSTEM_REFERENCE_PREFIXES = ("invoice_", "payment_", "supplier_payment_")
+
+def _duplicate_finding_id(rule: str, key: Dict[str, Any]) -> str:
+    return hashlib.sha1(json.dumps([rule, key], sort_keys=True, ensure_ascii=False, default=str).encode()).hexdigest()
+
+async def record_duplicate_findings(rule: str, groups: List[Dict[str, Any]]) -> int:
+    """Upsert one report entry per duplicate group"""
+    if not groups:
+        return 0
+    now = datetime.utcnow()
+    await db.treasury_duplicates.bulk_write([
+        UpdateOne(
+            {"_id": _duplicate_finding_id(rule, group["_id"])},
+            {
+                "$set": {
+                    "rule": rule,
+                    "key": group["_id"],
+                    "transaction_ids": group["transaction_ids"],
+                    "count": group["count"],
+                    "total_amount": group["total_amount"],
+                    "last_detected_at": now
+                },
+                "$setOnInsert": {"status": "open", "first_detected_at": now}
+            },
+            upsert=True
+        )
+        for group in groups
+    ], ordered=False)
+    return len(groups)
+
+async def find_duplicates_for_batch(batch: List[Dict[str, Any]]) -> int:
+    """Check the transactions of one scan batch against the whole ledger"""
+    group_fields = {
+        "transaction_ids": {"$push": "$id"},
+        "count": {"$sum": 1},
+        "total_amount": {"$sum": "$amount"}
+    }
+    findings = 0
+    
+    references = list({
+        transaction["reference"] for transaction in batch
+        if (transaction.get("reference") or "").startswith(SYSTEM_REFERENCE_PREFIXES)
+    })
+    if references:
+        groups = await db.treasury_transactions.aggregate([
+            {"$match": {"reference": {"$in": references}}},
+            {"$group": {"_id": {"reference": "$reference"}, **group_fields}},
+            {"$match": {"count": {"$gt": 1}}}
+        ]).to_list(None)
+        findings += await record_duplicate_findings("reference", groups)
+    
+    batch_keys = {
+        (t.get("account_id"), t.get("transaction_type"), t.get("amount"), t.get("description"))
+        for t in batch if t.get("amount")
+    }
+    if batch_keys:
+        groups = await db.treasury_transactions.aggregate([
+            {"$match": {
+                "amount": {"$in": list({key[2] for key in batch_keys})},
+                "description": {"$in": list({key[3] for key in batch_keys})}
+            }},
+            {"$group": {
+                "_id": {
+                    "account_id": "$account_id",
+                    "transaction_type": "$transaction_type",
+                    "amount": "$amount",
+                    "description": "$description"
+                },
+                **group_fields
+            }},
+            {"$match": {"count": {"$gt": 1}}}
+        ]).to_list(None)
+        groups = [
+            group for group in groups
+            if (group["_id"].get("account_id"), group["_id"].get("transaction_type"), group["_id"].get("amount"), group["_id"].get("description")) in batch_keys
+        ]
+        findings += await record_duplicate_findings("amount_description", groups)
+    
+    return findings
+
+async def scan_treasury_duplicates() -> Dict[str, Any]:
+    """Scan transactions inserted since the last checkpoint for duplicates"""
+    checkpoint = await db.job_checkpoints.find_one({"_id": "treasury_duplicate_scan"})
+    query = {}
+    if checkpoint:
+        since = checkpoint["last_scanned_at"] - timedelta(seconds=DUPLICATE_SCAN_LOOKBACK_SECONDS)
+        query = {"_id": {"$gt": ObjectId.from_datetime(since)}}
+    
+    scanned = 0
+    findings = 0
+    last_id = None
+    while True:
+        batch_query = {"_id": {"$gt": last_id}} if last_id else query
+        batch = await db.treasury_transactions.find(batch_query).sort("_id", 1).limit(DUPLICATE_SCAN_BATCH_SIZE).to_list(DUPLICATE_SCAN_BATCH_SIZE)
+        if not batch:
+            break
+        findings += await find_duplicates_for_batch(batch)
+        scanned += len(batch)
+        last_id = batch[-1]["_id"]
+        await db.job_checkpoints.update_one(
+            {"_id": "treasury_duplicate_scan"},
+            {"$set": {"last_scanned_at": last_id.generation_time.replace(tzinfo=None), "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+    
+    return {"scanned": scanned, "duplicate_groups": findings}
+
+async def run_duplicate_scan_worker():
+    """Background loop running the incremental duplicate scan"""
+    while True:
+        try:
+            result = await scan_treasury_duplicates()
+            if result["duplicate_groups"]:
+                logger.warning(f"Duplicate scan found {result['duplicate_groups']} duplicate groups in {result['scanned']} new transactions")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Duplicate scan error: {str(e)}")
+        await asyncio.sleep(DUPLICATE_SCAN_INTERVAL_SECONDS)
+
+# Daily rollups
+# daily_rollups keeps one document per (company, UTC day) with that day's sales,
+# discounts, cost of goods, outstanding deferred amount, collections and expenses by category.
+# Every invoice, payment and expense write applies its $inc right after the source
+# write, so period reports read one document per day instead of raw invoices;
+# rebuild_daily_rollups recomputes them from the source collections.
+ROLLUP_PERIODS = ("daily", "weekly", "monthly", "yearly")
+
+def rollup_day(value: Any = None) -> datetime:
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=None)
+    value = value or datetime.utcnow()
+    return datetime(value.year, value.month, value.day)
+
+def rollup_period_start(day: datetime, period: str) -> datetime:
+    if period == "weekly":
+        return day - timedelta(days=(day.weekday() - 5) % 7)  # weeks start on Saturday
+    if period == "monthly":
+        return day.replace(day=1)
+    if period == "yearly":
+        return day.replace(month=1, day=1)
+    return day
+
+def invoice_rolled_up_cost(invoice: Dict[str, Any]) -> float:
+    """The part of an invoice's cost_of_goods that daily_rollups already holds"""
+    rolled_up = invoice.get("cost_rolled_up")
+    if rolled_up is None:
+        # Invoices from before the marker was recorded
+        rolled_up = invoice.get("cost_of_goods")
+    return rolled_up or 0
+
+def invoice_rollup_delta(invoice: Dict[str, Any], sign: int) -> tuple:
+    return (invoice.get("company_id"), invoice.get("date"), {
+        "sales": sign * (invoice.get("total_amount") or 0),
+        "discounts": sign * (invoice.get("discount") or 0),
+        "deferred": sign * (invoice.get("remaining_amount") or 0),
+        "cost_of_goods": sign * invoice_rolled_up_cost(invoice),
+        "invoice_count": sign
+    })
+
+def expense_rollup_delta(expense: Dict[str, Any], sign: int) -> tuple:
+    category = getattr(expense.get("category"), "value", expense.get("category")) or ExpenseCategory.OTHER.value
+    amount = sign * (expense.get("amount") or 0)
+    return (expense.get("company_id"), expense.get("date"), {
+        "expenses": amount,
+        f"expenses_by_category.{category}": amount
+    })
+
+def _rollup_entries(deltas: List[tuple]) -> Dict[str, Dict[str, Any]]:
+    entries: Dict[str, Dict[str, Any]] = {}
+    for company_id, date, fields in deltas:
+        day = rollup_day(date)
+        key = f"{company_id or 'default'}:{day.date().isoformat()}"
+        entry = entries.setdefault(key, {"company_id": company_id, "date": day, "fields": {}})
+        for field, amount in fields.items():
+            entry["fields"][field] = entry["fields"].get(field, 0) + amount
+    return entries
+
+async def adjust_daily_rollups(deltas: List[tuple], session=None) -> None:
+    """Apply (company_id, date, {field: amount}) deltas with one $inc upsert per day"""
+    entries = _rollup_entries(deltas)
+    if not entries:
+        return
+    await db.daily_rollups.bulk_write([
+        UpdateOne(
+            {"_id": key},
+            {"$inc": entry["fields"], "$setOnInsert": {"company_id": entry["company_id"], "date": entry["date"]}},
+            upsert=True
+        )
+        for key, entry in entries.items()
+    ], ordered=False, session=session)
+
+async def rebuild_daily_rollups() -> int:
+    """Recompute every rollup from invoices, payments and expenses. Returns the number of days."""
+    day_id = {"company_id": "$company_id", "year": {"$year": "$date"}, "month": {"$month": "$date"}, "day": {"$dayOfMonth": "$date"}}
+    deltas = []
+    async for row in db.invoices.aggregate([
+        {"$group": {
+            "_id": day_id,
+            "sales": {"$sum": "$total_amount"},
+            "discounts": {"$sum": {"$ifNull": ["$discount", 0]}},
+            "deferred": {"$sum": "$remaining_amount"},
+            "cost_of_goods": {"$sum": {"$ifNull": ["$cost_of_goods", 0]}},
+            "invoice_count": {"$sum": 1}
+        }}
+    ]):
+        key = row.pop("_id")
+        deltas.append((key.get("company_id"), datetime(key["year"], key["month"], key["day"]), row))
+    
+    async for row in db.expenses.aggregate([
+        {"$group": {"_id": {**day_id, "category": "$category"}, "amount": {"$sum": "$amount"}}}
+    ]):
+        key = row["_id"]
+        deltas.append(expense_rollup_delta({
+            "company_id": key.get("company_id"),
+            "date": datetime(key["year"], key["month"], key["day"]),
+            "category": key.get("category"),
+            "amount": row["amount"]
+        }, 1))
+    
+    # Collections are dated by the payment; their company is the invoice's
+    async for row in db.payments.aggregate([
+        {"$lookup": {"from": "invoices", "localField": "invoice_id", "foreignField": "id", "as": "invoice"}},
+        {"$project": {"_id": 0, "amount": 1, "date": 1, "company_id": {"$arrayElemAt": ["$invoice.company_id", 0]}}},
+        {"$group": {"_id": day_id, "collections": {"$sum": "$amount"}}}
+    ]):
+        key = row.pop("_id")
+        deltas.append((key.get("company_id"), datetime(key["year"], key["month"], key["day"]), row))
+    
+    entries = _rollup_entries(deltas)
+    documents = []
+    for key, entry in entries.items():
+        document = {"_id": key, "company_id": entry["company_id"], "date": entry["date"], "expenses_by_category": {}}
+        for field, amount in entry["fields"].items():
+            if field.startswith("expenses_by_category."):
+                document["expenses_by_category"][field.split(".", 1)[1]] = amount
+            else:
+                document[field] = amount
+        documents.append(document)
+    
+    if documents:
+        await db.daily_rollups.bulk_write([
+            ReplaceOne({"_id": document["_id"]}, document, upsert=True) for document in documents
+        ], ordered=False)
+    await db.daily_rollups.delete_many({"_id": {"$nin": list(entries)}})
+    return len(documents)
+
+# Invoice side effects
+PAYMENT_METHOD_ACCOUNTS = {
+    "نقدي": "cash",
+    "آجل": "deferred",
+    "فودافون كاش محمد الصاوي": "vodafone_elsawy",
+    "فودافون كاش وائل محمد": "vodafone_wael",
+    "انستاباي": "instapay",
+    "يد الصاوي": "yad_elsawy"
+}
+
+async def record_local_product_sales(invoice: Dict[str, Any], completed_steps: set, mark_step) -> None:
+    """Update local product stock and supplier balances for an invoice's local items"""
+    for item_index, item in enumerate(invoice.get("items", [])):
+        step = f"local-item-{item_index}"
+        if item.get("product_type") != "local" or not item.get("local_product_details") or step in completed_steps:
+            continue
+        
+        details = item["local_product_details"]
+        
+        # Update local product stock
+        await db.local_products.update_one(
+            {"name": details.get("name"), "supplier": details.get("supplier")},
+            {"$inc": {"total_sold": item.get("quantity", 0)}}
+        )
+        
+        # Find supplier by name to record the purchase cost
+        supplier = await db.suppliers.find_one({"name": details.get("supplier", "")})
+        if supplier:
+            purchase_amount = details.get("purchase_price", 0) * item.get("quantity", 0)
+            supplier_transaction = SupplierTransaction(
+                supplier_id=supplier["id"],
+                supplier_name=details.get("supplier", ""),
+                transaction_type="purchase",
+                amount=purchase_amount,
+                description=f"شراء {details.get('name')} من فاتورة {invoice.get('invoice_number')}",
+                product_name=details.get("name", ""),
+                quantity=item.get("quantity", 0),
+                unit_price=details.get("purchase_price", 0),
+                reference_invoice_id=invoice["id"]
+            )
+            await db.supplier_transactions.insert_one(supplier_transaction.dict())
+            
+            # Update supplier balance
+            await db.suppliers.update_one(
+                {"id": supplier["id"]},
+                {"$inc": {"total_purchases": purchase_amount, "balance": purchase_amount}}
+            )
+        
+        await mark_step(step)
+
+def local_item_cost(item: Dict[str, Any]) -> float:
+    """Purchase price of a local item times its quantity"""
+    purchase_price = item.get("purchase_price")
+    if purchase_price is None:
+        purchase_price = (item.get("local_product_details") or {}).get("purchase_price", 0)
+    return (purchase_price or 0) * item.get("quantity", 0)
+
+async def record_material_costs(invoices: List[Dict[str, Any]], results: List[Dict[str, Any]]) -> None:
+    """Cost manufactured items by the mm actually deducted times each material's cost_per_mm.
+    
+    The invoice's cost_of_goods and gross_profit are recomputed from all item costs,
+    so running this again for the same deductions changes nothing. The rollup is moved
+    by the difference to the invoice's cost_rolled_up marker, and only by the run whose
+    guarded update advanced the marker, so retries and concurrent runs never count a
+    cost twice. A crash between the two writes leaves the rollup short until
+    rebuild_daily_rollups.
+    """
+    item_costs: Dict[str, Dict[int, float]] = {}
+    for item_result in results:
+        item_costs.setdefault(item_result["invoice_id"], {})[item_result["item_index"]] = sum(
+            deduction["consumption"] * (deduction.get("cost_per_mm") or 0)
+            for deduction in item_result["deductions"] if deduction["status"] == "applied"
+        )
+    
+    operations = []
+    markers = []
+    for invoice in invoices:
+        costs = item_costs.get(invoice["id"])
+        if costs is None:
+            continue
+        cost_of_goods = sum(
+            costs.get(index, item.get("cost") or 0) for index, item in enumerate(invoice.get("items", []))
+        )
+        update = {f"items.{index}.cost": cost for index, cost in costs.items()}
+        update["cost_of_goods"] = cost_of_goods
+        update["gross_profit"] = invoice.get("total_amount", 0) - cost_of_goods
+        operations.append(UpdateOne({"id": invoice["id"]}, {"$set": update}))
+        
+        rolled_up = invoice_rolled_up_cost(invoice)
+        if cost_of_goods != rolled_up:
+            markers.append((invoice, cost_of_goods, cost_of_goods - rolled_up))
+    
+    if operations:
+        await db.invoices.bulk_write(operations, ordered=False)
+    if markers:
+        results = await asyncio.gather(*(
+            db.invoices.update_one(
+                {"id": invoice["id"], "cost_rolled_up": invoice.get("cost_rolled_up")},
+                {"$set": {"cost_rolled_up": cost_of_goods}}
+            )
+            for invoice, cost_of_goods, _ in markers
+        ))
+        await adjust_daily_rollups([
+            (invoice.get("company_id"), invoice.get("date"), {"cost_of_goods": delta})
+            for (invoice, _, delta), result in zip(markers, results) if result.modified_count
+        ])
+
+def build_invoice_income_transaction(invoice: Dict[str, Any]) -> TreasuryTransaction:
+    """Treasury income transaction for a non-deferred invoice"""
+    return TreasuryTransaction(
+        company_id=invoice.get("company_id"),
+        account_id=PAYMENT_METHOD_ACCOUNTS.get(invoice.get("payment_method"), "cash"),
+        transaction_type="income",
+        amount=invoice.get("total_amount", 0),
+        description=f"فاتورة {invoice.get('invoice_number')} - {invoice.get('customer_name')}",
+        reference=f"invoice_{invoice['id']}",
+        unique_reference=True
+    )
+
+async def post_invoice_income(invoice: Dict[str, Any]) -> None:
+    """Add the treasury income transaction for a non-deferred invoice"""
+    if invoice.get("payment_method") == "آجل":
+        return
+    
+    treasury_transaction = build_invoice_income_transaction(invoice)
+    
+    # Check if treasury transaction already exists for this invoice
+    existing_transaction = await db.treasury_transactions.find_one({"reference": treasury_transaction.reference})
+    if existing_transaction:
+        return
+    
+    try:
+        await post_treasury_transactions([treasury_transaction])
+    except DuplicateKeyError:
+        # Posted concurrently by another worker
+        return
+
+# Invoice outbox
+# create_invoice only writes the invoice and its pending side-effect tasks; the outbox
+# worker applies them in the background, retrying failed tasks with backoff.
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '8'))
+OUTBOX_LEASE_SECONDS = 60  # a claimed task becomes available again if its worker dies
+OUTBOX_POLL_SECONDS = 5
+OUTBOX_MAX_BACKOFF_SECONDS = 300
+OUTBOX_CANCEL_WAIT_SECONDS = 5  # how long cancel_invoice waits for a running task
+
+_outbox_wakeup = asyncio.Event()
+
+def build_invoice_outbox_tasks(invoice: Invoice, supervisor_name: str = "") -> List[OutboxTask]:
+    """Side-effect tasks recorded together with a new invoice"""
+    items = invoice.items
+    tasks = []
+    
+    if any(item.product_type != "local" for item in items):
+        tasks.append(OutboxTask(task_type="deduct_materials", invoice_id=invoice.id))
+    if any(item.product_type == "local" and item.local_product_details for item in items):
+        tasks.append(OutboxTask(task_type="record_local_sales", invoice_id=invoice.id))
+    if invoice.payment_method != "آجل":
+        tasks.append(OutboxTask(task_type="post_invoice_income", invoice_id=invoice.id))
+    tasks.append(OutboxTask(
+        task_type="add_to_daily_work_order",
+        invoice_id=invoice.id,
+        payload={"supervisor_name": supervisor_name, "work_date": datetime.now().date().isoformat()}
+    ))
+    
+    return tasks
+
+async def run_outbox_task(task: Dict[str, Any]) -> Optional[Any]:
+    """Apply a single outbox task. Every handler is safe to run more than once."""
+    now = datetime.utcnow()
+    invoice = await db.invoices.find_one({"id": task["invoice_id"]}, {"_id": 0})
+    if not invoice:
+        if task.get("created_at") and task["created_at"] < now - timedelta(seconds=OUTBOX_LEASE_SECONDS):
+            # The invoice was deleted, or its insert never landed after the tasks were written
+            await db.outbox.update_one(
+                {"id": task["id"], "status": "processing"},
+                {"$set": {"status": "cancelled", "completed_at": now, "last_error": f"الفاتورة {task['invoice_id']} غير موجودة"}}
+            )
+            return None
+        raise ValueError(f"الفاتورة {task['invoice_id']} غير موجودة")
+    if invoice.get("cancelling_until") and invoice["cancelling_until"] > now:
+        # cancel_invoice is settling the invoice; it cancels this task or hands it back
+        raise ValueError(f"الفاتورة {task['invoice_id']} قيد الإلغاء")
+    
+    task_type = task["task_type"]
+    
+    if task_type == "deduct_materials":
+        plan = task.get("payload", {}).get("plan")
+        if plan is None:
+            # Persist the plan first so a retry replays exactly the same deductions
+            plan = await plan_material_deductions([invoice], token_prefix=task["id"])
+            await db.outbox.update_one({"id": task["id"]}, {"$set": {"payload.plan": plan}})
+        results = await apply_material_deductions(plan)
+        await record_material_costs([invoice], results)
+        return results
+    
+    if task_type == "record_local_sales":
+        async def mark_step(step):
+            await db.outbox.update_one({"id": task["id"]}, {"$addToSet": {"completed_steps": step}})
+        await record_local_product_sales(invoice, set(task.get("completed_steps", [])), mark_step)
+        return None
+    
+    if task_type == "post_invoice_income":
+        await post_invoice_income(invoice)
+        return None
+    
+    if task_type == "add_to_daily_work_order":
+        payload = task.get("payload", {})
+        await append_invoices_to_daily_work_order([invoice], payload.get("supervisor_name", ""), payload.get("work_date"))
+        return None
+    
+    raise ValueError(f"Unknown outbox task type: {task_type}")
+
+async def claim_outbox_task() -> Optional[Dict[str, Any]]:
+    """Atomically lease the next due task so concurrent workers never share one"""
+    now = datetime.utcnow()
+    return await db.outbox.find_one_and_update(
+        {"status": {"$in": ["pending", "processing"]}, "next_attempt_at": {"$lte": now}},
+        {
+            "$set": {"status": "processing", "next_attempt_at": now + timedelta(seconds=OUTBOX_LEASE_SECONDS)},
+            "$inc": {"attempts": 1}
+        },
+        sort=[("next_attempt_at", 1)],
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+async def process_outbox_task(task: Dict[str, Any]) -> None:
+    try:
+        result = await run_outbox_task(task)
+        # Only while still leased: a task cancelled meanwhile stays cancelled
+        await db.outbox.update_one(
+            {"id": task["id"], "status": "processing"},
+            {"$set": {"status": "done", "completed_at": datetime.utcnow(), "result": result, "last_error": None}}
+        )
+    except Exception as e:
+        failed = task.get("attempts", 1) >= OUTBOX_MAX_ATTEMPTS
+        backoff = min(2 ** task.get("attempts", 1), OUTBOX_MAX_BACKOFF_SECONDS)
+        await db.outbox.update_one(
+            {"id": task["id"], "status": "processing"},
+            {"$set": {
+                "status": "failed" if failed else "pending",
+                "next_attempt_at": datetime.utcnow() + timedelta(seconds=backoff),
+                "last_error": str(e)
+            }}
+        )
+        logger.warning(f"Outbox task {task['id']} ({task['task_type']}) failed on attempt {task.get('attempts')}: {str(e)}")
+
+async def wait_for_running_outbox_tasks(invoice_id: str) -> bool:
+    """Wait until no live worker holds a task of the invoice; False if one is still running"""
+    deadline = datetime.utcnow() + timedelta(seconds=OUTBOX_CANCEL_WAIT_SECONDS)
+    while True:
+        running = await db.outbox.count_documents({
+            "invoice_id": invoice_id,
+            "status": "processing",
+            "next_attempt_at": {"$gt": datetime.utcnow()}  # expired leases belong to dead workers
+        })
+        if not running:
+            return True
+        if datetime.utcnow() >= deadline:
+            return False
+        await asyncio.sleep(0.2)
+
+async def run_outbox_worker():
+    """Background loop draining the outbox"""
+    while True:
+        try:
+            task = await claim_outbox_task()
+            if task:
+                await process_outbox_task(task)
+                continue
+            
+            _outbox_wakeup.clear()
+            try:
+                await asyncio.wait_for(_outbox_wakeup.wait(), timeout=OUTBOX_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Outbox worker error: {str(e)}")
+            await asyncio.sleep(OUTBOX_POLL_SECONDS)
+
+@api_router.get("/outbox/status")
+async def get_outbox_status(failed_limit: int = 50):
+    """Report outbox lag and failed side-effect tasks"""
+    try:
+        counts = {"pending": 0, "processing": 0, "done": 0, "failed": 0, "cancelled": 0}
+        async for row in db.outbox.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]):
+            counts[row["_id"]] = row["count"]
+        
+        oldest = await db.outbox.find(
+            {"status": {"$in": ["pending", "processing"]}},
+            {"_id": 0, "id": 1, "task_type": 1, "created_at": 1}
+        ).sort("created_at", 1).limit(1).to_list(1)
+        lag_seconds = (datetime.utcnow() - oldest[0]["created_at"]).total_seconds() if oldest else 0
+        
+        failed_tasks = await db.outbox.find(
+            {"status": "failed"},
+            {"_id": 0, "payload.plan": 0}
+        ).sort("created_at", -1).limit(failed_limit).to_list(failed_limit)
+        
+        return {
+            "counts": counts,
+            "lag_seconds": lag_seconds,
+            "oldest_pending_task": oldest[0] if oldest else None,
+            "failed_tasks": failed_tasks
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/outbox/{task_id}/retry")
+async def retry_outbox_task(task_id: str):
+    """Put a failed outbox task back in the queue"""
+    try:
+        result = await db.outbox.update_one(
+            {"id": task_id, "status": "failed"},
+            {"$set": {"status": "pending", "attempts": 0, "next_attempt_at": datetime.utcnow()}}
+        )
+        if result.matched_count == 0:
+            raise HTTPException(status_code=404, detail="المهمة غير موجودة أو ليست فاشلة")
+        _outbox_wakeup.set()
+        return {"message": "تمت إعادة جدولة المهمة"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+def build_invoice(invoice: InvoiceCreate, invoice_number: str, company_id: Optional[str] = None) -> Invoice:
+    """Build an invoice with its totals from the create request"""
     # Calculate totals with discount
     subtotal = sum(item.total_price for item in invoice.items)
     
@@ -902,8 +3261,14 @@ async def create_invoice(invoice: InvoiceCreate, supervisor_name: str = ""):
     remaining_amount = total_after_discount if str(invoice.payment_method) == "آجل" else 0
     status = InvoiceStatus.PENDING  # Always start with PENDING status
     
+    # Local items cost their purchase price; manufactured items are costed when their material is deducted
     invoice_dict = invoice.dict()
-    invoice_obj = Invoice(
+    for item in invoice_dict["items"]:
+        item["cost"] = local_item_cost(item) if item.get("product_type") == "local" else None
+    cost_of_goods = sum(item["cost"] or 0 for item in invoice_dict["items"])
+    
+    return Invoice(
+        company_id=company_id,
         invoice_number=invoice_number,
         subtotal=subtotal,
         discount=discount_amount,
@@ -911,324 +3276,361 @@ async def create_invoice(invoice: InvoiceCreate, supervisor_name: str = ""):
         total_amount=total_after_discount,  # للتوافق مع الكود الموجود
         remaining_amount=remaining_amount,
         status=status,
+        cost_of_goods=cost_of_goods,
+        gross_profit=total_after_discount - cost_of_goods,
+        cost_rolled_up=cost_of_goods,
+        material_ledger=True,
         **invoice_dict
     )
+
+# Batch invoice creation
+# The batch writes the same per-invoice outbox tasks as create_invoice, but leases
+# them to itself and applies each kind of side effect once for the whole batch.
+# Tasks of a stage that fails are handed back to the outbox worker.
+INVOICE_BATCH_MAX_SIZE = 500
+
+async def release_outbox_tasks(tasks: List[OutboxTask], error: Exception) -> None:
+    """Hand leased batch tasks back to the outbox worker"""
+    await db.outbox.update_many(
+        {"id": {"$in": [task.id for task in tasks]}, "status": "processing"},
+        {"$set": {"status": "pending", "next_attempt_at": datetime.utcnow(), "last_error": str(error)}}
+    )
+    _outbox_wakeup.set()
+
+async def complete_outbox_tasks(tasks: List[OutboxTask], results: Optional[Dict[str, Any]] = None) -> None:
+    """Mark leased batch tasks done, with an optional result per invoice"""
+    if not tasks:
+        return
+    now = datetime.utcnow()
+    await db.outbox.bulk_write([
+        UpdateOne(
+            {"id": task.id, "status": "processing"},
+            {"$set": {"status": "done", "completed_at": now, "result": (results or {}).get(task.invoice_id), "last_error": None}}
+        )
+        for task in tasks
+    ], ordered=False)
+
+async def apply_invoice_batch_side_effects(invoices: List[Dict[str, Any]], tasks: List[OutboxTask], supervisor_name: str) -> Dict[str, List[str]]:
+    """Apply the side effects of a batch stage by stage; returns the task types that failed per invoice"""
+    tasks_by_type: Dict[str, List[OutboxTask]] = {}
+    for task in tasks:
+        tasks_by_type.setdefault(task.task_type, []).append(task)
+    invoices_by_id = {invoice["id"]: invoice for invoice in invoices}
+    pending_effects: Dict[str, List[str]] = {}
     
-    # Update inventory and handle local products
-    for item in invoice.items:
-        if hasattr(item, 'product_type') and item.product_type == 'local':
-            # Handle local product sale
-            if hasattr(item, 'local_product_details') and item.local_product_details:
-                # Update local product stock
-                await db.local_products.update_one(
-                    {"name": item.local_product_details.get("name"), 
-                     "supplier": item.local_product_details.get("supplier")},
-                    {"$inc": {"total_sold": item.quantity}}
-                )
-                
-                # Create supplier transaction for purchase cost
-                supplier_transaction = SupplierTransaction(
-                    supplier_id="", # We'll need to find this based on supplier name
-                    supplier_name=item.local_product_details.get("supplier", ""),
-                    transaction_type="purchase",
-                    amount=item.local_product_details.get("purchase_price", 0) * item.quantity,
-                    description=f"شراء {item.local_product_details.get('name')} من فاتورة {invoice_number}",
-                    product_name=item.local_product_details.get("name", ""),
-                    quantity=item.quantity,
-                    unit_price=item.local_product_details.get("purchase_price", 0),
-                    reference_invoice_id=invoice_obj.id
-                )
-                
-                # Find supplier by name to get ID
-                supplier = await db.suppliers.find_one({"name": item.local_product_details.get("supplier", "")})
-                if supplier:
-                    supplier_transaction.supplier_id = supplier["id"]
-                    await db.supplier_transactions.insert_one(supplier_transaction.dict())
-                    
-                    # Update supplier balance
-                    purchase_amount = item.local_product_details.get("purchase_price", 0) * item.quantity
-                    await db.suppliers.update_one(
-                        {"id": supplier["id"]},
-                        {
-                            "$inc": {
-                                "total_purchases": purchase_amount,
-                                "balance": purchase_amount
-                            }
-                        }
-                    )
-        else:
-            # Handle manufactured products - deduct from material height
-            material_deducted = False  # Flag to prevent double deduction
-            
-            # Prioritize multi-material selection over single material selection
-            if hasattr(item, 'selected_materials') and item.selected_materials and not material_deducted:
-                # Handle multiple materials with specified seal counts
-                for material_info in item.selected_materials:
-                    raw_material = await db.raw_materials.find_one({
-                        "unit_code": material_info.get("unit_code"),
-                        "inner_diameter": material_info.get("inner_diameter"),
-                        "outer_diameter": material_info.get("outer_diameter")
-                    })
-                    
-                    if raw_material:
-                        seal_consumption_per_piece = item.height + 2
-                        seals_to_produce = material_info.get("seals_count", 0)
-                        material_consumption = seals_to_produce * seal_consumption_per_piece
-                        current_height = raw_material.get("height", 0)
-                        
-                        if current_height >= material_consumption:
-                            # Deduct from this material
-                            await db.raw_materials.update_one(
-                                {"id": raw_material["id"]},
-                                {"$inc": {"height": -material_consumption}}
-                            )
-                            
-                            remaining_height = current_height - material_consumption
-                            print(f"✅ تم خصم {material_consumption} مم من الخامة {raw_material.get('unit_code', 'غير محدد')} لإنتاج {seals_to_produce} سيل - المتبقي: {remaining_height} مم")
-                        else:
-                            print(f"❌ خطأ: لا يوجد ارتفاع كافٍ في الخامة {raw_material.get('unit_code', 'غير محدد')} - مطلوب: {material_consumption} مم، متوفر: {current_height} مم")
-                    else:
-                        print(f"❌ خطأ: لم يتم العثور على الخامة {material_info.get('unit_code', 'غير محدد')}")
-                
-                material_deducted = True
-                print(f"🎉 تم خصم المواد من {len(item.selected_materials)} خامة مختلفة")
-                
-            # Prioritize material_details (single material) if no multi-material selection
-            elif item.material_details and not material_deducted:
-                material_details = item.material_details
-                if not material_details.get('is_finished_product', False):
-                    # Find the specific material selected by user
-                    raw_material = None
-                    
-                    # Search by inner_diameter + outer_diameter + unit_code together for highest accuracy
-                    if (material_details.get("inner_diameter") and 
-                        material_details.get("outer_diameter") and 
-                        material_details.get("unit_code")):
-                        raw_material = await db.raw_materials.find_one({
-                            "inner_diameter": material_details.get("inner_diameter"),
-                            "outer_diameter": material_details.get("outer_diameter"),
-                            "unit_code": material_details.get("unit_code")
-                        })
-                    
-                    # If not found by dimensions + unit_code, try by specifications only
-                    if not raw_material and material_details.get("material_type"):
-                        raw_material = await db.raw_materials.find_one({
-                            "material_type": material_details.get("material_type"),
-                            "inner_diameter": material_details.get("inner_diameter"),
-                            "outer_diameter": material_details.get("outer_diameter")
-                        })
-                    
-                    if raw_material:
-                        # Calculate actual seals to be made from this material
-                        seal_consumption_per_piece = item.height + 2
-                        total_seals_requested = item.quantity
-                        material_height = raw_material.get("height", 0)
-                        
-                        # Calculate maximum seals possible from this material
-                        max_possible_seals = int(material_height // seal_consumption_per_piece)
-                        
-                        # Check if remaining height would be unusable (< 15mm but > 0)
-                        remaining_after_max = material_height - (max_possible_seals * seal_consumption_per_piece)
-                        if remaining_after_max > 0 and remaining_after_max < 15 and max_possible_seals > 0:
-                            max_possible_seals -= 1  # Reduce by 1 to avoid unusable remainder
-                        
-                        # Determine actual seals to produce (limited by material availability)
-                        actual_seals_to_produce = min(total_seals_requested, max_possible_seals)
-                        material_consumption = actual_seals_to_produce * seal_consumption_per_piece
-                        
-                        if actual_seals_to_produce > 0 and material_height >= material_consumption:
-                            # Deduct from material height
-                            await db.raw_materials.update_one(
-                                {"id": raw_material["id"]},
-                                {"$inc": {"height": -material_consumption}}
-                            )
-                            
-                            material_deducted = True
-                            remaining_height = material_height - material_consumption
-                            
-                            if actual_seals_to_produce < total_seals_requested:
-                                print(f"⚠️ تم خصم {material_consumption} مم من الخامة {raw_material.get('unit_code', 'غير محدد')} لإنتاج {actual_seals_to_produce} سيل من أصل {total_seals_requested} سيل - المتبقي: {remaining_height} مم")
-                                print(f"📌 ملاحظة: يحتاج المستخدم لاختيار خامة أخرى لإنتاج الـ {total_seals_requested - actual_seals_to_produce} سيل المتبقية")
-                            else:
-                                print(f"✅ تم خصم {material_consumption} مم من الخامة {raw_material.get('unit_code', 'غير محدد')} لإنتاج جميع الـ {total_seals_requested} سيل - المتبقي: {remaining_height} مم")
-                        else:
-                            if max_possible_seals <= 0:
-                                print(f"❌ خطأ: الخامة {raw_material.get('unit_code', 'غير محدد')} لا تكفي لإنتاج أي سيل - الارتفاع: {material_height} مم، المطلوب: {seal_consumption_per_piece} مم للسيل الواحد")
-                            else:
-                                print(f"❌ خطأ: لا يوجد ارتفاع كافٍ في الخامة {raw_material.get('unit_code', 'غير محدد')} - مطلوب: {material_consumption} مم، متوفر: {material_height} مم")
-                    else:
-                        print(f"❌ خطأ: لم يتم العثور على الخامة المحددة - {material_details.get('material_type')} {material_details.get('inner_diameter')}×{material_details.get('outer_diameter')} كود: {material_details.get('unit_code', 'غير محدد')}")
-            
-            # Fallback to material_used only if material_details didn't work and no deduction happened
-            if item.material_used and not material_deducted:
-                # Find the raw material by unit_code only (less accurate fallback)
-                raw_material = await db.raw_materials.find_one({"unit_code": item.material_used})
-                
-                if raw_material:
-                    # Calculate required material consumption (seal height + 2mm waste) * quantity
-                    material_consumption = (item.height + 2) * item.quantity
-                    
-                    # Check if there's enough height available
-                    current_height = raw_material.get("height", 0)
-                    if current_height >= material_consumption:
-                        # Deduct from material height
-                        await db.raw_materials.update_one(
-                            {"unit_code": item.material_used},
-                            {"$inc": {"height": -material_consumption}}
-                        )
-                        
-                        material_deducted = True
-                        print(f"⚠️ تم خصم {material_consumption} مم من ارتفاع الخامة {item.material_used} (بحث بكود الوحدة فقط - أقل دقة)")
-                    else:
-                        print(f"❌ تحذير: لا يوجد ارتفاع كافٍ في الخامة {item.material_used} - مطلوب: {material_consumption} مم، متوفر: {current_height} مم")
-                else:
-                    print(f"❌ تحذير: الخامة {item.material_used} غير موجودة في المواد الخام")
+    async def run_stage(task_type, stage):
+        stage_tasks = tasks_by_type.get(task_type, [])
+        if not stage_tasks:
+            return
+        try:
+            await stage(stage_tasks, [invoices_by_id[task.invoice_id] for task in stage_tasks])
+        except Exception as e:
+            logger.warning(f"Batch stage {task_type} failed, leaving it to the outbox worker: {str(e)}")
+            await release_outbox_tasks(stage_tasks, e)
+            for task in stage_tasks:
+                pending_effects.setdefault(task.invoice_id, []).append(task_type)
+    
+    async def deduct_materials(stage_tasks, stage_invoices):
+        # One plan over all invoices; each task keeps its share so a retry replays the same tokens
+        plan = await plan_material_deductions(stage_invoices, token_prefix=str(uuid.uuid4()))
+        await db.outbox.bulk_write([
+            UpdateOne({"id": task.id}, {"$set": {"payload.plan": {
+                "operation_count": plan["operation_count"],
+                "results": [result for result in plan["results"] if result["invoice_id"] == task.invoice_id]
+            }}})
+            for task in stage_tasks
+        ], ordered=False)
+        results: Dict[str, List] = {}
+        applied = await apply_material_deductions(plan)
+        for result in applied:
+            results.setdefault(result["invoice_id"], []).append(result)
+        await record_material_costs(stage_invoices, applied)
+        await complete_outbox_tasks(stage_tasks, results)
+    
+    async def record_local_sales(stage_tasks, stage_invoices):
+        for task, invoice in zip(stage_tasks, stage_invoices):
+            async def mark_step(step, task_id=task.id):
+                await db.outbox.update_one({"id": task_id}, {"$addToSet": {"completed_steps": step}})
+            await record_local_product_sales(invoice, set(), mark_step)
+        await complete_outbox_tasks(stage_tasks)
     
-    await db.invoices.insert_one(invoice_obj.dict())
+    async def post_income(stage_tasks, stage_invoices):
+        transactions = [build_invoice_income_transaction(invoice) for invoice in stage_invoices]
+        existing = await db.treasury_transactions.distinct(
+            "reference", {"reference": {"$in": [transaction.reference for transaction in transactions]}}
+        )
+        await post_treasury_transactions([transaction for transaction in transactions if transaction.reference not in existing])
+        await complete_outbox_tasks(stage_tasks)
     
-    # Add treasury transaction for non-deferred payments
-    if str(invoice.payment_method) != "آجل":  # التحقق من النص العربي
-        # Map payment methods to treasury account IDs
-        payment_method_mapping = {
-            "نقدي": "cash",
-            "آجل": "deferred",
-            "فودافون كاش محمد الصاوي": "vodafone_elsawy", 
-            "فودافون كاش وائل محمد": "vodafone_wael",
-            "انستاباي": "instapay",
-            "يد الصاوي": "yad_elsawy"
-        }
-        
-        account_id = payment_method_mapping.get(str(invoice.payment_method), "cash")
-        
-        # Check if treasury transaction already exists for this invoice
-        existing_transaction = await db.treasury_transactions.find_one({
-            "reference": f"invoice_{invoice_obj.id}"
-        })
-        
-        if not existing_transaction:
-            treasury_transaction = TreasuryTransaction(
-                account_id=account_id,
-                transaction_type="income",
-                amount=total_after_discount,
-                description=f"فاتورة {invoice_number} - {invoice.customer_name}",
-                reference=f"invoice_{invoice_obj.id}"
-            )
-            await db.treasury_transactions.insert_one(treasury_transaction.dict())
+    async def add_to_daily_work_order(stage_tasks, stage_invoices):
+        await append_invoices_to_daily_work_order(stage_invoices, supervisor_name, stage_tasks[0].payload.get("work_date"))
+        await complete_outbox_tasks(stage_tasks)
     
-    # Add to daily work order automatically
+    await run_stage("deduct_materials", deduct_materials)
+    await run_stage("record_local_sales", record_local_sales)
+    await run_stage("post_invoice_income", post_income)
+    await run_stage("add_to_daily_work_order", add_to_daily_work_order)
+    
+    return pending_effects
+
+@api_router.post("/invoices/batch")
+async def create_invoices_batch(
+    batch: InvoiceBatchCreate,
+    supervisor_name: str = "",
+    company_id: Optional[str] = None,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    """Create many invoices in one request, reporting success or failure per invoice"""
+    if len(batch.invoices) > INVOICE_BATCH_MAX_SIZE:
+        raise HTTPException(status_code=400, detail=f"الحد الأقصى {INVOICE_BATCH_MAX_SIZE} فاتورة في الدفعة الواحدة")
+    
+    return await run_idempotent(
+        "invoices_batch",
+        idempotency_key,
+        {"batch": batch, "supervisor_name": supervisor_name, "company_id": company_id},
+        lambda: insert_invoice_batch(batch.invoices, supervisor_name, company_id)
+    )
+
+async def insert_invoice_batch(payloads: List[Dict[str, Any]], supervisor_name: str, company_id: Optional[str]):
     try:
-        today = datetime.now().date()
-        
-        # Get or create daily work order for today
-        daily_work_order = await db.work_orders.find_one({
-            "is_daily": True,
-            "work_date": today.isoformat()
-        })
-        
-        if not daily_work_order:
-            # Create new daily work order
-            work_order = WorkOrder(
-                title=f"أمر شغل يومي - {today.strftime('%d/%m/%Y')}",
-                description=f"أمر شغل يومي لجميع فواتير يوم {today.strftime('%d/%m/%Y')}",
-                supervisor_name=supervisor_name,
-                is_daily=True,
-                work_date=today.isoformat(),  # Store as string
-                invoices=[],
-                total_amount=0.0,
-                total_items=0,
-                status="جديد"
-            )
-            
-            await db.work_orders.insert_one(work_order.dict())
-            daily_work_order = work_order.dict()
-        
-        # Add invoice to daily work order with enhanced material details
-        invoice_for_work_order = invoice_obj.dict()
-        if "_id" in invoice_for_work_order:
-            del invoice_for_work_order["_id"]
-        
-        # Enhance items with material usage details for work order display
-        enhanced_items = []
-        for item in invoice_for_work_order.get("items", []):
-            enhanced_item = item.copy()
-            
-            # Add material consumption details for manufactured products
-            if item.get("product_type") == "manufactured":
-                seal_consumption = (item.get("height", 0) + 2) * item.get("quantity", 0)
-                
-                # Build material info string based on selected materials
-                material_info = ""
-                unit_code_display = ""
-                
-                print(f"🔍 Debug - Item data: {item}")
-                print(f"🔍 Debug - Selected materials: {item.get('selected_materials')}")
-                
-                if item.get("selected_materials"):
-                    print(f"✅ Found selected_materials: {len(item.get('selected_materials'))} materials")
-                    # Multi-material case
-                    material_parts = []
-                    for mat in item.get("selected_materials", []):
-                        inner_dia = mat.get("inner_diameter", 0)
-                        outer_dia = mat.get("outer_diameter", 0) 
-                        unit_code = mat.get("unit_code", "غير محدد")
-                        seals_count = mat.get("seals_count", 0)
-                        material_parts.append(f"{inner_dia}×{outer_dia} {unit_code} ({seals_count})")
-                    
-                    unit_code_display = " / ".join(material_parts)
-                    material_info = f"مواد متعددة: {len(item.get('selected_materials', []))} خامة"
-                    print(f"✅ Multi-material unit_code_display: {unit_code_display}")
-                    
-                elif item.get("material_details"):
-                    # Single material case
-                    mat_details = item.get("material_details")
-                    inner_dia = mat_details.get("inner_diameter", 0)
-                    outer_dia = mat_details.get("outer_diameter", 0)
-                    unit_code = mat_details.get("unit_code", "غير محدد")
-                    unit_code_display = f"{inner_dia}×{outer_dia} {unit_code} ({item.get('quantity', 0)})"
-                    material_info = f"{unit_code} ({item.get('quantity', 0)} سيل)"
-                    
-                elif item.get("material_used"):
-                    # Fallback case
-                    unit_code_display = f"{item.get('material_used')} ({item.get('quantity', 0)})"
-                    material_info = f"{item.get('material_used')} ({item.get('quantity', 0)} سيل)"
-                
-                enhanced_item["material_consumption"] = seal_consumption
-                enhanced_item["material_info"] = material_info
-                enhanced_item["unit_code_display"] = unit_code_display  # This will be used in work order
-                enhanced_item["work_order_display"] = f"{item.get('seal_type', '')} {item.get('material_type', '')} {item.get('inner_diameter', 0)}×{item.get('outer_diameter', 0)}×{item.get('height', 0)} - {material_info} - استهلاك: {seal_consumption} مم"
-            
-            enhanced_items.append(enhanced_item)
+        results: List[Dict[str, Any]] = [{"index": index, "success": False} for index in range(len(payloads))]
         
-        invoice_for_work_order["items"] = enhanced_items
-            
-        current_invoices = daily_work_order.get("invoices", [])
-        current_invoices.append(invoice_for_work_order)
+        valid = []
+        for index, payload in enumerate(payloads):
+            try:
+                valid.append((index, InvoiceCreate(**payload)))
+            except Exception as e:
+                results[index]["error"] = str(e)
         
-        new_total_amount = daily_work_order.get("total_amount", 0) + total_after_discount
-        new_total_items = daily_work_order.get("total_items", 0) + len(invoice.items)
+        # Allocate the whole block of invoice numbers at once
+        numbers = await allocate_sequence_numbers(company_id, "invoice", len(valid)) if valid else []
+        invoices = [
+            (index, build_invoice(invoice, format_sequence_number("invoice", number), company_id))
+            for (index, invoice), number in zip(valid, numbers)
+        ]
         
-        await db.work_orders.update_one(
-            {"id": daily_work_order["id"]},
-            {"$set": {
-                "invoices": current_invoices,
-                "total_amount": new_total_amount,
-                "total_items": new_total_items,
-                "supervisor_name": supervisor_name  # Update supervisor name if provided
-            }}
+        # Lease the side-effect tasks to this request; the worker picks them up if it dies
+        lease_until = datetime.utcnow() + timedelta(seconds=OUTBOX_LEASE_SECONDS)
+        tasks_by_invoice = {}
+        for _, invoice_obj in invoices:
+            tasks = build_invoice_outbox_tasks(invoice_obj, supervisor_name)
+            for task in tasks:
+                task.status = "processing"
+                task.attempts = 1
+                task.next_attempt_at = lease_until
+            tasks_by_invoice[invoice_obj.id] = tasks
+        all_tasks = [task for tasks in tasks_by_invoice.values() for task in tasks]
+        if all_tasks:
+            await db.outbox.insert_many([task.dict() for task in all_tasks])
+        
+        failed_ids = set()
+        if invoices:
+            try:
+                await db.invoices.insert_many([invoice_obj.dict() for _, invoice_obj in invoices], ordered=False)
+            except BulkWriteError as e:
+                for error in e.details.get("writeErrors", []):
+                    index, invoice_obj = invoices[error["index"]]
+                    failed_ids.add(invoice_obj.id)
+                    results[index]["error"] = error.get("errmsg", "فشل حفظ الفاتورة")
+                await db.outbox.delete_many({"invoice_id": {"$in": list(failed_ids)}})
+            except Exception:
+                await db.outbox.delete_many({"invoice_id": {"$in": list(tasks_by_invoice)}})
+                raise
+        
+        created = [(index, invoice_obj) for index, invoice_obj in invoices if invoice_obj.id not in failed_ids]
+        await adjust_treasury_balances([
+            (invoice_obj.company_id, "deferred", invoice_obj.total_amount)
+            for _, invoice_obj in created if invoice_obj.payment_method == "آجل"
+        ])
+        await adjust_daily_rollups([invoice_rollup_delta(invoice_obj.dict(), 1) for _, invoice_obj in created])
+        await invalidate_dashboard_stats()
+        created_tasks = [task for _, invoice_obj in created for task in tasks_by_invoice[invoice_obj.id]]
+        pending_effects = await apply_invoice_batch_side_effects(
+            [invoice_obj.dict() for _, invoice_obj in created], created_tasks, supervisor_name
         )
         
+        for index, invoice_obj in created:
+            results[index].update({
+                "success": True,
+                "invoice_id": invoice_obj.id,
+                "invoice_number": invoice_obj.invoice_number,
+                "total_amount": invoice_obj.total_amount
+            })
+            if invoice_obj.id in pending_effects:
+                results[index]["pending_side_effects"] = pending_effects[invoice_obj.id]
+        
+        return {
+            "message": f"تم إنشاء {len(created)} فاتورة من {len(payloads)}",
+            "created": len(created),
+            "failed": len(payloads) - len(created),
+            "results": results
+        }
     except Exception as e:
-        # Log error but don't fail invoice creation
-        print(f"Error adding invoice to daily work order: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Keyset pagination cursors
+INVOICE_PAGE_MAX_LIMIT = 1000
+
+def encode_page_cursor(values: Dict[str, Any]) -> str:
+    """Encode the sort key of the last row of a page as an opaque cursor"""
+    payload = {
+        key: {"$date": value.isoformat()} if isinstance(value, datetime) else value
+        for key, value in values.items()
+    }
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+def decode_page_cursor(cursor: str, keys: List[str]) -> Dict[str, Any]:
+    """Decode a cursor made by encode_page_cursor, checking it has the expected keys"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        values = {
+            key: datetime.fromisoformat(value["$date"]) if isinstance(value, dict) and "$date" in value else value
+            for key, value in payload.items()
+        }
+        if any(key not in values for key in keys):
+            raise ValueError("missing cursor keys")
+        return values
+    except Exception:
+        raise HTTPException(status_code=400, detail="مؤشر الصفحة غير صالح")
+
+# Header fields and totals shown in invoice tables; items are only counted
+INVOICE_SUMMARY_PROJECTION = {
+    "_id": 0,
+    "id": 1,
+    "company_id": 1,
+    "invoice_number": 1,
+    "customer_id": 1,
+    "customer_name": 1,
+    "invoice_title": 1,
+    "supervisor_name": 1,
+    "subtotal": 1,
+    "discount": 1,
+    "discount_type": 1,
+    "discount_value": 1,
+    "total_after_discount": 1,
+    "total_amount": 1,
+    "paid_amount": 1,
+    "remaining_amount": 1,
+    "payment_method": 1,
+    "status": 1,
+    "date": 1,
+    "notes": 1,
+    "item_count": {"$size": {"$ifNull": ["$items", []]}}
+}
+
+# Invoice endpoints
+@api_router.post("/invoices", response_model=Invoice)
+async def create_invoice(
+    invoice: InvoiceCreate,
+    supervisor_name: str = "",
+    company_id: Optional[str] = None,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    return await run_idempotent(
+        "invoices",
+        idempotency_key,
+        {"invoice": invoice, "supervisor_name": supervisor_name, "company_id": company_id},
+        lambda: insert_invoice(invoice, supervisor_name, company_id)
+    )
+
+async def insert_invoice(invoice: InvoiceCreate, supervisor_name: str, company_id: Optional[str]) -> Invoice:
+    # Generate invoice number
+    invoice_number = await next_sequence_number(company_id, "invoice")
+    invoice_obj = build_invoice(invoice, invoice_number, company_id)
+    
+    tasks = build_invoice_outbox_tasks(invoice_obj, supervisor_name)
+    
+    if await supports_transactions():
+        # The invoice, its tasks, balance and rollup are written together or not at all
+        async def write_invoice(session):
+            await db.outbox.insert_many([task.dict() for task in tasks], session=session)
+            await db.invoices.insert_one(invoice_obj.dict(), session=session)
+            await adjust_deferred_invoice_balance(invoice_obj.dict(), 1, session=session)
+            await adjust_daily_rollups([invoice_rollup_delta(invoice_obj.dict(), 1)], session=session)
+        
+        async with await client.start_session() as session:
+            await session.with_transaction(write_invoice)
+    else:
+        # Record the side effects first so they survive a crash right after the invoice insert;
+        # tasks left without an invoice are cancelled by the outbox worker
+        await db.outbox.insert_many([task.dict() for task in tasks])
+        try:
+            await db.invoices.insert_one(invoice_obj.dict())
+        except Exception:
+            await db.outbox.delete_many({"invoice_id": invoice_obj.id})
+            raise
+        
+        await adjust_deferred_invoice_balance(invoice_obj.dict(), 1)
+        await adjust_daily_rollups([invoice_rollup_delta(invoice_obj.dict(), 1)])
     
+    await invalidate_dashboard_stats()
+    _outbox_wakeup.set()
     return invoice_obj
 
 @api_router.get("/invoices")
-async def get_invoices(company_id: str):
-    """Get invoices for specific company"""
+async def get_invoices(
+    company_id: str,
+    response: Response,
+    limit: int = Query(INVOICE_PAGE_MAX_LIMIT, ge=1, le=INVOICE_PAGE_MAX_LIMIT),
+    after: Optional[str] = None,
+    status: Optional[str] = None,
+    payment_method: Optional[str] = None,
+    customer_id: Optional[str] = None,
+    customer_name: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    has_remaining: bool = False,
+    view: str = Query("full", pattern="^(summary|full)$")
+):
+    """Get a page of invoices for specific company, newest first.
+    
+    Pages are keyed on (date, id); when more invoices exist the cursor for the
+    next page is returned in the X-Next-Cursor header and goes in `after`.
+    Rows are full invoices; view=summary returns header fields, totals and item_count
+    for list screens that do not need the items.
+    """
     company_id = get_company_id_from_request(company_id)
-    invoices = await db.invoices.find({"company_id": company_id}).sort("date", -1).to_list(1000)
-    return [Invoice(**invoice) for invoice in invoices]
+    
+    query: Dict[str, Any] = {"company_id": company_id}
+    if status:
+        query["status"] = status
+    if payment_method:
+        query["payment_method"] = payment_method
+    if customer_id:
+        query["customer_id"] = customer_id
+    if customer_name:
+        query["customer_name"] = customer_name
+    if date_from or date_to:
+        query["date"] = {}
+        if date_from:
+            query["date"]["$gte"] = date_from
+        if date_to:
+            query["date"]["$lte"] = date_to
+    if has_remaining:
+        query["remaining_amount"] = {"$gt": 0}
+    if after:
+        cursor = decode_page_cursor(after, ["date", "id"])
+        query["$or"] = [
+            {"date": {"$lt": cursor["date"]}},
+            {"date": cursor["date"], "id": {"$lt": cursor["id"]}}
+        ]
+    
+    pipeline = [
+        {"$match": query},
+        {"$sort": {"date": -1, "id": -1}},
+        {"$limit": limit + 1}
+    ]
+    if view == "summary":
+        pipeline.append({"$project": INVOICE_SUMMARY_PROJECTION})
+    invoices = await db.invoices.aggregate(pipeline).to_list(limit + 1)
+    
+    if len(invoices) > limit:
+        invoices = invoices[:limit]
+        response.headers["X-Next-Cursor"] = encode_page_cursor({"date": invoices[-1]["date"], "id": invoices[-1]["id"]})
+    
+    if view == "full":
+        return [Invoice(**invoice) for invoice in invoices]
+    return invoices
 
 @api_router.get("/invoices/{invoice_id}", response_model=Invoice)
 async def get_invoice(invoice_id: str):
@@ -1240,13 +3642,19 @@ async def get_invoice(invoice_id: str):
 @api_router.delete("/invoices/clear-all")
 async def clear_all_invoices():
     result = await db.invoices.delete_many({})
+    await reconcile_treasury_balances()
+    await rebuild_daily_rollups()
+    await invalidate_dashboard_stats()
     return {"message": f"تم حذف {result.deleted_count} فاتورة", "deleted_count": result.deleted_count}
 
 @api_router.delete("/invoices/{invoice_id}")
 async def delete_invoice(invoice_id: str):
-    result = await db.invoices.delete_one({"id": invoice_id})
-    if result.deleted_count == 0:
+    invoice = await db.invoices.find_one_and_delete({"id": invoice_id})
+    if not invoice:
         raise HTTPException(status_code=404, detail="الفاتورة غير موجودة")
+    await adjust_deferred_invoice_balance(invoice, -1)
+    await adjust_daily_rollups([invoice_rollup_delta(invoice, -1)])
+    await invalidate_dashboard_stats()
     return {"message": "تم حذف الفاتورة بنجاح"}
 
 @api_router.put("/invoices/{invoice_id}/status")
@@ -1310,22 +3718,49 @@ async def update_invoice(invoice_id: str, invoice_update: dict):
                 'total_amount': total_after_discount
             })
         
+        # Keep the costing in step with the items and total
+        if 'items' in invoice_update:
+            # Local items cost their purchase price; manufactured items keep the cost of their deduction
+            for item in invoice_update['items']:
+                item['cost'] = local_item_cost(item) if item.get('product_type') == 'local' else item.get('cost')
+            cost_of_goods = sum(item['cost'] or 0 for item in invoice_update['items'])
+            invoice_update['cost_of_goods'] = cost_of_goods
+            invoice_update['cost_rolled_up'] = cost_of_goods
+        else:
+            cost_of_goods = existing_invoice.get('cost_of_goods')
+        if cost_of_goods is not None and ('items' in invoice_update or 'total_amount' in invoice_update):
+            invoice_update['gross_profit'] = invoice_update.get('total_amount', existing_invoice.get('total_amount', 0)) - cost_of_goods
+        
         # Update the invoice
-        result = await db.invoices.update_one(
+        previous_invoice = await db.invoices.find_one_and_update(
             {"id": invoice_id},
             {"$set": invoice_update}
         )
         
-        if result.matched_count == 0:
+        if not previous_invoice:
             raise HTTPException(status_code=404, detail="الفاتورة غير موجودة")
         
+        await adjust_deferred_invoice_balance(previous_invoice, -1)
+        await adjust_deferred_invoice_balance({**previous_invoice, **invoice_update}, 1)
+        await adjust_daily_rollups([
+            invoice_rollup_delta(previous_invoice, -1),
+            invoice_rollup_delta({**previous_invoice, **invoice_update}, 1)
+        ])
+        await invalidate_dashboard_stats()
+        
         return {"message": "تم تحديث الفاتورة بنجاح"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # Payment endpoints
 @api_router.post("/payments", response_model=Payment)
-async def create_payment(payment: PaymentCreate):
+async def create_payment(
+    payment: PaymentCreate,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    return await run_idempotent("payments", idempotency_key, payment, lambda: apply_payment(payment))
+
+async def apply_payment(payment: PaymentCreate) -> Payment:
     payment_obj = Payment(**payment.dict())
     
     # Update invoice
@@ -1346,6 +3781,11 @@ async def create_payment(payment: PaymentCreate):
             "status": status
         }}
     )
+    await adjust_daily_rollups([
+        (invoice.get("company_id"), invoice.get("date"), {"deferred": max(0, new_remaining) - invoice.get("remaining_amount", 0)}),
+        (invoice.get("company_id"), payment_obj.date, {"collections": payment.amount})
+    ])
+    await invalidate_dashboard_stats()
     
     # Add treasury transaction for the payment
     payment_method_mapping = {
@@ -1367,25 +3807,29 @@ async def create_payment(payment: PaymentCreate):
     
     if not existing_transaction:
         # Add income transaction to the payment account
-        treasury_transaction = TreasuryTransaction(
+        treasury_transactions = [TreasuryTransaction(
+            company_id=invoice.get("company_id"),
             account_id=account_id,
             transaction_type="income",
             amount=payment.amount,
             description=f"دفع فاتورة {invoice['invoice_number']} - {invoice['customer_name']}",
-            reference=f"payment_{payment_obj.id}"
-        )
-        await db.treasury_transactions.insert_one(treasury_transaction.dict())
+            reference=f"payment_{payment_obj.id}",
+            unique_reference=True
+        )]
         
         # For deferred invoices, also create a deduction from deferred account
         if invoice.get("payment_method") == "آجل":
-            deferred_transaction = TreasuryTransaction(
+            treasury_transactions.append(TreasuryTransaction(
+                company_id=invoice.get("company_id"),
                 account_id="deferred",
                 transaction_type="expense",
                 amount=payment.amount,
                 description=f"تسديد آجل فاتورة {invoice['invoice_number']} - {invoice['customer_name']}",
-                reference=f"payment_{payment_obj.id}_deferred"
-            )
-            await db.treasury_transactions.insert_one(deferred_transaction.dict())
+                reference=f"payment_{payment_obj.id}_deferred",
+                unique_reference=True
+            ))
+        
+        await post_treasury_transactions(treasury_transactions)
     
     await db.payments.insert_one(payment_obj.dict())
     return payment_obj
@@ -1398,20 +3842,26 @@ async def get_payments():
 @api_router.delete("/payments/clear-all")
 async def clear_all_payments():
     result = await db.payments.delete_many({})
+    await rebuild_daily_rollups()
     return {"message": f"تم حذف {result.deleted_count} دفعة", "deleted_count": result.deleted_count}
 
 @api_router.delete("/payments/{payment_id}")
 async def delete_payment(payment_id: str):
-    result = await db.payments.delete_one({"id": payment_id})
-    if result.deleted_count == 0:
+    payment = await db.payments.find_one_and_delete({"id": payment_id})
+    if not payment:
         raise HTTPException(status_code=404, detail="الدفعة غير موجودة")
+    invoice = await db.invoices.find_one({"id": payment.get("invoice_id")}, {"_id": 0, "company_id": 1})
+    await adjust_daily_rollups([((invoice or {}).get("company_id"), payment.get("date"), {"collections": -payment.get("amount", 0)})])
     return {"message": "تم حذف الدفعة بنجاح"}
 
 # Expense endpoints
 @api_router.post("/expenses", response_model=Expense)
-async def create_expense(expense: ExpenseCreate):
-    expense_obj = Expense(**expense.dict())
+async def create_expense(expense: ExpenseCreate, company_id: Optional[str] = None):
+    expense_obj = Expense(**expense.dict(), company_id=company_id)
     await db.expenses.insert_one(expense_obj.dict())
+    await adjust_treasury_balances([(expense_obj.company_id, "cash", -expense_obj.amount)])
+    await adjust_daily_rollups([expense_rollup_delta(expense_obj.dict(), 1)])
+    await invalidate_dashboard_stats()
     return expense_obj
 
 @api_router.get("/expenses", response_model=List[Expense])
@@ -1422,33 +3872,214 @@ async def get_expenses():
 @api_router.delete("/expenses/clear-all")
 async def clear_all_expenses():
     result = await db.expenses.delete_many({})
+    await reconcile_treasury_balances()
+    await rebuild_daily_rollups()
+    await invalidate_dashboard_stats()
     return {"message": f"تم حذف {result.deleted_count} مصروف", "deleted_count": result.deleted_count}
 
 @api_router.delete("/expenses/{expense_id}")
 async def delete_expense(expense_id: str):
-    result = await db.expenses.delete_one({"id": expense_id})
-    if result.deleted_count == 0:
+    expense = await db.expenses.find_one_and_delete({"id": expense_id})
+    if not expense:
         raise HTTPException(status_code=404, detail="المصروف غير موجود")
+    await adjust_treasury_balances([(expense.get("company_id"), "cash", expense.get("amount", 0))])
+    await adjust_daily_rollups([expense_rollup_delta(expense, -1)])
+    await invalidate_dashboard_stats()
     return {"message": "تم حذف المصروف بنجاح"}
 
 # Revenue reports
 @api_router.get("/reports/revenue")
-async def get_revenue_report(period: str = "daily"):
-    # Implementation for revenue reports based on period
-    invoices = list(await db.invoices.find().to_list(1000))
-    expenses = list(await db.expenses.find().to_list(1000))
+async def get_revenue_report(
+    period: str = Query("daily", pattern="^(daily|weekly|monthly|yearly)$"),
+    company_id: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None
+):
+    """Revenue totals for the current day, week, month or year (or date_from..date_to),
+    with one bucket per period, read from the daily rollups"""
+    try:
+        if not date_from:
+            date_from = rollup_period_start(rollup_day(date_to), period)
+        
+        query: Dict[str, Any] = {"date": _date_range(rollup_day(date_from), date_to, inclusive=True)}
+        if company_id:
+            query["company_id"] = company_id
+        
+        totals = {"sales": 0, "discounts": 0, "cost_of_goods": 0, "deferred": 0, "collections": 0, "expenses": 0, "invoice_count": 0}
+        expenses_by_category: Dict[str, float] = {}
+        buckets: Dict[datetime, Dict[str, Any]] = {}
+        async for rollup in db.daily_rollups.find(query, {"_id": 0}).sort("date", 1):
+            start = rollup_period_start(rollup["date"], period)
+            bucket = buckets.setdefault(start, {"period_start": start, "revenue": 0, "expenses": 0, "material_cost": 0})
+            material_cost = rollup.get("expenses_by_category", {}).get(ExpenseCategory.MATERIALS.value, 0)
+            bucket["revenue"] += rollup.get("sales", 0)
+            bucket["expenses"] += rollup.get("expenses", 0)
+            bucket["material_cost"] += material_cost
+            for field in totals:
+                totals[field] += rollup.get(field, 0)
+            for category, amount in rollup.get("expenses_by_category", {}).items():
+                expenses_by_category[category] = expenses_by_category.get(category, 0) + amount
+        
+        for bucket in buckets.values():
+            bucket["profit"] = bucket["revenue"] - bucket["expenses"]
+        
+        return {
+            "total_revenue": totals["sales"],
+            "total_expenses": totals["expenses"],
+            "material_cost": expenses_by_category.get(ExpenseCategory.MATERIALS.value, 0),
+            "profit": totals["sales"] - totals["expenses"],
+            "total_discounts": totals["discounts"],
+            "cost_of_goods": totals["cost_of_goods"],
+            "gross_profit": totals["sales"] - totals["cost_of_goods"],
+            "deferred_amount": totals["deferred"],
+            "collections": totals["collections"],
+            "invoice_count": totals["invoice_count"],
+            "expenses_by_category": expenses_by_category,
+            "period": period,
+            "date_from": date_from,
+            "date_to": date_to,
+            "buckets": list(buckets.values())
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/reports/margin")
+async def get_margin_report(
+    company_id: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None
+):
+    """Revenue, cost of goods and gross margin from the costs stored on each invoice.
     
-    total_revenue = sum(invoice.get("total_amount", 0) for invoice in invoices)
-    total_expenses = sum(expense.get("amount", 0) for expense in expenses)
-    material_cost = sum(expense.get("amount", 0) for expense in expenses if expense.get("category") == "خامات")
+    Invoices from before costing was recorded have no cost_of_goods and are skipped.
+    Lines by product type are before the invoice discount.
+    """
+    try:
+        match: Dict[str, Any] = {"cost_of_goods": {"$ne": None}}
+        if company_id:
+            match["company_id"] = company_id
+        date_filter = _date_range(date_from, date_to, inclusive=True)
+        if date_filter:
+            match["date"] = date_filter
+        
+        totals = await db.invoices.aggregate([
+            {"$match": match},
+            {"$group": {
+                "_id": None,
+                "revenue": {"$sum": "$total_amount"},
+                "cost_of_goods": {"$sum": "$cost_of_goods"},
+                "gross_profit": {"$sum": "$gross_profit"},
+                "invoice_count": {"$sum": 1}
+            }},
+            {"$project": {"_id": 0}}
+        ]).to_list(1)
+        
+        by_product_type = await db.invoices.aggregate([
+            {"$match": match},
+            {"$unwind": "$items"},
+            {"$group": {
+                "_id": {"$ifNull": ["$items.product_type", "manufactured"]},
+                "revenue": {"$sum": "$items.total_price"},
+                "cost_of_goods": {"$sum": {"$ifNull": ["$items.cost", 0]}},
+                "quantity": {"$sum": "$items.quantity"},
+                "uncosted_items": {"$sum": {"$cond": [{"$eq": [{"$ifNull": ["$items.cost", None]}, None]}, 1, 0]}}
+            }},
+            {"$sort": {"_id": 1}}
+        ]).to_list(None)
+        
+        summary = totals[0] if totals else {"revenue": 0, "cost_of_goods": 0, "gross_profit": 0, "invoice_count": 0}
+        summary["margin_percent"] = (summary["gross_profit"] / summary["revenue"] * 100) if summary["revenue"] else 0
+        for row in by_product_type:
+            row["product_type"] = row.pop("_id")
+            row["gross_profit"] = row["revenue"] - row["cost_of_goods"]
+            row["margin_percent"] = (row["gross_profit"] / row["revenue"] * 100) if row["revenue"] else 0
+        
+        return {
+            **summary,
+            "company_id": company_id,
+            "date_from": date_from,
+            "date_to": date_to,
+            "by_product_type": by_product_type
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Receivables aging: bucket name and the oldest age (in days) it holds; older is 90_plus
+AGING_BUCKETS = [("0_30", 30), ("31_60", 60), ("61_90", 90)]
+
+@api_router.get("/reports/receivables-aging")
+async def get_receivables_aging(company_id: Optional[str] = None):
+    """Outstanding invoice balances per customer in 0-30, 31-60, 61-90 and 90+ day buckets.
     
-    return {
-        "total_revenue": total_revenue,
-        "total_expenses": total_expenses,
-        "material_cost": material_cost,
-        "profit": total_revenue - total_expenses,
-        "period": period
-    }
+    Only invoices with remaining_amount > 0 are read, through the partial open balance index
+    when it exists.
+    """
+    try:
+        today = rollup_day()
+        match: Dict[str, Any] = {"remaining_amount": {"$gt": 0}}
+        if company_id:
+            match["company_id"] = company_id
+        
+        bucket_branches = [
+            {"case": {"$gte": ["$date", today - timedelta(days=max_age)]}, "then": name}
+            for name, max_age in AGING_BUCKETS
+        ]
+        bucket_names = [name for name, _ in AGING_BUCKETS] + ["90_plus"]
+        pipeline = [
+            {"$match": match},
+            {"$project": {
+                "_id": 0,
+                "customer_id": 1,
+                "customer_name": 1,
+                "date": 1,
+                "remaining_amount": 1,
+                "bucket": {"$switch": {"branches": bucket_branches, "default": "90_plus"}}
+            }},
+            {"$group": {
+                "_id": {"customer_id": "$customer_id", "customer_name": "$customer_name"},
+                **{
+                    name: {"$sum": {"$cond": [{"$eq": ["$bucket", name]}, "$remaining_amount", 0]}}
+                    for name in bucket_names
+                },
+                "total": {"$sum": "$remaining_amount"},
+                "invoice_count": {"$sum": 1},
+                "oldest_invoice_date": {"$min": "$date"}
+            }},
+            {"$sort": {"total": -1}},
+            {"$project": {
+                "_id": 0,
+                "customer_id": "$_id.customer_id",
+                "customer_name": "$_id.customer_name",
+                **{name: 1 for name in bucket_names},
+                "total": 1,
+                "invoice_count": 1,
+                "oldest_invoice_date": 1
+            }}
+        ]
+        try:
+            customers = await db.invoices.aggregate(pipeline, hint="invoices_company_open_balance").to_list(None)
+        except OperationFailure:
+            # The index is built at startup; until it exists let the planner choose
+            customers = await db.invoices.aggregate(pipeline).to_list(None)
+        
+        totals = {name: sum(customer[name] for customer in customers) for name in bucket_names}
+        return {
+            "as_of": today,
+            "company_id": company_id,
+            "totals": {**totals, "total": sum(totals.values())},
+            "customers": customers
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/reports/rollups/rebuild")
+async def rebuild_report_rollups():
+    """Recompute the daily rollups from invoices, payments and expenses"""
+    try:
+        days = await rebuild_daily_rollups()
+        return {"message": "تم إعادة بناء ملخصات التقارير", "days": days}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
 # Work orders
 @api_router.post("/work-orders", response_model=WorkOrder)
@@ -1458,6 +4089,7 @@ async def create_work_order(invoice_id: str):
         raise HTTPException(status_code=404, detail="الفاتورة غير موجودة")
     
     work_order = WorkOrder(
+        work_order_number=await next_sequence_number(invoice.get("company_id"), "work_order"),
         invoice_id=invoice_id,
         items=invoice["items"]
     )
@@ -1472,6 +4104,7 @@ async def create_work_order_multiple(work_order_data: dict):
         # Create work order with multiple invoices
         work_order = {
             "id": str(uuid.uuid4()),
+            "work_order_number": await next_sequence_number(work_order_data.get("company_id"), "work_order"),
             "title": work_order_data.get("title", ""),
             "description": work_order_data.get("description", ""),
             "priority": work_order_data.get("priority", "عادي"),
@@ -1516,29 +4149,16 @@ async def get_or_create_daily_work_order(work_date: str, supervisor_name: str =
                 
             return existing_order
         
-        # Create new daily work order
-        work_order = WorkOrder(
-            title=f"أمر شغل يومي - {work_date_obj.strftime('%d/%m/%Y')}",
-            description=f"أمر شغل يومي لجميع فواتير يوم {work_date_obj.strftime('%d/%m/%Y')}",
-            supervisor_name=supervisor_name,
-            is_daily=True,
-            work_date=work_date_obj.isoformat(),  # Store as string
-            invoices=[],
-            total_amount=0.0,
-            total_items=0,
-            status="جديد"
-        )
-        
-        await db.work_orders.insert_one(work_order.dict())
+        # Create new daily work order (safe against concurrent creation)
+        await get_or_create_daily_work_order_doc(work_date_obj.isoformat(), supervisor_name)
+        work_order_dict = await db.work_orders.find_one({
+            "is_daily": True,
+            "work_date": work_date_obj.isoformat()
+        })
         
         # Clean up MongoDB ObjectId for return
-        work_order_dict = work_order.dict()
         if "_id" in work_order_dict:
             del work_order_dict["_id"]
-        
-        # Convert date to string for JSON serialization
-        if "work_date" in work_order_dict and work_order_dict["work_date"]:
-            work_order_dict["work_date"] = work_order_dict["work_date"].isoformat() if hasattr(work_order_dict["work_date"], 'isoformat') else str(work_order_dict["work_date"])
             
         return work_order_dict
         
@@ -1549,48 +4169,21 @@ async def get_or_create_daily_work_order(work_date: str, supervisor_name: str =
 async def add_invoice_to_daily_work_order(work_order_id: str, invoice_id: str):
     """Add invoice to daily work order"""
     try:
-        # Get the work order
-        work_order = await db.work_orders.find_one({"id": work_order_id})
-        if not work_order:
-            raise HTTPException(status_code=404, detail="أمر الشغل غير موجود")
-        
         # Get the invoice
-        invoice = await db.invoices.find_one({"id": invoice_id})
+        invoice = await db.invoices.find_one({"id": invoice_id}, {"_id": 0})
         if not invoice:
             raise HTTPException(status_code=404, detail="الفاتورة غير موجودة")
         
-        # Clean up MongoDB ObjectId from invoice
-        if "_id" in invoice:
-            del invoice["_id"]
-        
-        # Get current invoices
-        current_invoices = work_order.get("invoices", [])
-        
-        # Check if invoice already exists
-        if any(inv.get("id") == invoice_id for inv in current_invoices):
+        # Append atomically - skipped if the invoice is already in the work order
+        if not await push_invoices_to_work_order(work_order_id, [invoice]):
+            if not await db.work_orders.find_one({"id": work_order_id}, {"_id": 0, "id": 1}):
+                raise HTTPException(status_code=404, detail="أمر الشغل غير موجود")
             return {"message": "الفاتورة موجودة بالفعل في أمر الشغل"}
             
-        current_invoices.append(invoice)
-        
-        # Update totals
-        new_total_amount = work_order.get("total_amount", 0) + invoice.get("total_amount", 0)
-        new_total_items = work_order.get("total_items", 0) + len(invoice.get("items", []))
-        
-        # Update in database
-        result = await db.work_orders.update_one(
-            {"id": work_order_id},
-            {"$set": {
-                "invoices": current_invoices,
-                "total_amount": new_total_amount,
-                "total_items": new_total_items
-            }}
-        )
-        
-        if result.matched_count == 0:
-            raise HTTPException(status_code=404, detail="فشل في تحديث أمر الشغل")
-            
         return {"message": "تم إضافة الفاتورة إلى أمر الشغل اليومي بنجاح"}
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -1627,48 +4220,21 @@ async def delete_work_order(work_order_id: str):
 async def add_invoice_to_work_order(work_order_id: str, invoice_id: str):
     """Add an invoice to an existing work order"""
     try:
-        # Get the work order
-        work_order = await db.work_orders.find_one({"id": work_order_id})
-        if not work_order:
-            raise HTTPException(status_code=404, detail="أمر الشغل غير موجود")
-            
         # Get the invoice
-        invoice = await db.invoices.find_one({"id": invoice_id})
+        invoice = await db.invoices.find_one({"id": invoice_id}, {"_id": 0})
         if not invoice:
             raise HTTPException(status_code=404, detail="الفاتورة غير موجودة")
             
-        # Clean invoice data
-        if "_id" in invoice:
-            del invoice["_id"]
-            
-        # Update work order with new invoice
-        current_invoices = work_order.get("invoices", [])
-        
-        # Check if invoice already exists in work order
-        if any(inv.get("id") == invoice_id for inv in current_invoices):
+        # Append atomically - skipped if the invoice is already in the work order
+        if not await push_invoices_to_work_order(work_order_id, [invoice]):
+            if not await db.work_orders.find_one({"id": work_order_id}, {"_id": 0, "id": 1}):
+                raise HTTPException(status_code=404, detail="أمر الشغل غير موجود")
             raise HTTPException(status_code=400, detail="الفاتورة موجودة بالفعل في أمر الشغل")
             
-        current_invoices.append(invoice)
-        
-        # Update totals
-        new_total_amount = work_order.get("total_amount", 0) + invoice.get("total_amount", 0)
-        new_total_items = work_order.get("total_items", 0) + len(invoice.get("items", []))
-        
-        # Update in database
-        result = await db.work_orders.update_one(
-            {"id": work_order_id},
-            {"$set": {
-                "invoices": current_invoices,
-                "total_amount": new_total_amount,
-                "total_items": new_total_items
-            }}
-        )
-        
-        if result.matched_count == 0:
-            raise HTTPException(status_code=404, detail="فشل في تحديث أمر الشغل")
-            
         return {"message": "تم إضافة الفاتورة إلى أمر الشغل بنجاح"}
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -1688,12 +4254,122 @@ async def get_treasury_transactions():
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@api_router.get("/treasury/accounts/{account_id}/statement")
+async def get_account_statement(
+    account_id: str,
+    response: Response,
+    company_id: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    limit: int = Query(100, ge=1, le=500),
+    after: Optional[str] = None
+):
+    """Account statement with a running balance, oldest first.
+    
+    The first page starts from the account's ledger balance at date_from, read from
+    the nearest snapshot; later pages continue from the balance carried in the
+    X-Next-Cursor cursor, so no page scans earlier history.
+    """
+    try:
+        date_from, date_to = to_naive_utc(date_from), to_naive_utc(date_to)
+        match: Dict[str, Any] = {"account_id": account_id}
+        if company_id:
+            match["company_id"] = company_id
+        
+        # The live ledger starts at the latest reset; earlier postings are archived
+        opening_snapshot = await db.treasury_snapshots.find_one(
+            {"snapshot_type": "opening"}, {"_id": 0, "closed_at": 1}, sort=[("closed_at", -1)]
+        )
+        if opening_snapshot and date_from and date_from < opening_snapshot["closed_at"]:
+            date_from = opening_snapshot["closed_at"]
+        
+        date_filter = _date_range(date_from, date_to, inclusive=True)
+        if date_filter:
+            match["date"] = date_filter
+        
+        if after:
+            cursor = decode_page_cursor(after, ["date", "id", "balance"])
+            opening_balance = cursor["balance"]
+            match["$or"] = [
+                {"date": {"$gt": cursor["date"]}},
+                {"date": cursor["date"], "id": {"$gt": cursor["id"]}}
+            ]
+        elif date_from:
+            ledger = await compute_ledger_balances(date_from, inclusive=False, company_id=company_id, account_id=account_id)
+            opening_balance = sum(entry["balance"] for entry in ledger.values())
+        else:
+            opening_balance = 0
+        
+        transactions = await db.treasury_transactions.aggregate([
+            {"$match": match},
+            {"$sort": {"date": 1, "id": 1}},
+            {"$limit": limit + 1},
+            {"$setWindowFields": {
+                "sortBy": {"date": 1, "id": 1},
+                "output": {
+                    "running_total": {"$sum": SIGNED_AMOUNT, "window": {"documents": ["unbounded", "current"]}}
+                }
+            }},
+            {"$addFields": {
+                "signed_amount": SIGNED_AMOUNT,
+                "running_balance": {"$add": [opening_balance, "$running_total"]}
+            }},
+            {"$project": {"_id": 0, "running_total": 0}}
+        ]).to_list(limit + 1)
+        
+        if len(transactions) > limit:
+            transactions = transactions[:limit]
+            last = transactions[-1]
+            response.headers["X-Next-Cursor"] = encode_page_cursor({
+                "date": last["date"], "id": last["id"], "balance": last["running_balance"]
+            })
+        
+        return {
+            "account_id": account_id,
+            "company_id": company_id,
+            "opening_balance": opening_balance,
+            "closing_balance": transactions[-1]["running_balance"] if transactions else opening_balance,
+            "transactions": transactions
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/treasury/cashflow")
+async def get_treasury_cashflow(
+    granularity: str = Query("day", pattern="^(day|week|month)$"),
+    date_from: Optional[datetime] = Query(None, alias="from"),
+    date_to: Optional[datetime] = Query(None, alias="to"),
+    company_id: Optional[str] = None
+):
+    """Income, expense and transfer totals per account for each day, week or month"""
+    try:
+        date_from, date_to = to_naive_utc(date_from), to_naive_utc(date_to)
+        # The live ledger starts at the latest reset; earlier postings are archived
+        opening_snapshot = await db.treasury_snapshots.find_one(
+            {"snapshot_type": "opening"}, {"_id": 0, "closed_at": 1}, sort=[("closed_at", -1)]
+        )
+        if opening_snapshot and (not date_from or date_from < opening_snapshot["closed_at"]):
+            date_from = opening_snapshot["closed_at"]
+        
+        rows = await get_cashflow(granularity, date_from, date_to, company_id)
+        return {
+            "granularity": granularity,
+            "from": date_from,
+            "to": date_to,
+            "company_id": company_id,
+            "rows": rows
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @api_router.post("/treasury/transactions")
 async def create_treasury_transaction(transaction: TreasuryTransactionCreate):
     """Create a new treasury transaction"""
     try:
         transaction_obj = TreasuryTransaction(**transaction.dict())
-        await db.treasury_transactions.insert_one(transaction_obj.dict())
+        await post_treasury_transactions([transaction_obj])
         
         transaction_dict = transaction_obj.dict()
         if "_id" in transaction_dict:
@@ -1704,8 +4380,14 @@ async def create_treasury_transaction(transaction: TreasuryTransactionCreate):
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.post("/treasury/transfer")
-async def transfer_funds(transfer: TransferRequest):
+async def transfer_funds(
+    transfer: TransferRequest,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
     """Transfer funds between accounts"""
+    return await run_idempotent("treasury_transfer", idempotency_key, transfer, lambda: apply_transfer(transfer))
+
+async def apply_transfer(transfer: TransferRequest):
     try:
         # Create outgoing transaction
         out_transaction = TreasuryTransaction(
@@ -1729,9 +4411,8 @@ async def transfer_funds(transfer: TransferRequest):
         # Link transactions
         out_transaction.related_transaction_id = in_transaction.id
         
-        # Save both transactions
-        await db.treasury_transactions.insert_one(out_transaction.dict())
-        await db.treasury_transactions.insert_one(in_transaction.dict())
+        # Save both legs together
+        await post_treasury_transactions([out_transaction, in_transaction], balanced=True)
         
         return {"message": "تم التحويل بنجاح", "transfer_id": out_transaction.id}
         
@@ -1739,62 +4420,101 @@ async def transfer_funds(transfer: TransferRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.get("/treasury/balances")
-async def get_account_balances():
-    """Get current balances for all accounts"""
-    try:
-        # Get all transactions
-        transactions = await db.treasury_transactions.find().to_list(10000)
-        
-        # Get invoice data for automatic transactions
-        invoices = await db.invoices.find().to_list(1000)
-        expenses = await db.expenses.find().to_list(1000)
-        
-        # Calculate balances
-        account_balances = {
-            'cash': 0,
-            'vodafone_elsawy': 0,
-            'vodafone_wael': 0,
-            'deferred': 0,
-            'instapay': 0,
-            'yad_elsawy': 0
-        }
-        
-        # Add invoice amounts (only for deferred invoices that don't have treasury transactions)
-        payment_method_map = {
-            'نقدي': 'cash',
-            'فودافون كاش محمد الصاوي': 'vodafone_elsawy',
-            'فودافون كاش وائل محمد': 'vodafone_wael',
-            'آجل': 'deferred',
-            'انستاباي': 'instapay',
-            'يد الصاوي': 'yad_elsawy'
-        }
+async def get_account_balances(company_id: Optional[str] = None, as_of: Optional[datetime] = None):
+    """Get current balances for all accounts, optionally for a single company or as of a past date"""
+    try:
+        if as_of:
+            return await compute_account_balances_as_of(to_naive_utc(as_of), company_id)
         
-        # Only add deferred invoices directly (non-deferred invoices are handled by treasury transactions)
-        for invoice in invoices:
-            if invoice.get('payment_method') == 'آجل':
-                account_balances['deferred'] += invoice.get('total_amount', 0)
+        account_balances = {account_id: 0 for account_id in TREASURY_ACCOUNTS}
         
-        # Subtract expenses from cash
-        for expense in expenses:
-            account_balances['cash'] -= expense.get('amount', 0)
+        query = {"account_id": {"$in": TREASURY_ACCOUNTS}}
+        if company_id:
+            query["company_id"] = company_id
         
-        # Apply manual transactions
-        for transaction in transactions:
-            account_id = transaction.get('account_id')
-            if account_id in account_balances:
-                amount = transaction.get('amount', 0)
-                transaction_type = transaction.get('transaction_type')
-                
-                if transaction_type in ['income', 'transfer_in']:
-                    account_balances[account_id] += amount
-                elif transaction_type in ['expense', 'transfer_out']:
-                    account_balances[account_id] -= amount
+        async for balance in db.treasury_balances.find(query, {"_id": 0, "account_id": 1, "balance": 1}):
+            account_balances[balance["account_id"]] += balance.get("balance", 0)
         
         return account_balances
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@api_router.post("/treasury/closings")
+async def create_treasury_closing(closed_at: Optional[datetime] = None, username: Optional[str] = None):
+    """Close the treasury now (or at closed_at), storing every account's balance"""
+    try:
+        now = datetime.utcnow()
+        closed_at = to_naive_utc(closed_at) or now
+        # Postings dated after a future closing could still land inside it
+        if closed_at > now:
+            raise HTTPException(status_code=400, detail="لا يمكن إنشاء إقفال بتاريخ مستقبلي")
+        snapshot = await create_treasury_snapshot(closed_at, "closing", created_by=username)
+        return snapshot
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/treasury/snapshots")
+async def get_treasury_snapshots(limit: int = Query(30, ge=1, le=365), snapshot_type: Optional[str] = None):
+    """Latest closing and opening snapshots, newest first"""
+    try:
+        query = {"snapshot_type": snapshot_type} if snapshot_type else {}
+        return await db.treasury_snapshots.find(query, {"_id": 0}).sort("closed_at", -1).limit(limit).to_list(limit)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/treasury/duplicates")
+async def get_treasury_duplicates(status: str = "open", limit: int = Query(100, ge=1, le=1000)):
+    """Duplicate transaction groups found by the incremental scan"""
+    try:
+        findings = await db.treasury_duplicates.find({"status": status}).sort("last_detected_at", -1).limit(limit).to_list(limit)
+        for finding in findings:
+            finding["id"] = finding.pop("_id")
+        return findings
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/treasury/duplicates/scan")
+async def run_treasury_duplicate_scan():
+    """Run the incremental duplicate scan now"""
+    try:
+        return await scan_treasury_duplicates()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.put("/treasury/duplicates/{finding_id}/dismiss")
+async def dismiss_treasury_duplicate(finding_id: str, username: Optional[str] = None):
+    """Mark a duplicate group as reviewed"""
+    try:
+        result = await db.treasury_duplicates.update_one(
+            {"_id": finding_id},
+            {"$set": {"status": "dismissed", "dismissed_by": username, "dismissed_at": datetime.utcnow()}}
+        )
+        if result.matched_count == 0:
+            raise HTTPException(status_code=404, detail="السجل غير موجود")
+        return {"message": "تم تجاهل التكرار"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/treasury/balances/reconcile")
+async def reconcile_account_balances(apply: bool = True):
+    """Rebuild the stored account balances from the ledger and report any drift"""
+    try:
+        drift = await reconcile_treasury_balances(apply=apply)
+        if drift:
+            logger.warning(f"Treasury balance drift found on {len(drift)} accounts")
+        return {
+            "message": "تمت مطابقة أرصدة الخزينة" if not drift else f"تم العثور على فروقات في {len(drift)} حساب",
+            "applied": apply,
+            "drift": drift
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 # Suppliers endpoints
 @api_router.get("/suppliers", response_model=List[Supplier])
 async def get_suppliers():
@@ -1984,8 +4704,21 @@ async def create_supplier_transaction(transaction: SupplierTransactionCreate):
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.post("/supplier-payment")
-async def pay_supplier(supplier_id: str, amount: float, payment_method: str = "cash"):
+async def pay_supplier(
+    supplier_id: str,
+    amount: float,
+    payment_method: str = "cash",
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
     """Pay a supplier and deduct from treasury"""
+    return await run_idempotent(
+        "supplier_payment",
+        idempotency_key,
+        {"supplier_id": supplier_id, "amount": amount, "payment_method": payment_method},
+        lambda: apply_supplier_payment(supplier_id, amount, payment_method)
+    )
+
+async def apply_supplier_payment(supplier_id: str, amount: float, payment_method: str):
     try:
         # Get supplier
         supplier = await db.suppliers.find_one({"id": supplier_id})
@@ -1999,7 +4732,8 @@ async def pay_supplier(supplier_id: str, amount: float, payment_method: str = "c
             transaction_type="payment",
             amount=amount,
             description=f"دفع للمورد {supplier['name']}",
-            payment_method=payment_method
+            payment_method=payment_method,
+            payment_number=await next_sequence_number(supplier.get("company_id"), "supplier_payment")
         )
         await db.supplier_transactions.insert_one(supplier_transaction.dict())
         
@@ -2020,9 +4754,10 @@ async def pay_supplier(supplier_id: str, amount: float, payment_method: str = "c
             transaction_type="expense",
             amount=amount,
             description=f"دفع للمورد {supplier['name']}",
-            reference=f"supplier_payment_{supplier_transaction.id}"
+            reference=f"supplier_payment_{supplier_transaction.id}",
+            unique_reference=True
         )
-        await db.treasury_transactions.insert_one(treasury_transaction.dict())
+        await post_treasury_transactions([treasury_transaction])
         
         return {"message": "تم دفع المبلغ للمورد بنجاح", "payment_id": supplier_transaction.id}
     except Exception as e:
@@ -2030,23 +4765,16 @@ async def pay_supplier(supplier_id: str, amount: float, payment_method: str = "c
 
 # Inventory Management endpoints
 @api_router.get("/inventory", response_model=List[InventoryItem])
-async def get_inventory():
-    """Get all inventory items sorted by material type priority then size"""
+async def get_inventory(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MATERIAL_PAGE_MAX_LIMIT),
+    after: Optional[str] = None
+):
+    """Get all inventory items sorted by material type priority then size, paged like /raw-materials"""
     try:
-        # Define material type priority order: BUR-NBR-BT-BOOM-VT
-        material_priority = {'BUR': 1, 'NBR': 2, 'BT': 3, 'BOOM': 4, 'VT': 5}
-        
-        # Get all items first
-        items = await db.inventory_items.find({}).to_list(None)
-        
-        # Sort by material type priority, then by diameter
-        sorted_items = sorted(items, key=lambda x: (
-            material_priority.get(x.get('material_type', ''), 6),  # Material priority
-            x.get('inner_diameter', 0),  # Then inner diameter
-            x.get('outer_diameter', 0)   # Then outer diameter
-        ))
-        
-        return sorted_items
+        return await list_materials_in_order(db.inventory_items, {}, response, limit, after)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -2096,7 +4824,7 @@ async def create_inventory_item(item: InventoryItemCreate):
                 detail=f"عنصر بنفس المواصفات موجود بالفعل: {item.material_type} - {item.inner_diameter}x{item.outer_diameter}"
             )
         
-        inventory_item = InventoryItem(**item.dict())
+        inventory_item = InventoryItem(**item.dict(), priority=material_priority(item.material_type))
         await db.inventory_items.insert_one(inventory_item.dict())
         
         # Create initial transaction
@@ -2130,6 +4858,7 @@ async def update_inventory_item(item_id: str, item: InventoryItemCreate):
             {
                 "$set": {
                     **item.dict(),
+                    "priority": material_priority(item.material_type),
                     "last_updated": datetime.utcnow()
                 }
             }
@@ -2313,17 +5042,21 @@ async def reset_treasury(username: str):
         if username != "Elsawy":
             raise HTTPException(status_code=403, detail="غير مصرح لك بتنفيذ هذه العملية")
         
-        # Get count of records before deletion for logging
-        treasury_count = await db.treasury_transactions.count_documents({})
+        # Start a new opening snapshot first, so postings not archived yet no longer count
+        reset_at = datetime.utcnow()
+        opening_snapshot = await create_treasury_snapshot(reset_at, "opening", created_by=username)
         
-        # Delete all treasury transactions
-        treasury_result = await db.treasury_transactions.delete_many({})
+        # Move the old treasury transactions to the archive
+        archived_count = await archive_treasury_transactions(reset_at, opening_snapshot["id"])
+        await reconcile_treasury_balances()
         
         return {
-            "message": "تم مسح جميع بيانات الخزينة بنجاح",
-            "deleted_treasury_transactions": treasury_result.deleted_count,
+            "message": "تم أرشفة بيانات الخزينة وبدء رصيد افتتاحي جديد",
+            "deleted_treasury_transactions": archived_count,
+            "archived_treasury_transactions": archived_count,
+            "opening_snapshot_id": opening_snapshot["id"],
             "reset_by": username,
-            "reset_at": datetime.utcnow().isoformat()
+            "reset_at": reset_at.isoformat()
         }
     except Exception as e:
         if isinstance(e, HTTPException):
@@ -2380,49 +5113,59 @@ async def change_invoice_payment_method(
         if old_payment_method == "آجل" and new_payment_method != "آجل":
             # Create income transaction for the new payment method
             new_transaction = TreasuryTransaction(
+                company_id=invoice.get("company_id"),
                 account_id=new_account_id,
                 transaction_type="income",
                 amount=invoice_amount,
                 description=f"تحويل من آجل إلى {new_payment_method} - {transfer_reference}",
                 reference=f"تحويل-{invoice.get('invoice_number')}"
             )
-            await db.treasury_transactions.insert_one(new_transaction.dict())
+            # The income leg and the deferred balance it replaces move together
+            await post_treasury_transactions(
+                [new_transaction], balanced=True,
+                balance_deltas=[(invoice.get("company_id"), "deferred", -invoice_amount)]
+            )
             transactions_created.append("income")
             
         # Case 2: Converting FROM immediate payment method TO deferred
         elif old_payment_method != "آجل" and new_payment_method == "آجل":
             # Create expense transaction to remove from old payment method
             old_transaction = TreasuryTransaction(
+                company_id=invoice.get("company_id"),
                 account_id=old_account_id,
                 transaction_type="expense",
                 amount=invoice_amount,
                 description=f"تحويل من {old_payment_method} إلى آجل - {transfer_reference}",
                 reference=f"تحويل-{invoice.get('invoice_number')}"
             )
-            await db.treasury_transactions.insert_one(old_transaction.dict())
+            await post_treasury_transactions(
+                [old_transaction], balanced=True,
+                balance_deltas=[(invoice.get("company_id"), "deferred", invoice_amount)]
+            )
             transactions_created.append("expense")
             
         # Case 3: Converting between immediate payment methods (not deferred)
         elif old_payment_method != "آجل" and new_payment_method != "آجل":
             # Remove from old account
             old_transaction = TreasuryTransaction(
+                company_id=invoice.get("company_id"),
                 account_id=old_account_id,
                 transaction_type="expense",
                 amount=invoice_amount,
                 description=f"خصم لتحويل طريقة الدفع - {transfer_reference}",
                 reference=f"تحويل-{invoice.get('invoice_number')}"
             )
-            await db.treasury_transactions.insert_one(old_transaction.dict())
             
             # Add to new account
             new_transaction = TreasuryTransaction(
+                company_id=invoice.get("company_id"),
                 account_id=new_account_id,
                 transaction_type="income",
                 amount=invoice_amount,
                 description=f"إضافة من تحويل طريقة الدفع - {transfer_reference}",
                 reference=f"تحويل-{invoice.get('invoice_number')}"
             )
-            await db.treasury_transactions.insert_one(new_transaction.dict())
+            await post_treasury_transactions([old_transaction, new_transaction], balanced=True)
             transactions_created.extend(["expense", "income"])
             
         # Case 4: Converting from deferred to deferred (should not happen, but handle gracefully)
@@ -2443,6 +5186,8 @@ async def change_invoice_payment_method(
             {"id": invoice_id},
             {"$set": update_data}
         )
+        await adjust_daily_rollups([invoice_rollup_delta(invoice, -1), invoice_rollup_delta({**invoice, **update_data}, 1)])
+        await invalidate_dashboard_stats()
         
         return {
             "message": f"تم تحويل طريقة الدفع من {old_payment_method} إلى {new_payment_method}",
@@ -2468,76 +5213,74 @@ async def cancel_invoice(invoice_id: str, username: str = None):
         if not invoice:
             raise HTTPException(status_code=404, detail="الفاتورة غير موجودة")
         
-        # Restore materials to inventory for each item
-        for item in invoice.get("items", []):
-            if item.get("product_type") == "manufactured":
-                # Handle multi-material restoration
-                if item.get("selected_materials"):
-                    for material_info in item.get("selected_materials", []):
-                        raw_material = await db.raw_materials.find_one({
-                            "unit_code": material_info.get("unit_code"),
-                            "inner_diameter": material_info.get("inner_diameter"),
-                            "outer_diameter": material_info.get("outer_diameter")
-                        })
-                        
-                        if raw_material:
-                            seals_to_restore = material_info.get("seals_count", 0)
-                            material_to_restore = seals_to_restore * (item.get("height", 0) + 2)
-                            
-                            # Add material back
-                            await db.raw_materials.update_one(
-                                {"id": raw_material["id"]},
-                                {"$inc": {"height": material_to_restore}}
-                            )
-                            
-                            print(f"✅ تم استرداد {material_to_restore} مم للخامة {raw_material.get('unit_code')}")
+        # Outbox tasks claimed while the flag is live see it and back off; wait for one already
+        # running. The flag lapses on its own if this request dies before settling.
+        await db.invoices.update_one({"id": invoice_id}, {"$set": {
+            "cancelling_until": datetime.utcnow() + timedelta(seconds=OUTBOX_LEASE_SECONDS)
+        }})
+        try:
+            if not await wait_for_running_outbox_tasks(invoice_id):
+                raise HTTPException(status_code=409, detail="الفاتورة قيد المعالجة، أعد المحاولة")
+            
+            # No side effect can land any more: unfinished ones are dropped instead of reversed
+            tasks = await db.outbox.find({"invoice_id": invoice_id}, {"_id": 0, "task_type": 1, "status": 1}).to_list(None)
+            task_status = {task["task_type"]: task["status"] for task in tasks}
+            await db.outbox.update_many(
+                {"invoice_id": invoice_id, "status": {"$in": ["pending", "processing", "failed"]}},
+                {"$set": {"status": "cancelled"}}
+            )
+            
+            def effect_applied(task_type):
+                # Done tasks are purged after a week and invoices from before the outbox have none
+                return task_status.get(task_type, "done") == "done"
+            
+            # Give back exactly the deductions recorded for this invoice
+            restored_materials = []
+            if invoice.get("material_ledger"):
+                restored_materials = await restore_invoice_materials(invoice, username)
+            elif effect_applied("deduct_materials"):
+                restored_materials = await restore_legacy_invoice_materials(invoice, username)
+            
+            # Reverse the treasury income only if it was posted
+            reversal_legs = []
+            treasury_reversed = invoice.get("payment_method") != "آجل" and (
+                effect_applied("post_invoice_income") or
+                await db.treasury_transactions.find_one({"reference": f"invoice_{invoice_id}"}, {"_id": 1}) is not None
+            )
+            if treasury_reversed:
+                payment_method_mapping = {
+                    "نقدي": "cash",
+                    "آجل": "deferred",
+                    "فودافون كاش محمد الصاوي": "vodafone_elsawy",
+                    "فودافون كاش وائل محمد": "vodafone_wael", 
+                    "انستاباي": "instapay",
+                    "يد الصاوي": "yad_elsawy"
+                }
                 
-                # Handle single material restoration
-                elif item.get("material_details"):
-                    material_details = item.get("material_details")
-                    raw_material = await db.raw_materials.find_one({
-                        "unit_code": material_details.get("unit_code"),
-                        "inner_diameter": material_details.get("inner_diameter"),
-                        "outer_diameter": material_details.get("outer_diameter")
-                    })
-                    
-                    if raw_material:
-                        material_to_restore = item.get("quantity", 0) * (item.get("height", 0) + 2)
-                        
-                        # Add material back
-                        await db.raw_materials.update_one(
-                            {"id": raw_material["id"]},
-                            {"$inc": {"height": material_to_restore}}
-                        )
-                        
-                        print(f"✅ تم استرداد {material_to_restore} مم للخامة {raw_material.get('unit_code')}")
-        
-        # Remove treasury transaction if not deferred
-        if invoice.get("payment_method") != "آجل":
-            payment_method_mapping = {
-                "نقدي": "cash",
-                "آجل": "deferred",
-                "فودافون كاش محمد الصاوي": "vodafone_elsawy",
-                "فودافون كاش وائل محمد": "vodafone_wael", 
-                "انستاباي": "instapay",
-                "يد الصاوي": "yad_elsawy"
-            }
+                account_id = payment_method_mapping.get(invoice.get("payment_method"))
+                if account_id:
+                    # Create negative transaction to reverse the income
+                    reversal_transaction = TreasuryTransaction(
+                        company_id=invoice.get("company_id"),
+                        account_id=account_id,
+                        transaction_type="expense",
+                        amount=invoice.get("total_amount", 0),
+                        description=f"إلغاء فاتورة {invoice.get('invoice_number')}",
+                        reference=f"إلغاء-{invoice.get('invoice_number')}",
+                        balance=-invoice.get("total_amount", 0)
+                    )
+                    reversal_legs.append(reversal_transaction)
+            # The reversal and the deferred balance of the invoice are written together
+            await post_treasury_transactions(reversal_legs, balance_deltas=deferred_invoice_deltas(invoice, -1))
             
-            account_id = payment_method_mapping.get(invoice.get("payment_method"))
-            if account_id:
-                # Create negative transaction to reverse the income
-                reversal_transaction = TreasuryTransaction(
-                    account_id=account_id,
-                    transaction_type="expense",
-                    amount=invoice.get("total_amount", 0),
-                    description=f"إلغاء فاتورة {invoice.get('invoice_number')}",
-                    reference=f"إلغاء-{invoice.get('invoice_number')}",
-                    balance=-invoice.get("total_amount", 0)
-                )
-                await db.treasury_transactions.insert_one(reversal_transaction.dict())
-        
-        # Remove invoice from database
-        await db.invoices.delete_one({"id": invoice_id})
+            # Remove invoice from database
+            await db.invoices.delete_one({"id": invoice_id})
+            await adjust_daily_rollups([invoice_rollup_delta(invoice, -1)])
+            await invalidate_dashboard_stats()
+        except Exception:
+            # The invoice stays; let its outbox tasks run again
+            await db.invoices.update_one({"id": invoice_id}, {"$unset": {"cancelling_until": ""}})
+            raise
         
         # Remove from work orders
         await db.work_orders.update_many(
@@ -2548,8 +5291,12 @@ async def cancel_invoice(invoice_id: str, username: str = None):
         return {
             "message": f"تم إلغاء الفاتورة {invoice.get('invoice_number')} واسترداد المواد",
             "invoice_number": invoice.get("invoice_number"),
-            "materials_restored": True,
-            "treasury_reversed": invoice.get("payment_method") != "آجل"
+            "materials_restored": bool(restored_materials),
+            "restored_materials": [
+                {"unit_code": movement["unit_code"], "height": movement["height_change"], "seals": movement["seals"]}
+                for movement in restored_materials
+            ],
+            "treasury_reversed": treasury_reversed
         }
         
     except Exception as e:
@@ -2710,7 +5457,8 @@ async def import_inventory_excel(file: UploadFile = File(...)):
                         outer_diameter=float(row['outer_diameter']),
                         available_pieces=int(row['available_pieces']),
                         min_stock_level=int(row.get('min_stock_level', 2)),
-                        notes=str(row.get('notes', ''))
+                        notes=str(row.get('notes', '')),
+                        priority=material_priority(row['material_type'])
                     )
                     await db.inventory_items.insert_one(inventory_item.dict())
                 
@@ -2820,14 +5568,17 @@ async def import_raw_materials_excel(file: UploadFile = File(...)):
                     height=float(row['height']),
                     pieces_count=int(row['pieces_count']),
                     unit_code=str(row['unit_code']),
-                    cost_per_mm=float(row['cost_per_mm'])
+                    cost_per_mm=float(row['cost_per_mm']),
+                    priority=material_priority(row['material_type'])
                 )
                 await db.raw_materials.insert_one(raw_material.dict())
+                await raise_unit_code_counters([raw_material.dict()])
                 imported_count += 1
                 
             except Exception as e:
                 errors.append(f"صف {index + 2}: {str(e)}")
         
+        invalidate_material_index()
         return {
             "message": f"تم استيراد {imported_count} مادة خام بنجاح",
             "imported_count": imported_count,
@@ -2922,14 +5673,17 @@ async def bulk_import_raw_materials(data: dict):
                     raw_material_dict["id"] = str(uuid.uuid4())
                 if "created_at" not in raw_material_dict:
                     raw_material_dict["created_at"] = datetime.utcnow()
+                raw_material_dict["priority"] = material_priority(raw_material_dict.get("material_type"))
                 
                 await db.raw_materials.insert_one(raw_material_dict)
+                await raise_unit_code_counters([raw_material_dict])
                 imported_count += 1
                 
             except Exception as e:
                 print(f"Error importing raw material: {e}")
                 skipped_count += 1
         
+        invalidate_material_index()
         return {
             "message": f"تم استيراد {imported_count} مادة خام، تم تخطي {skipped_count} مادة",
             "imported": imported_count,
@@ -2957,6 +5711,9 @@ async def bulk_import_invoices(data: dict):
                 # Create new invoice
                 invoice = Invoice(**item)
                 await db.invoices.insert_one(invoice.dict())
+                await adjust_deferred_invoice_balance(invoice.dict(), 1)
+                await adjust_daily_rollups([invoice_rollup_delta(invoice.dict(), 1)])
+                await invalidate_dashboard_stats()
                 imported_count += 1
                 
             except Exception as e:
@@ -2983,7 +5740,7 @@ async def bulk_import_treasury_transactions(data: dict):
             try:
                 # Create new treasury transaction
                 transaction = TreasuryTransaction(**item)
-                await db.treasury_transactions.insert_one(transaction.dict())
+                await post_treasury_transactions([transaction])
                 imported_count += 1
                 
             except Exception as e:
@@ -3015,7 +5772,7 @@ async def bulk_import_expenses(data: dict):
                     description=item.get("description", "مصروف مستورد"),
                     reference=item.get("reference", "استيراد")
                 )
-                await db.treasury_transactions.insert_one(expense_transaction.dict())
+                await post_treasury_transactions([expense_transaction])
                 imported_count += 1
                 
             except Exception as e:
@@ -3045,7 +5802,7 @@ async def bulk_import_revenues(data: dict):
                     description=item.get("description", "إيراد مستورد"),
                     reference=item.get("reference", "استيراد")
                 )
-                await db.treasury_transactions.insert_one(revenue_transaction.dict())
+                await post_treasury_transactions([revenue_transaction])
                 imported_count += 1
                 
             except Exception as e:
@@ -3182,6 +5939,7 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Configure logging
@@ -3191,8 +5949,71 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Indexes backing the atomic update paths; creation is idempotent
+async def ensure_indexes():
+    index_specs = [
+        (db.work_orders, [("work_date", 1)], {"name": "daily_work_date_unique", "unique": True, "partialFilterExpression": {"is_daily": True}}),
+        (db.work_orders, [("invoices.id", 1)], {"name": "work_order_invoice_ids"}),
+        (db.invoices, [("company_id", 1), ("date", -1), ("id", -1)], {"name": "invoices_company_date"}),
+        (db.invoices, [("company_id", 1), ("status", 1), ("date", -1), ("id", -1)], {"name": "invoices_company_status_date"}),
+        (db.invoices, [("company_id", 1), ("payment_method", 1), ("date", -1), ("id", -1)], {"name": "invoices_company_payment_date"}),
+        (db.invoices, [("company_id", 1), ("customer_id", 1), ("date", -1), ("id", -1)], {"name": "invoices_company_customer_date"}),
+        (db.invoices, [("company_id", 1), ("customer_name", 1), ("date", -1), ("id", -1)], {"name": "invoices_company_customer_name_date"}),
+        (db.invoices, [("company_id", 1), ("date", -1), ("id", -1), ("remaining_amount", 1)], {"name": "invoices_company_open_balance", "partialFilterExpression": {"remaining_amount": {"$gt": 0}}}),
+        (db.expenses, [("company_id", 1), ("date", -1)], {"name": "expenses_company_date"}),
+        (db.daily_rollups, [("company_id", 1), ("date", 1)], {"name": "daily_rollups_company_date"}),
+        (db.raw_material_movements, [("token", 1)], {"name": "raw_material_movements_token", "unique": True}),
+        (db.raw_material_movements, [("material_id", 1), ("created_at", -1), ("id", -1)], {"name": "raw_material_movements_material"}),
+        (db.raw_material_movements, [("reference_invoice_id", 1)], {"name": "raw_material_movements_invoice"}),
+        (db.daily_rollups, [("date", 1)], {"name": "daily_rollups_date"}),
+        (db.customers, [("company_id", 1)], {"name": "customers_company"}),
+        (db.raw_materials, [("holds.quote_id", 1)], {"name": "raw_materials_hold_quote"}),
+        (db.raw_materials, [("company_id", 1), ("priority", 1), ("inner_diameter", 1), ("outer_diameter", 1), ("id", 1)], {"name": "raw_materials_company_listing"}),
+        (db.inventory_items, [("priority", 1), ("inner_diameter", 1), ("outer_diameter", 1), ("id", 1)], {"name": "inventory_items_listing"}),
+        (db.outbox, [("status", 1), ("next_attempt_at", 1)], {"name": "outbox_due"}),
+        (db.outbox, [("invoice_id", 1)], {"name": "outbox_invoice"}),
+        (db.outbox, [("completed_at", 1)], {"name": "outbox_done_ttl", "expireAfterSeconds": 7 * 24 * 3600}),
+        (db.treasury_transactions, [("company_id", 1), ("account_id", 1), ("date", 1)], {"name": "treasury_company_account_date"}),
+        (db.treasury_transactions, [("date", 1)], {"name": "treasury_date"}),
+        (db.treasury_transactions, [("company_id", 1), ("date", 1)], {"name": "treasury_company_date"}),
+        (db.treasury_transactions, [("reference", 1)], {"name": "treasury_reference"}),
+        (db.treasury_transactions, [("reference", 1), ("unique_reference", 1)], {"name": "treasury_reference_unique", "unique": True, "partialFilterExpression": {"unique_reference": True}}),
+        (db.treasury_transactions, [("amount", 1), ("description", 1)], {"name": "treasury_amount_description"}),
+        (db.treasury_duplicates, [("status", 1), ("last_detected_at", -1)], {"name": "treasury_duplicates_status"}),
+        (db.treasury_transactions, [("account_id", 1), ("date", 1), ("id", 1)], {"name": "treasury_account_statement"}),
+        (db.treasury_transactions, [("created_at", 1)], {"name": "treasury_created_at"}),
+        (db.treasury_transactions_archive, [("company_id", 1), ("account_id", 1), ("date", 1)], {"name": "treasury_archive_company_account_date"}),
+        (db.treasury_snapshots, [("closed_at", -1), ("created_at", -1)], {"name": "treasury_snapshots_closed_at"}),
+        (db.treasury_snapshots, [("snapshot_type", 1), ("closed_at", 1)], {"name": "treasury_snapshots_closing_unique", "unique": True, "partialFilterExpression": {"snapshot_type": "closing"}}),
+        (db.treasury_balances, [("company_id", 1), ("account_id", 1)], {"name": "treasury_balances_company_account"}),
+        (db.idempotency_keys, [("created_at", 1)], {"name": "idempotency_keys_ttl", "expireAfterSeconds": IDEMPOTENCY_KEY_TTL_SECONDS}),
+    ]
+    for collection, keys, options in index_specs:
+        try:
+            await collection.create_index(keys, **options)
+        except Exception as e:
+            logger.warning(f"Could not create index {options.get('name')} on {collection.name}: {str(e)}")
+
+@app.on_event("startup")
+async def startup_db_client():
+    await ensure_indexes()
+    if await db.treasury_balances.estimated_document_count() == 0:
+        # First start with materialized balances: build them from the existing ledger
+        await reconcile_treasury_balances()
+    if await db.daily_rollups.estimated_document_count() == 0:
+        await rebuild_daily_rollups()
+    await seed_unit_code_counters()
+    await backfill_material_priorities()
+    app.state.outbox_worker = asyncio.create_task(run_outbox_worker())
+    app.state.treasury_closing_worker = asyncio.create_task(run_treasury_closing_worker())
+    app.state.duplicate_scan_worker = asyncio.create_task(run_duplicate_scan_worker())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for worker_name in ("outbox_worker", "treasury_closing_worker", "duplicate_scan_worker"):
+        worker = getattr(app.state, worker_name, None)
+        if worker:
+            worker.cancel()
     client.close()
 
 # Helper function to get company ID from request
@@ -3379,6 +6200,7 @@ async def migrate_existing_data_to_company(company_id: str):
             {"company_id": {"$exists": False}},
             {"$set": {"company_id": company_id}}
         )
+        invalidate_material_index()
         migration_results["raw_materials"] = raw_materials_result.modified_count
         
         # Migrate invoices
@@ -3394,6 +6216,8 @@ async def migrate_existing_data_to_company(company_id: str):
             {"$set": {"company_id": company_id}}
         )
         migration_results["treasury_transactions"] = treasury_result.modified_count
+        await invalidate_cashflow_cache()
+        await invalidate_dashboard_stats()
         
         # Migrate work orders
         work_orders_result = await db.work_orders.update_many(
@@ -3409,6 +6233,10 @@ async def migrate_existing_data_to_company(company_id: str):
         )
         migration_results["customers"] = customers_result.modified_count
         
+        # Balances and rollups are keyed by company, so rebuild them for the migrated data
+        await reconcile_treasury_balances()
+        await rebuild_daily_rollups()
+        
         return {
             "message": "تم ترحيل البيانات بنجاح",
             "company_id": company_id,
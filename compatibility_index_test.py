@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Test for the in-memory compatibility index
+- Every compatible material is inside the diameter window and belongs to the company
+- A change to a material shows up in the next check
+"""
+
+import time
+import requests
+
+BACKEND_URL = "https://seal-inventory.preview.emergentagent.com/api"
+
+def get_company_id():
+    companies = requests.get(f"{BACKEND_URL}/companies").json()
+    return companies[0]["id"] if companies else None
+
+def check(company_id, material, quote_id=None):
+    response = requests.post(f"{BACKEND_URL}/compatibility-check", params={"company_id": company_id}, json={
+        "seal_type": "RSL",
+        "material_type": material["material_type"],
+        "inner_diameter": material["inner_diameter"],
+        "outer_diameter": material["outer_diameter"],
+        "height": 5,
+        "quote_id": quote_id
+    })
+    return response.json()["compatible_materials"] if response.status_code == 200 else None
+
+def test_results_inside_window(company_id, material):
+    """Results respect the 10% window and the company"""
+    print("Testing compatibility window...")
+
+    started = time.time()
+    results = check(company_id, material)
+    elapsed = time.time() - started
+    if results is None:
+        print("❌ Compatibility check failed")
+        return False
+
+    for result in results:
+        if (result["inner_diameter"] > material["inner_diameter"] * 1.1 or
+                result["outer_diameter"] < material["outer_diameter"] * 0.9 or
+                result.get("company_id") not in (company_id, None)):
+            print(f"❌ {result['unit_code']} is outside the window")
+            return False
+
+    print(f"✅ {len(results)} compatible materials in {elapsed * 1000:.0f} ms")
+    return True
+
+def test_change_is_visible(company_id, material):
+    """A reservation is reflected by the next check"""
+    print("Testing index refresh after a change...")
+
+    quote_id = f"index-test-{int(time.time())}"
+    response = requests.post(f"{BACKEND_URL}/material-reservations", json={
+        "quote_id": quote_id,
+        "material_id": material["id"],
+        "seals_count": 1,
+        "seal_height": 5
+    })
+    if response.status_code != 200:
+        print(f"⚠️ Could not reserve: HTTP {response.status_code}")
+        return True
+
+    results = check(company_id, material) or []
+    match = next((r for r in results if r["id"] == material["id"]), None)
+    requests.delete(f"{BACKEND_URL}/material-reservations/{quote_id}")
+    if match and match["reserved_height"] < 7:
+        print(f"❌ Reservation not reflected: {match['reserved_height']} mm reserved")
+        return False
+
+    print("✅ Change visible in the next check")
+    return True
+
+if __name__ == "__main__":
+    print("🧭 Compatibility Index Test")
+    print("=" * 40)
+
+    company_id = get_company_id()
+    materials = requests.get(f"{BACKEND_URL}/raw-materials", params={"company_id": company_id}).json()
+    material = next((m for m in materials if m["height"] >= 40), None)
+    window_ok = test_results_inside_window(company_id, material) if material else False
+    change_ok = test_change_is_visible(company_id, material) if material else False
+
+    if window_ok and change_ok:
+        print("\n✅ Compatibility index working!")
+    else:
+        print("\n❌ Compatibility index needs work")
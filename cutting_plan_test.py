@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Test for the cutting-plan optimizer
+- Every planned cut leaves 0 mm or a usable remainder of at least 15 mm
+- The plan's selected_materials are accepted by invoice creation as they are
+"""
+
+import requests
+
+BACKEND_URL = "https://seal-inventory.preview.emergentagent.com/api"
+
+def get_company_id():
+    companies = requests.get(f"{BACKEND_URL}/companies").json()
+    return companies[0]["id"] if companies else None
+
+def get_plan(company_id, material):
+    response = requests.post(f"{BACKEND_URL}/cutting-plan", params={"company_id": company_id}, json={
+        "material_type": material["material_type"],
+        "inner_diameter": material["inner_diameter"],
+        "outer_diameter": material["outer_diameter"],
+        "height": 5,
+        "quantity": 3
+    })
+    if response.status_code != 200:
+        print(f"❌ Cutting plan failed: HTTP {response.status_code} - {response.text}")
+        return None
+    return response.json()
+
+def test_plan_respects_remainder_rule(company_id, material):
+    """No planned cut leaves an unusable 1-14 mm remainder"""
+    print("Testing cutting plan remainders...")
+
+    plan = get_plan(company_id, material)
+    if plan is None:
+        return None
+
+    for selected in plan["selected_materials"]:
+        remaining = selected["height"] - selected["seals_count"] * plan["consumption_per_seal"]
+        if 0 < remaining < 15:
+            print(f"❌ {selected['unit_code']} would keep {remaining} mm")
+            return None
+    if plan["seals_planned"] + plan["shortfall"] != plan["seals_requested"]:
+        print("❌ Planned seals and shortfall do not add up")
+        return None
+
+    print(f"✅ {plan['seals_planned']} seals from {len(plan['selected_materials'])} materials, {plan['total_leftover']} mm left")
+    return plan
+
+def test_plan_creates_invoice(company_id, material, plan):
+    """An invoice item built from the plan is accepted"""
+    print("Testing invoice from a cutting plan...")
+
+    if not plan["selected_materials"]:
+        print("⚠️ Nothing to cut, skipping invoice")
+        return True
+    response = requests.post(f"{BACKEND_URL}/invoices", params={"company_id": company_id}, json={
+        "customer_name": "اختبار خطة القص",
+        "payment_method": "نقدي",
+        "items": [{
+            "seal_type": "RSL",
+            "material_type": material["material_type"],
+            "inner_diameter": material["inner_diameter"],
+            "outer_diameter": material["outer_diameter"],
+            "height": 5,
+            "quantity": plan["seals_planned"],
+            "unit_price": 1,
+            "total_price": plan["seals_planned"],
+            "selected_materials": plan["selected_materials"]
+        }]
+    })
+    if response.status_code != 200:
+        print(f"❌ Invoice failed: HTTP {response.status_code} - {response.text}")
+        return False
+
+    requests.delete(f"{BACKEND_URL}/invoices/{response.json()['id']}/cancel")
+    print("✅ Invoice created from plan and cancelled")
+    return True
+
+if __name__ == "__main__":
+    print("✂️ Cutting Plan Test")
+    print("=" * 40)
+
+    company_id = get_company_id()
+    materials = requests.get(f"{BACKEND_URL}/raw-materials", params={"company_id": company_id}).json()
+    material = materials[0] if materials else None
+    plan = test_plan_respects_remainder_rule(company_id, material) if material else None
+    invoice_ok = test_plan_creates_invoice(company_id, material, plan) if plan else False
+
+    if plan and invoice_ok:
+        print("\n✅ Cutting plan working!")
+    else:
+        print("\n❌ Cutting plan needs work")
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Test for append-only daily work order updates
+- Concurrent invoices must all land in today's daily work order
+- Adding the same invoice twice must not duplicate it
+"""
+
+import requests
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_URL = "https://seal-inventory.preview.emergentagent.com/api"
+
+def create_invoice(index):
+    invoice_data = {
+        "customer_name": f"عميل أمر الشغل {index}",
+        "items": [{
+            "product_type": "local",
+            "product_name": "منتج اختبار",
+            "quantity": 1,
+            "unit_price": 15.0,
+            "total_price": 15.0
+        }],
+        "payment_method": "آجل"
+    }
+    response = requests.post(f"{BACKEND_URL}/invoices", json=invoice_data)
+    return response.json() if response.status_code == 200 else None
+
+def get_daily_work_order():
+    today = datetime.now().strftime("%Y-%m-%d")
+    response = requests.get(f"{BACKEND_URL}/work-orders/daily/{today}")
+    return response.json() if response.status_code == 200 else None
+
+def test_concurrent_invoices_in_daily_work_order():
+    """10 invoices created at the same time must all appear in the daily work order"""
+    print("Testing concurrent appends to the daily work order...")
+
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        invoices = [invoice for invoice in executor.map(create_invoice, range(10)) if invoice]
+
+    work_order = get_daily_work_order()
+    if not work_order:
+        print("❌ Could not load today's daily work order")
+        return False
+
+    work_order_ids = {invoice.get("id") for invoice in work_order.get("invoices", [])}
+    missing = [invoice["invoice_number"] for invoice in invoices if invoice["id"] not in work_order_ids]
+    if missing:
+        print(f"❌ Invoices lost from the daily work order: {missing}")
+        return False
+
+    print(f"✅ All {len(invoices)} concurrent invoices are in work order {work_order.get('work_order_number')}")
+    return True
+
+def test_add_invoice_twice():
+    """Re-adding an invoice must not append a second copy"""
+    print("Testing duplicate add is ignored...")
+
+    invoice = create_invoice(99)
+    work_order = get_daily_work_order()
+    if not invoice or not work_order:
+        print("❌ Could not prepare test data")
+        return False
+
+    response = requests.put(
+        f"{BACKEND_URL}/work-orders/daily/{work_order['id']}/add-invoice",
+        params={"invoice_id": invoice["id"]}
+    )
+    if response.status_code != 200:
+        print(f"❌ Add invoice failed: HTTP {response.status_code}")
+        return False
+
+    work_order = get_daily_work_order()
+    copies = [entry for entry in work_order.get("invoices", []) if entry.get("id") == invoice["id"]]
+    if len(copies) != 1:
+        print(f"❌ Invoice appears {len(copies)} times in the work order")
+        return False
+
+    print("✅ Invoice appears exactly once")
+    return True
+
+if __name__ == "__main__":
+    print("📋 Daily Work Order Append Test")
+    print("=" * 40)
+
+    concurrent_ok = test_concurrent_invoices_in_daily_work_order()
+    duplicate_ok = test_add_invoice_twice()
+
+    if concurrent_ok and duplicate_ok:
+        print("\n✅ Daily work order appends working!")
+    else:
+        print("\n❌ Daily work order appends need work")
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Test for company-scoped dashboard stats
+- Stats are computed for a single company
+- A new expense shows up immediately despite the stats cache
+"""
+
+import requests
+
+BACKEND_URL = "https://seal-inventory.preview.emergentagent.com/api"
+
+def get_stats(company_id=None):
+    params = {"company_id": company_id} if company_id else {}
+    response = requests.get(f"{BACKEND_URL}/dashboard/stats", params=params)
+    if response.status_code != 200:
+        print(f"❌ Stats failed: HTTP {response.status_code} - {response.text}")
+        return None
+    return response.json()
+
+def get_company_id():
+    companies = requests.get(f"{BACKEND_URL}/companies").json()
+    return companies[0]["id"] if companies else None
+
+def test_company_stats_within_total(company_id):
+    """One company's numbers never exceed the totals of all companies"""
+    print("Testing company-scoped stats...")
+
+    company = get_stats(company_id)
+    overall = get_stats()
+    if company is None or overall is None:
+        return False
+
+    for field in ("total_sales", "total_expenses", "total_unpaid", "invoice_count", "customer_count"):
+        if company[field] > overall[field] + 0.01:
+            print(f"❌ {field}: company {company[field]} exceeds overall {overall[field]}")
+            return False
+
+    print(f"✅ Company stats: {company}")
+    return True
+
+def test_expense_invalidates_cache(company_id):
+    """Stats read right after an expense include it"""
+    print("Testing stats refresh after a new expense...")
+
+    before = get_stats(company_id)
+    response = requests.post(f"{BACKEND_URL}/expenses", params={"company_id": company_id}, json={
+        "description": "اختبار لوحة التحكم",
+        "amount": 11.0,
+        "category": "أخرى"
+    })
+    if response.status_code != 200:
+        print(f"❌ Could not create expense: HTTP {response.status_code}")
+        return False
+
+    after = get_stats(company_id)
+    if before is None or after is None or abs(after["total_expenses"] - before["total_expenses"] - 11.0) > 0.01:
+        print(f"❌ Expenses did not increase by 11.0: {before} -> {after}")
+        return False
+
+    print("✅ Stats refreshed after the expense")
+    return True
+
+if __name__ == "__main__":
+    print("📊 Dashboard Stats Test")
+    print("=" * 40)
+
+    company_id = get_company_id()
+    scoped_ok = test_company_stats_within_total(company_id)
+    cache_ok = test_expense_invalidates_cache(company_id)
+
+    if scoped_ok and cache_ok:
+        print("\n✅ Dashboard stats working!")
+    else:
+        print("\n❌ Dashboard stats need work")
@@ -1,4 +1,4 @@
-import React, { useState, useEffect, createContext, useContext } from 'react';
+import React, { useState, useEffect, useRef, createContext, useContext } from 'react';
 import './App.css';
 import axios from 'axios';
 import * as XLSX from 'xlsx';
@@ -1874,6 +1874,11 @@ const Dashboard = () => {
 };
 
 // Sales Component
+// كل فاتورة قيد الإعداد لها quote_id تحجز به الخامات المختارة حتى يتم حفظها
+const newQuoteId = () => (
+  window.crypto?.randomUUID ? window.crypto.randomUUID() : `${Date.now()}-${Math.random().toString(36).slice(2)}`
+);
+
 const Sales = () => {
   const [customers, setCustomers] = useState([]);
   const [newCustomer, setNewCustomer] = useState('');
@@ -1918,6 +1923,17 @@ const Sales = () => {
   const [measurementUnit, setMeasurementUnit] = useState('مم'); // بوصة أو مم
   const [wallHeight, setWallHeight] = useState(''); // ارتفاع الحيطة للـ W types
   const [clientType, setClientType] = useState(1); // نوع العميل للتسعير (1, 2, 3)
+  const [quoteId, setQuoteId] = useState(newQuoteId); // حجز الخامات لهذه الفاتورة
+  const quoteIdRef = useRef(quoteId);
+
+  // إلغاء حجز الخامات عند مغادرة الصفحة دون حفظ الفاتورة
+  useEffect(() => {
+    quoteIdRef.current = quoteId;
+  }, [quoteId]);
+
+  useEffect(() => () => {
+    axios.delete(`${API}/material-reservations/${quoteIdRef.current}`).catch(() => {});
+  }, []);
 
   // Measurement conversion functions
   const mmToInch = (mm) => {
@@ -1968,6 +1984,44 @@ const Sales = () => {
     }
   };
 
+  // الملي المطلوب من كل خامة لكل بنود الفاتورة (الحجز واحد لكل خامة في الفاتورة)
+  const materialReservationTotals = (reservedItems) => {
+    const totals = {};
+    for (const item of reservedItems) {
+      for (const selected of item.selected_materials || []) {
+        const total = totals[selected.id] || { seals: 0, height: 0 };
+        total.seals += selected.seals_count;
+        total.height += selected.seals_count * parseFloat(item.height);
+        totals[selected.id] = total;
+      }
+    }
+    return totals;
+  };
+
+  const reserveMaterials = async (reservedItems, materialIds) => {
+    const totals = materialReservationTotals(reservedItems);
+    for (const materialId of materialIds) {
+      const total = totals[materialId];
+      if (!total || total.seals === 0) continue;
+      await axios.post(`${API}/material-reservations`, {
+        quote_id: quoteId,
+        material_id: materialId,
+        seals_count: total.seals,
+        seal_height: total.height / total.seals
+      });
+    }
+  };
+
+  // بعد حذف أو تعديل بند: إلغاء حجز الفاتورة ثم حجز ما تبقى من البنود
+  const syncMaterialReservations = async (remainingItems) => {
+    try {
+      await axios.delete(`${API}/material-reservations/${quoteId}`);
+      await reserveMaterials(remainingItems, Object.keys(materialReservationTotals(remainingItems)));
+    } catch (error) {
+      console.error('Error updating material reservations:', error);
+    }
+  };
+
   // Calculate automatic pricing based on material and client type
   const calculateAutomaticPrice = async (material, height, clientType) => {
     try {
@@ -1995,6 +2049,18 @@ const Sales = () => {
       let totalPrice = 0;
       const height = parseFloat(currentItem.height);
       
+      // حجز الخامات المختارة حتى لا يستخدمها كاشير آخر قبل حفظ الفاتورة
+      const selection = {
+        height: height,
+        selected_materials: selectedMaterials.map(sel => ({ id: sel.material.id, seals_count: sel.seals }))
+      };
+      try {
+        await reserveMaterials([...items, selection], selectedMaterials.map(sel => sel.material.id));
+      } catch (error) {
+        alert('تعذر حجز الخامات: ' + (error.response?.data?.detail || error.message));
+        return;
+      }
+      
       for (const selected of selectedMaterials) {
         const pricing = await calculateAutomaticPrice(selected.material, height, clientType);
         if (pricing) {
@@ -2060,7 +2126,8 @@ ${selectedMaterials.map(sel => `- ${sel.material.unit_code}: ${sel.seals} سيل
         material_type: currentItem.material_type,
         inner_diameter: innerDiameter,
         outer_diameter: outerDiameter,
-        height: height
+        height: height,
+        quote_id: quoteId
       });
       setCompatibilityResults(response.data);
     } catch (error) {
@@ -2278,12 +2345,18 @@ ${selectedMaterials.map(sel => `- ${sel.material.unit_code}: ${sel.seals} سيل
     // Remove the item being edited
     const newItems = items.filter((_, i) => i !== index);
     setItems(newItems);
+    if (item.selected_materials) {
+      syncMaterialReservations(newItems);
+    }
   };
 
   const deleteItem = (index) => {
     if (confirm('هل أنت متأكد من حذف هذا العنصر؟')) {
       const newItems = items.filter((_, i) => i !== index);
       setItems(newItems);
+      if (items[index].selected_materials) {
+        syncMaterialReservations(newItems);
+      }
     }
   };
 
@@ -2348,7 +2421,8 @@ ${selectedMaterials.map(sel => `- ${sel.material.unit_code}: ${sel.seals} سيل
         discount_type: discountType,
         discount_value: parseFloat(discount || 0),
         total_after_discount: totalAfterDiscount,
-        notes: ''
+        notes: '',
+        quote_id: quoteId
       };
 
       const response = await axios.post(`${API}/invoices?supervisor_name=${encodeURIComponent(supervisorName)}`, invoiceData);
@@ -2366,6 +2440,7 @@ ${selectedMaterials.map(sel => `- ${sel.material.unit_code}: ${sel.seals} سيل
         setDiscount(0);
         setDiscountType('amount');
         setClientType(1); // إعادة تعيين نوع العميل
+        setQuoteId(newQuoteId()); // الحجز تحول إلى الفاتورة، والفاتورة التالية تبدأ حجزاً جديداً
         
         // طباعة الفاتورة
         printInvoice(response.data);
@@ -3058,7 +3133,7 @@ ${selectedMaterials.map(sel => `- ${sel.material.unit_code}: ${sel.seals} سيل
                     sel.material.inner_diameter === material.inner_diameter &&
                     sel.material.outer_diameter === material.outer_diameter
                   );
-                  const maxSeals = Math.floor(material.height / (parseFloat(currentItem.height) + 2));
+                  const maxSeals = Math.floor((material.available_height ?? material.height) / (parseFloat(currentItem.height) + 2));
                   const remainingSeals = parseInt(currentItem.quantity) - selectedMaterials.reduce((sum, sel) => sum + sel.seals, 0);
                   
                   return (
@@ -3133,6 +3208,7 @@ ${selectedMaterials.map(sel => `- ${sel.material.unit_code}: ${sel.seals} سيل
                   <button
                     onClick={() => {
                       setSelectedMaterials([]);
+                      syncMaterialReservations(items); // إلغاء حجز الاختيار الحالي فقط
                     }}
                     className="bg-gray-500 text-white px-4 py-2 rounded hover:bg-gray-600"
                   >
@@ -4038,7 +4114,9 @@ const Deferred = () => {
 
   const fetchUnpaidInvoices = async () => {
     try {
-      const response = await axios.get(`${API}/invoices`);
+      const response = await axios.get(`${API}/invoices`, {
+        params: { view: 'summary' }
+      });
       const invoices = response.data.filter(invoice => 
         // يجب أن تكون الفاتورة آجلة أو لها مبلغ مستحق
         (invoice.payment_method === 'آجل' || invoice.remaining_amount > 0) &&
@@ -4872,7 +4950,9 @@ const Invoices = () => {
   const fetchInvoices = async () => {
     try {
       console.log('Fetching invoices...');
-      const response = await axios.get(`${API}/invoices`);
+      const response = await axios.get(`${API}/invoices`, {
+        params: { view: 'summary' }
+      });
       console.log('Invoices fetched:', response.data.length, 'invoices');
       setInvoices(response.data);
     } catch (error) {
@@ -4903,6 +4983,17 @@ const Invoices = () => {
     }
   };
 
+  // The table holds invoice summaries; printing and editing load the full invoice
+  const withInvoiceDetails = async (invoiceId, action) => {
+    try {
+      const response = await axios.get(`${API}/invoices/${invoiceId}`);
+      action(response.data);
+    } catch (error) {
+      console.error('Error fetching invoice:', error);
+      alert('خطأ في تحميل الفاتورة: ' + (error.response?.data?.detail || error.message));
+    }
+  };
+
   const startEditInvoice = (invoice) => {
     setEditingInvoice(invoice.id);
     setEditForm({
@@ -5478,14 +5569,14 @@ const Invoices = () => {
                   <td className="border border-gray-300 p-2">
                     <div className="flex flex-wrap gap-1">
                       <button
-                        onClick={() => printInvoice(invoice)}
+                        onClick={() => withInvoiceDetails(invoice.id, printInvoice)}
                         className="bg-blue-500 text-white px-2 py-1 rounded text-xs hover:bg-blue-600"
                         title="طباعة الفاتورة"
                       >
                         طباعة
                       </button>
                       <button
-                        onClick={() => startEditInvoice(invoice)}
+                        onClick={() => withInvoiceDetails(invoice.id, startEditInvoice)}
                         className="bg-green-500 text-white px-2 py-1 rounded text-xs hover:bg-green-600"
                         title="تعديل الفاتورة"
                       >
@@ -5997,7 +6088,7 @@ const WorkOrders = () => {
       // For now, use Master Seal ID directly until full multi-company is implemented
       const masterSealId = "fdc83710-034a-410e-b5b7-ee231f36fd31";
       const response = await axios.get(`${API}/invoices`, {
-        params: { company_id: masterSealId }
+        params: { company_id: masterSealId, view: 'summary' }
       });
       setInvoices(response.data);
     } catch (error) {
@@ -6025,8 +6116,10 @@ const WorkOrders = () => {
     }
 
     try {
-      // Get selected invoices data
-      const selectedInvoicesData = invoices.filter(inv => selectedInvoices.includes(inv.id));
+      // Get selected invoices data (the list only holds summaries)
+      const selectedInvoicesData = await Promise.all(
+        selectedInvoices.map(invoiceId => axios.get(`${API}/invoices/${invoiceId}`).then(response => response.data))
+      );
       
       // Clean invoices data (remove MongoDB ObjectIds)
       const cleanInvoices = selectedInvoicesData.map(inv => {
@@ -6122,7 +6215,7 @@ const WorkOrders = () => {
 
   const printWorkOrder = (workOrder) => {
     const workOrderInvoices = workOrder.invoices?.map(invoiceData => 
-      invoices.find(inv => inv.id === invoiceData.id) || invoiceData
+      invoiceData.items ? invoiceData : (invoices.find(inv => inv.id === invoiceData.id) || invoiceData)
     ).filter(inv => inv) || [];
     
     const totalAmount = workOrderInvoices.reduce((sum, inv) => sum + (inv.total_amount || 0), 0);
@@ -6434,7 +6527,7 @@ const WorkOrders = () => {
                 المبلغ: ج.م {invoice.total_amount?.toFixed(2) || '0.00'}
               </p>
               <p className="text-sm">
-                المنتجات: {invoice.items?.length || 0} صنف
+                المنتجات: {invoice.item_count ?? (invoice.items?.length || 0)} صنف
               </p>
               <span className={`inline-block px-2 py-1 rounded text-xs mt-1 ${
                 invoice.status === 'تم التنفيذ' 
@@ -6468,7 +6561,7 @@ const WorkOrders = () => {
             <p className="text-blue-700">
               إجمالي المنتجات: {invoices
                 .filter(inv => selectedInvoices.includes(inv.id))
-                .reduce((sum, inv) => sum + (inv.items?.length || 0), 0)} صنف
+                .reduce((sum, inv) => sum + (inv.item_count ?? (inv.items?.length || 0)), 0)} صنف
             </p>
           </div>
         )}
@@ -6704,7 +6797,9 @@ const Treasury = () => {
       // Fetch balances and transactions from backend
       const balancesResponse = await axios.get(`${API}/treasury/balances`);
       const transactionsResponse = await axios.get(`${API}/treasury/transactions`);
-      const invoicesResponse = await axios.get(`${API}/invoices`);
+      const invoicesResponse = await axios.get(`${API}/invoices`, {
+        params: { view: 'summary' }
+      });
       const expensesResponse = await axios.get(`${API}/expenses`);
       
       const balances = balancesResponse.data;
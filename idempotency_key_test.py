@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Test for Idempotency-Key support on create endpoints
+- Retrying POST /api/invoices with the same key returns the same invoice
+- Retrying POST /api/payments with the same key records one payment
+- Reusing a key with a different body is rejected
+"""
+
+import uuid
+import requests
+
+BACKEND_URL = "https://seal-inventory.preview.emergentagent.com/api"
+
+def invoice_payload(customer_name="عميل اختبار مفتاح التكرار"):
+    return {
+        "customer_name": customer_name,
+        "items": [{
+            "product_type": "local",
+            "product_name": "منتج اختبار",
+            "quantity": 1,
+            "unit_price": 40.0,
+            "total_price": 40.0
+        }],
+        "payment_method": "آجل"
+    }
+
+def test_invoice_retry():
+    """Two POSTs with one key create a single invoice"""
+    print("Testing invoice retry with Idempotency-Key...")
+
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+    first = requests.post(f"{BACKEND_URL}/invoices", json=invoice_payload(), headers=headers)
+    second = requests.post(f"{BACKEND_URL}/invoices", json=invoice_payload(), headers=headers)
+
+    if first.status_code != 200 or second.status_code != 200:
+        print(f"❌ Requests failed: HTTP {first.status_code} / {second.status_code}")
+        return None
+    if first.json()["id"] != second.json()["id"]:
+        print(f"❌ Retry created a second invoice: {first.json()['invoice_number']} / {second.json()['invoice_number']}")
+        return None
+
+    print(f"✅ Retry replayed invoice {first.json()['invoice_number']}")
+    return first.json()
+
+def test_payment_retry(invoice):
+    """Two POSTs with one key record a single payment"""
+    print("Testing payment retry with Idempotency-Key...")
+
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+    payment = {"invoice_id": invoice["id"], "amount": 10.0, "payment_method": "نقدي"}
+    first = requests.post(f"{BACKEND_URL}/payments", json=payment, headers=headers)
+    second = requests.post(f"{BACKEND_URL}/payments", json=payment, headers=headers)
+
+    if first.status_code != 200 or second.status_code != 200:
+        print(f"❌ Requests failed: HTTP {first.status_code} / {second.status_code}")
+        return False
+
+    updated = requests.get(f"{BACKEND_URL}/invoices/{invoice['id']}").json()
+    if abs(updated["paid_amount"] - 10.0) > 0.01:
+        print(f"❌ Paid amount is {updated['paid_amount']}, expected 10.0")
+        return False
+
+    print("✅ Payment applied once")
+    return True
+
+def test_key_reuse_with_different_body():
+    """A key bound to one request cannot be used for another"""
+    print("Testing key reuse with a different body...")
+
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+    requests.post(f"{BACKEND_URL}/invoices", json=invoice_payload(), headers=headers)
+    response = requests.post(f"{BACKEND_URL}/invoices", json=invoice_payload("عميل آخر"), headers=headers)
+
+    if response.status_code != 422:
+        print(f"❌ Expected HTTP 422, got {response.status_code}")
+        return False
+
+    print("✅ Key reuse rejected")
+    return True
+
+if __name__ == "__main__":
+    print("🔑 Idempotency Key Test")
+    print("=" * 40)
+
+    invoice = test_invoice_retry()
+    payment_ok = test_payment_retry(invoice) if invoice else False
+    reuse_ok = test_key_reuse_with_different_body()
+
+    if invoice and payment_ok and reuse_ok:
+        print("\n✅ Idempotency keys working!")
+    else:
+        print("\n❌ Idempotency keys need work")
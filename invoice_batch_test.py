@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Test for POST /api/invoices/batch
+- Valid invoices in a batch are created with consecutive numbers
+- An invalid invoice is reported without aborting the rest of the batch
+"""
+
+import requests
+
+BACKEND_URL = "https://seal-inventory.preview.emergentagent.com/api"
+
+def local_invoice(customer_name, payment_method="نقدي"):
+    return {
+        "customer_name": customer_name,
+        "items": [{
+            "product_type": "local",
+            "product_name": "منتج اختبار",
+            "quantity": 1,
+            "unit_price": 25.0,
+            "total_price": 25.0
+        }],
+        "payment_method": payment_method
+    }
+
+def test_batch_creation():
+    """Ten paper tickets entered in one request"""
+    print("Testing batch invoice creation...")
+
+    batch = {"invoices": [local_invoice(f"عميل دفعة {i}", "نقدي" if i % 2 else "آجل") for i in range(10)]}
+    response = requests.post(f"{BACKEND_URL}/invoices/batch", json=batch)
+    if response.status_code != 200:
+        print(f"❌ Batch failed: HTTP {response.status_code} - {response.text}")
+        return False
+
+    result = response.json()
+    if result["created"] != 10:
+        print(f"❌ Only {result['created']} of 10 invoices created: {result['results']}")
+        return False
+
+    numbers = [int(row["invoice_number"].split("-")[1]) for row in result["results"]]
+    if numbers != list(range(numbers[0], numbers[0] + 10)):
+        print(f"❌ Invoice numbers are not one block: {numbers}")
+        return False
+
+    print(f"✅ Created 10 invoices INV-{numbers[0]:06d} .. INV-{numbers[-1]:06d}")
+    return True
+
+def test_partial_failure():
+    """A broken payload fails alone"""
+    print("Testing per-invoice failures...")
+
+    batch = {"invoices": [
+        local_invoice("عميل دفعة صحيح"),
+        {"customer_name": "فاتورة بدون أصناف"},
+        local_invoice("عميل دفعة صحيح 2")
+    ]}
+    response = requests.post(f"{BACKEND_URL}/invoices/batch", json=batch)
+    if response.status_code != 200:
+        print(f"❌ Batch failed: HTTP {response.status_code}")
+        return False
+
+    results = response.json()["results"]
+    if [row["success"] for row in results] != [True, False, True]:
+        print(f"❌ Unexpected results: {results}")
+        return False
+
+    print(f"✅ Invalid invoice reported: {results[1]['error'][:60]}...")
+    return True
+
+if __name__ == "__main__":
+    print("📦 Invoice Batch Test")
+    print("=" * 40)
+
+    batch_ok = test_batch_creation()
+    partial_ok = test_partial_failure()
+
+    if batch_ok and partial_ok:
+        print("\n✅ Batch invoice creation working!")
+    else:
+        print("\n❌ Batch invoice creation needs work")
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Test for per-invoice cost of goods and the margin report
+- A local item is costed at its purchase price when the invoice is created
+- The margin report adds up the stored invoice costs
+"""
+
+import requests
+
+BACKEND_URL = "https://seal-inventory.preview.emergentagent.com/api"
+
+def get_margin():
+    response = requests.get(f"{BACKEND_URL}/reports/margin")
+    if response.status_code != 200:
+        print(f"❌ Margin report failed: HTTP {response.status_code} - {response.text}")
+        return None
+    return response.json()
+
+def test_local_item_cost():
+    """2 local items bought at 12 cost 24"""
+    print("Testing local item cost at sale time...")
+
+    response = requests.post(f"{BACKEND_URL}/invoices", json={
+        "customer_name": "عميل اختبار الربحية",
+        "items": [{
+            "product_type": "local",
+            "product_name": "منتج اختبار",
+            "quantity": 2,
+            "unit_price": 20.0,
+            "total_price": 40.0,
+            "local_product_details": {"name": "منتج اختبار", "supplier": "مورد اختبار", "purchase_price": 12.0, "selling_price": 20.0}
+        }],
+        "payment_method": "نقدي"
+    })
+    if response.status_code != 200:
+        print(f"❌ Could not create invoice: HTTP {response.status_code}")
+        return False
+
+    invoice = response.json()
+    if abs(invoice["items"][0]["cost"] - 24.0) > 0.01 or abs(invoice["cost_of_goods"] - 24.0) > 0.01:
+        print(f"❌ Unexpected cost: item {invoice['items'][0]['cost']}, invoice {invoice['cost_of_goods']}")
+        return False
+    if abs(invoice["gross_profit"] - 16.0) > 0.01:
+        print(f"❌ Unexpected gross profit: {invoice['gross_profit']}")
+        return False
+
+    print(f"✅ Cost {invoice['cost_of_goods']}, gross profit {invoice['gross_profit']}")
+    return True
+
+def test_margin_report_totals():
+    """Revenue minus cost equals gross profit, overall and per product type"""
+    print("Testing margin report...")
+
+    report = get_margin()
+    if report is None:
+        return False
+
+    if abs(report["revenue"] - report["cost_of_goods"] - report["gross_profit"]) > 0.01:
+        print(f"❌ Totals do not add up: {report}")
+        return False
+    for row in report["by_product_type"]:
+        if abs(row["revenue"] - row["cost_of_goods"] - row["gross_profit"]) > 0.01:
+            print(f"❌ {row['product_type']} does not add up: {row}")
+            return False
+
+    print(f"✅ Margin {report['margin_percent']:.1f}% over {report['invoice_count']} invoices")
+    return True
+
+if __name__ == "__main__":
+    print("💹 Invoice Margin Test")
+    print("=" * 40)
+
+    cost_ok = test_local_item_cost()
+    report_ok = test_margin_report_totals()
+
+    if cost_ok and report_ok:
+        print("\n✅ Invoice costing working!")
+    else:
+        print("\n❌ Invoice costing needs work")
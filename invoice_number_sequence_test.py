@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Test for the per-company invoice number sequence allocator
+- Concurrent invoice creation must never produce the same invoice number
+- Each company gets its own sequence
+"""
+
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_URL = "https://seal-inventory.preview.emergentagent.com/api"
+
+COMPANY_A = "sequence-test-company-a"
+COMPANY_B = "sequence-test-company-b"
+
+def build_invoice(index):
+    return {
+        "customer_name": f"عميل اختبار الترقيم {index}",
+        "items": [{
+            "product_type": "local",
+            "product_name": "منتج اختبار",
+            "quantity": 1,
+            "unit_price": 10.0,
+            "total_price": 10.0
+        }],
+        "payment_method": "آجل",
+        "discount_type": "amount",
+        "discount_value": 0.0
+    }
+
+def create_invoice(company_id, index):
+    response = requests.post(
+        f"{BACKEND_URL}/invoices",
+        params={"company_id": company_id},
+        json=build_invoice(index)
+    )
+    if response.status_code != 200:
+        print(f"❌ Failed to create invoice: HTTP {response.status_code} - {response.text}")
+        return None
+    return response.json()
+
+def cleanup(invoices):
+    for invoice in invoices:
+        requests.delete(f"{BACKEND_URL}/invoices/{invoice['id']}/cancel", params={"username": "Elsawy"})
+
+def test_concurrent_invoice_numbers():
+    """20 concurrent cashiers must get 20 different invoice numbers"""
+    print("Testing concurrent invoice number allocation...")
+
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        invoices = list(executor.map(lambda i: create_invoice(COMPANY_A, i), range(20)))
+
+    created = [invoice for invoice in invoices if invoice]
+    numbers = [invoice["invoice_number"] for invoice in created]
+
+    try:
+        if len(created) != 20:
+            print(f"❌ Only {len(created)} of 20 invoices were created")
+            return False
+        if len(set(numbers)) != len(numbers):
+            print(f"❌ Duplicate invoice numbers: {sorted(numbers)}")
+            return False
+        if any(invoice.get("company_id") != COMPANY_A for invoice in created):
+            print("❌ Invoices were not stamped with the company id")
+            return False
+
+        print(f"✅ 20 unique invoice numbers: {sorted(numbers)[0]} .. {sorted(numbers)[-1]}")
+        return True
+    finally:
+        cleanup(created)
+
+def test_sequences_are_per_company():
+    """Invoices of the same company are numbered in increasing order"""
+    print("Testing per-company sequences...")
+
+    first_a = create_invoice(COMPANY_A, 1)
+    first_b = create_invoice(COMPANY_B, 1)
+    second_a = create_invoice(COMPANY_A, 2)
+    created = [invoice for invoice in (first_a, first_b, second_a) if invoice]
+
+    try:
+        if len(created) != 3:
+            print("❌ Could not create test invoices")
+            return False
+
+        number = lambda invoice: int(invoice["invoice_number"].split("-")[1])
+        if number(second_a) <= number(first_a):
+            print(f"❌ Sequence for {COMPANY_A} is not increasing: {first_a['invoice_number']} -> {second_a['invoice_number']}")
+            return False
+
+        print(f"✅ {COMPANY_A}: {first_a['invoice_number']} -> {second_a['invoice_number']}, {COMPANY_B}: {first_b['invoice_number']}")
+        return True
+    finally:
+        cleanup(created)
+
+if __name__ == "__main__":
+    print("🔢 Invoice Number Sequence Test")
+    print("=" * 40)
+
+    concurrent_ok = test_concurrent_invoice_numbers()
+    per_company_ok = test_sequences_are_per_company()
+
+    if concurrent_ok and per_company_ok:
+        print("\n✅ Invoice number sequences working!")
+    else:
+        print("\n❌ Invoice number sequences need work")
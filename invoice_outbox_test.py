@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Test for the invoice side-effect outbox
+- POST /api/invoices returns before side effects are applied
+- The outbox worker posts the treasury income shortly afterwards
+- Cancelling right after creation leaves the cash balance where it was
+- GET /api/outbox/status reports lag and failed tasks
+"""
+
+import time
+import requests
+
+BACKEND_URL = "https://seal-inventory.preview.emergentagent.com/api"
+
+def get_cash_balance():
+    response = requests.get(f"{BACKEND_URL}/treasury/balances")
+    return response.json().get("cash", 0) if response.status_code == 200 else None
+
+def test_side_effects_applied_by_worker():
+    """The cash income for an invoice shows up once the outbox drains"""
+    print("Testing outbox applies invoice side effects...")
+
+    initial_cash = get_cash_balance()
+    invoice_data = {
+        "customer_name": "عميل اختبار الأوت بوكس",
+        "items": [{
+            "product_type": "local",
+            "product_name": "منتج اختبار",
+            "quantity": 1,
+            "unit_price": 123.0,
+            "total_price": 123.0
+        }],
+        "payment_method": "نقدي"
+    }
+
+    start = time.time()
+    response = requests.post(f"{BACKEND_URL}/invoices", json=invoice_data)
+    elapsed = time.time() - start
+    if response.status_code != 200:
+        print(f"❌ Invoice creation failed: HTTP {response.status_code} - {response.text}")
+        return False
+    print(f"   Invoice created in {elapsed * 1000:.0f} ms")
+
+    # Wait for the worker to post the treasury transaction
+    for _ in range(20):
+        time.sleep(0.5)
+        if abs(get_cash_balance() - initial_cash - 123.0) < 0.01:
+            print("✅ Treasury income posted by the outbox worker")
+            return True
+
+    print(f"❌ Cash balance did not increase by 123: {initial_cash} -> {get_cash_balance()}")
+    return False
+
+def test_cancel_right_after_create():
+    """Income and its reversal never get out of step, whatever the worker is doing"""
+    print("Testing cancel while side effects may be running...")
+
+    initial_cash = get_cash_balance()
+    response = requests.post(f"{BACKEND_URL}/invoices", json={
+        "customer_name": "عميل اختبار إلغاء الأوت بوكس",
+        "items": [{
+            "product_type": "local",
+            "product_name": "منتج اختبار",
+            "quantity": 1,
+            "unit_price": 77.0,
+            "total_price": 77.0
+        }],
+        "payment_method": "نقدي"
+    })
+    if response.status_code != 200:
+        print(f"❌ Invoice creation failed: HTTP {response.status_code}")
+        return False
+
+    # 409 means a task was still running; the cancel can simply be retried
+    for _ in range(10):
+        cancel = requests.delete(f"{BACKEND_URL}/invoices/{response.json()['id']}/cancel")
+        if cancel.status_code != 409:
+            break
+        time.sleep(0.5)
+    if cancel.status_code != 200:
+        print(f"❌ Cancel failed: HTTP {cancel.status_code} - {cancel.text}")
+        return False
+
+    time.sleep(2)
+    if abs(get_cash_balance() - initial_cash) > 0.01:
+        print(f"❌ Cash balance changed: {initial_cash} -> {get_cash_balance()}")
+        return False
+
+    print(f"✅ Cash unchanged, treasury_reversed={cancel.json()['treasury_reversed']}")
+    return True
+
+def test_outbox_status():
+    """Status endpoint exposes counts, lag and failed tasks"""
+    print("Testing GET /api/outbox/status...")
+
+    response = requests.get(f"{BACKEND_URL}/outbox/status")
+    if response.status_code != 200:
+        print(f"❌ Status endpoint failed: HTTP {response.status_code}")
+        return False
+
+    status = response.json()
+    missing = [key for key in ("counts", "lag_seconds", "failed_tasks") if key not in status]
+    if missing:
+        print(f"❌ Missing keys in status: {missing}")
+        return False
+
+    print(f"✅ Outbox counts: {status['counts']}, lag: {status['lag_seconds']:.1f}s, failed: {len(status['failed_tasks'])}")
+    return True
+
+if __name__ == "__main__":
+    print("📬 Invoice Outbox Test")
+    print("=" * 40)
+
+    effects_ok = test_side_effects_applied_by_worker()
+    cancel_ok = test_cancel_right_after_create()
+    status_ok = test_outbox_status()
+
+    if effects_ok and cancel_ok and status_ok:
+        print("\n✅ Invoice outbox working!")
+    else:
+        print("\n❌ Invoice outbox needs work")
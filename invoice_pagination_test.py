@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Test for keyset pagination and filters on GET /api/invoices
+- Walking the X-Next-Cursor header visits every invoice exactly once
+- Server-side filters only return matching invoices
+"""
+
+import requests
+
+BACKEND_URL = "https://seal-inventory.preview.emergentagent.com/api"
+
+COMPANY_ID = "elsawy"
+
+def get_page(params):
+    response = requests.get(f"{BACKEND_URL}/invoices", params={"company_id": COMPANY_ID, **params})
+    if response.status_code != 200:
+        print(f"❌ Failed to load invoices: HTTP {response.status_code} - {response.text}")
+        return None, None
+    return response.json(), response.headers.get("X-Next-Cursor")
+
+def test_cursor_walk():
+    """Pages of 25 must not repeat or skip invoices"""
+    print("Testing cursor pagination...")
+
+    seen = []
+    cursor = None
+    while True:
+        params = {"limit": 25}
+        if cursor:
+            params["after"] = cursor
+        page, cursor = get_page(params)
+        if page is None:
+            return False
+        seen.extend(invoice["id"] for invoice in page)
+        if not cursor:
+            break
+
+    if len(seen) != len(set(seen)):
+        print("❌ Some invoices were returned on more than one page")
+        return False
+
+    print(f"✅ Walked {len(seen)} invoices without repeats")
+    return True
+
+def test_filters():
+    """Deferred invoices with an open balance only"""
+    print("Testing server-side filters...")
+
+    page, _ = get_page({"payment_method": "آجل", "has_remaining": "true", "limit": 100})
+    if page is None:
+        return False
+
+    wrong = [invoice["invoice_number"] for invoice in page
+             if invoice["payment_method"] != "آجل" or invoice["remaining_amount"] <= 0]
+    if wrong:
+        print(f"❌ Invoices not matching the filters: {wrong}")
+        return False
+
+    print(f"✅ {len(page)} deferred invoices with remaining balance")
+    return True
+
+def test_invalid_cursor():
+    """A malformed cursor is rejected"""
+    print("Testing invalid cursor...")
+
+    response = requests.get(f"{BACKEND_URL}/invoices", params={"company_id": COMPANY_ID, "after": "not-a-cursor"})
+    if response.status_code != 400:
+        print(f"❌ Expected HTTP 400, got {response.status_code}")
+        return False
+
+    print("✅ Invalid cursor rejected")
+    return True
+
+if __name__ == "__main__":
+    print("📄 Invoice Pagination Test")
+    print("=" * 40)
+
+    walk_ok = test_cursor_walk()
+    filters_ok = test_filters()
+    cursor_ok = test_invalid_cursor()
+
+    if walk_ok and filters_ok and cursor_ok:
+        print("\n✅ Invoice pagination working!")
+    else:
+        print("\n❌ Invoice pagination needs work")
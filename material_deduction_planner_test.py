@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Test for the batched material deduction planner
+- Several invoice items cutting from the same raw material
+- Deductions never drive a material below zero
+"""
+
+import requests
+from datetime import datetime
+
+BACKEND_URL = "https://seal-inventory.preview.emergentagent.com/api"
+
+def create_test_material(unit_code, height):
+    """Create a raw material directly through bulk import (skips inventory checks)"""
+    material = {
+        "material_type": "NBR",
+        "inner_diameter": 41.0,
+        "outer_diameter": 61.0,
+        "height": height,
+        "pieces_count": 1,
+        "unit_code": unit_code,
+        "cost_per_mm": 0.5
+    }
+    response = requests.post(f"{BACKEND_URL}/raw-materials/bulk-import", json={"data": [material]})
+    return response.status_code == 200
+
+def find_material(unit_code):
+    export = requests.get(f"{BACKEND_URL}/data-management/export-all").json()
+    for material in export.get("data", {}).get("raw_materials", []):
+        if material.get("unit_code") == unit_code:
+            return material
+    return None
+
+def manufactured_item(unit_code, quantity, seals_count=None):
+    item = {
+        "seal_type": "RSL",
+        "material_type": "NBR",
+        "inner_diameter": 42.0,
+        "outer_diameter": 60.0,
+        "height": 8.0,
+        "quantity": quantity,
+        "unit_price": 20.0,
+        "total_price": 20.0 * quantity,
+        "product_type": "manufactured"
+    }
+    if seals_count is not None:
+        item["selected_materials"] = [{
+            "unit_code": unit_code,
+            "material_type": "NBR",
+            "inner_diameter": 41.0,
+            "outer_diameter": 61.0,
+            "seals_count": seals_count
+        }]
+    else:
+        item["material_details"] = {
+            "unit_code": unit_code,
+            "material_type": "NBR",
+            "inner_diameter": 41.0,
+            "outer_diameter": 61.0,
+            "is_finished_product": False
+        }
+    return item
+
+def test_multi_item_deduction():
+    """Three items on one material: every deduction sees the previous ones"""
+    print("Testing multi-item deduction from one material...")
+
+    unit_code = f"PLAN-{datetime.now().strftime('%H%M%S')}"
+    if not create_test_material(unit_code, 100.0):
+        print("❌ Could not create test material")
+        return False
+
+    invoice_data = {
+        "customer_name": "عميل اختبار خصم الخامات",
+        "items": [
+            manufactured_item(unit_code, 2, seals_count=2),  # 20 mm
+            manufactured_item(unit_code, 3, seals_count=3),  # 30 mm
+            manufactured_item(unit_code, 4)                  # 40 mm
+        ],
+        "payment_method": "آجل"
+    }
+    response = requests.post(f"{BACKEND_URL}/invoices", json=invoice_data)
+    if response.status_code != 200:
+        print(f"❌ Invoice creation failed: HTTP {response.status_code} - {response.text}")
+        return False
+
+    material = find_material(unit_code)
+    if not material:
+        print("❌ Test material not found after invoice")
+        return False
+
+    expected_height = 100.0 - 20.0 - 30.0 - 40.0
+    if abs(material["height"] - expected_height) > 0.01:
+        print(f"❌ Expected height {expected_height} mm, got {material['height']} mm")
+        return False
+
+    print(f"✅ Material {unit_code} height is {material['height']} mm after 3 items")
+    return True
+
+def test_no_negative_height():
+    """A selection larger than the material must not be deducted"""
+    print("Testing insufficient height is skipped...")
+
+    unit_code = f"PLAN-LOW-{datetime.now().strftime('%H%M%S')}"
+    if not create_test_material(unit_code, 25.0):
+        print("❌ Could not create test material")
+        return False
+
+    invoice_data = {
+        "customer_name": "عميل اختبار خصم الخامات",
+        "items": [manufactured_item(unit_code, 5, seals_count=5)],  # 50 mm > 25 mm
+        "payment_method": "آجل"
+    }
+    response = requests.post(f"{BACKEND_URL}/invoices", json=invoice_data)
+    if response.status_code != 200:
+        print(f"❌ Invoice creation failed: HTTP {response.status_code}")
+        return False
+
+    material = find_material(unit_code)
+    if not material or material["height"] != 25.0:
+        print(f"❌ Material height changed unexpectedly: {material and material['height']}")
+        return False
+
+    print("✅ Insufficient material left untouched")
+    return True
+
+if __name__ == "__main__":
+    print("🧮 Material Deduction Planner Test")
+    print("=" * 40)
+
+    multi_ok = test_multi_item_deduction()
+    negative_ok = test_no_negative_height()
+
+    if multi_ok and negative_ok:
+        print("\n✅ Material deduction planner working!")
+    else:
+        print("\n❌ Material deduction planner needs work")
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Test for the raw material movement ledger
+- A sale records a deduction movement for the material it was cut from
+- Cancelling the invoice restores exactly the recorded deduction
+"""
+
+import time
+import requests
+
+BACKEND_URL = "https://seal-inventory.preview.emergentagent.com/api"
+
+def get_company_id():
+    companies = requests.get(f"{BACKEND_URL}/companies").json()
+    return companies[0]["id"] if companies else None
+
+def find_material(company_id):
+    materials = requests.get(f"{BACKEND_URL}/raw-materials", params={"company_id": company_id}).json()
+    return next((m for m in materials if m.get("height", 0) >= 50), None)
+
+def get_material(company_id, material_id):
+    materials = requests.get(f"{BACKEND_URL}/raw-materials", params={"company_id": company_id}).json()
+    return next((m for m in materials if m["id"] == material_id), None)
+
+def get_movements(material_id):
+    return requests.get(f"{BACKEND_URL}/raw-materials/{material_id}/movements", params={"limit": 20}).json()
+
+def test_sale_and_cancel_movements():
+    """Deduction on sale, matching restoration on cancel"""
+    print("Testing material movements...")
+
+    company_id = get_company_id()
+    material = find_material(company_id)
+    if not material:
+        print("❌ No raw material with at least 50 mm available")
+        return False
+
+    response = requests.post(f"{BACKEND_URL}/invoices", params={"company_id": company_id}, json={
+        "customer_name": "عميل اختبار الحركات",
+        "items": [{
+            "seal_type": "RSL",
+            "material_type": material["material_type"],
+            "inner_diameter": material["inner_diameter"],
+            "outer_diameter": material["outer_diameter"],
+            "height": 8,
+            "quantity": 2,
+            "unit_price": 10.0,
+            "total_price": 20.0,
+            "product_type": "manufactured",
+            "selected_materials": [{
+                "unit_code": material["unit_code"],
+                "inner_diameter": material["inner_diameter"],
+                "outer_diameter": material["outer_diameter"],
+                "seals_count": 2
+            }]
+        }],
+        "payment_method": "نقدي"
+    })
+    if response.status_code != 200:
+        print(f"❌ Could not create invoice: HTTP {response.status_code}")
+        return False
+    invoice = response.json()
+
+    time.sleep(3)  # deductions are applied by the outbox worker
+    deduction = next((m for m in get_movements(material["id"])
+                      if m["reference_invoice_id"] == invoice["id"] and m["movement_type"] == "deduction"), None)
+    if not deduction or abs(deduction["height_change"] + 20.0) > 0.01:
+        print(f"❌ Deduction movement not recorded: {deduction}")
+        return False
+    print(f"   Deducted {-deduction['height_change']} mm from {material['unit_code']}")
+
+    response = requests.delete(f"{BACKEND_URL}/invoices/{invoice['id']}/cancel", params={"username": "Elsawy"})
+    if response.status_code != 200:
+        print(f"❌ Cancel failed: HTTP {response.status_code}")
+        return False
+
+    restoration = next((m for m in get_movements(material["id"])
+                        if m["reference_invoice_id"] == invoice["id"] and m["movement_type"] == "restoration"), None)
+    after = get_material(company_id, material["id"])
+    if not restoration or abs(restoration["height_change"] - 20.0) > 0.01:
+        print(f"❌ Restoration movement not recorded: {restoration}")
+        return False
+    if abs(after["height"] - material["height"]) > 0.01:
+        print(f"❌ Height not restored: {material['height']} -> {after['height']}")
+        return False
+
+    print(f"✅ Restored {restoration['height_change']} mm, height back to {after['height']}")
+    return True
+
+if __name__ == "__main__":
+    print("📦 Material Movement Ledger Test")
+    print("=" * 40)
+
+    movements_ok = test_sale_and_cancel_movements()
+
+    if movements_ok:
+        print("\n✅ Material movement ledger working!")
+    else:
+        print("\n❌ Material movement ledger needs work")
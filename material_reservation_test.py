@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Test for time-limited material reservations
+- A hold lowers the height other quotes can reserve or see as available
+- The quote holding the mm still sees it in the compatibility check
+- Releasing a quote frees its holds
+"""
+
+import uuid
+import requests
+
+BACKEND_URL = "https://seal-inventory.preview.emergentagent.com/api"
+
+def get_company_id():
+    companies = requests.get(f"{BACKEND_URL}/companies").json()
+    return companies[0]["id"] if companies else None
+
+def find_material(company_id):
+    materials = requests.get(f"{BACKEND_URL}/raw-materials", params={"company_id": company_id}).json()
+    return next((m for m in materials if m["height"] >= 60), None)
+
+def compatible_height(material, quote_id):
+    response = requests.post(f"{BACKEND_URL}/compatibility-check", json={
+        "seal_type": "RSL",
+        "inner_diameter": material["inner_diameter"],
+        "outer_diameter": material["outer_diameter"],
+        "height": 5,
+        "quote_id": quote_id
+    })
+    match = next((m for m in response.json()["compatible_materials"] if m["id"] == material["id"]), None)
+    return match["available_height"] if match else None
+
+def test_hold_blocks_other_quotes(material):
+    """Another quote cannot reserve the held mm"""
+    print("Testing a hold against another quote...")
+
+    quote_id = f"quote-{uuid.uuid4().hex[:8]}"
+    seals = int(material["height"] // 2 // 7)
+    response = requests.post(f"{BACKEND_URL}/material-reservations", json={
+        "quote_id": quote_id,
+        "material_id": material["id"],
+        "seals_count": seals,
+        "seal_height": 5,
+        "created_by": "Elsawy"
+    })
+    if response.status_code != 200:
+        print(f"❌ Reservation failed: HTTP {response.status_code} - {response.text}")
+        return None
+    held = response.json()["height"]
+
+    other = requests.post(f"{BACKEND_URL}/material-reservations", json={
+        "quote_id": f"quote-{uuid.uuid4().hex[:8]}",
+        "material_id": material["id"],
+        "seals_count": int((material["height"] - held) // 7) + 1,
+        "seal_height": 5
+    })
+    if other.status_code != 409:
+        print(f"❌ Second quote could reserve held mm: HTTP {other.status_code}")
+        return None
+
+    print(f"✅ {held} mm held for {quote_id}")
+    return quote_id, held
+
+def test_availability_subtracts_holds(material, quote_id, held):
+    """Only other quotes see the held mm as unavailable"""
+    print("Testing availability with holds...")
+
+    others_see = compatible_height(material, None)
+    holder_sees = compatible_height(material, quote_id)
+    if holder_sees is None or (others_see is not None and abs(holder_sees - others_see - held) > 0.01):
+        print(f"❌ Unexpected availability: holder {holder_sees}, others {others_see}")
+        return False
+
+    print(f"✅ Holder sees {holder_sees} mm, others {others_see} mm")
+    return True
+
+def test_release(quote_id):
+    """Deleting a quote's reservations leaves no active holds"""
+    print("Testing releasing a quote...")
+
+    requests.delete(f"{BACKEND_URL}/material-reservations/{quote_id}")
+    holds = requests.get(f"{BACKEND_URL}/material-reservations/{quote_id}").json()
+    if holds:
+        print(f"❌ {len(holds)} holds still active")
+        return False
+
+    print("✅ Quote released")
+    return True
+
+if __name__ == "__main__":
+    print("🔒 Material Reservation Test")
+    print("=" * 40)
+
+    material = find_material(get_company_id())
+    held = test_hold_blocks_other_quotes(material) if material else None
+    availability_ok = test_availability_subtracts_holds(material, *held) if held else False
+    release_ok = test_release(held[0]) if held else False
+
+    if held and availability_ok and release_ok:
+        print("\n✅ Material reservations working!")
+    else:
+        print("\n❌ Material reservations need work")
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Test for the indexed raw material and inventory listings
+- The full listing is ordered by material type priority then size
+- Paging with X-Next-Cursor returns the same rows as the full listing
+"""
+
+import requests
+
+BACKEND_URL = "https://seal-inventory.preview.emergentagent.com/api"
+
+MATERIAL_PRIORITY = {'BUR': 1, 'NBR': 2, 'BT': 3, 'BOOM': 4, 'VT': 5}
+
+def get_company_id():
+    companies = requests.get(f"{BACKEND_URL}/companies").json()
+    return companies[0]["id"] if companies else None
+
+def listing_key(item):
+    return (MATERIAL_PRIORITY.get(item["material_type"], 6), item["inner_diameter"], item["outer_diameter"])
+
+def get_all_pages(path, params, page_size):
+    rows, cursor, pages = [], None, 0
+    while True:
+        page_params = {**params, "limit": page_size}
+        if cursor:
+            page_params["after"] = cursor
+        response = requests.get(f"{BACKEND_URL}{path}", params=page_params)
+        if response.status_code != 200:
+            print(f"❌ Page failed: HTTP {response.status_code} - {response.text}")
+            return None
+        rows += response.json()
+        pages += 1
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            return rows, pages
+
+def test_listing_order_and_pages(path, params):
+    """Pages of 5 rows add up to the ordered full listing"""
+    print(f"Testing {path} ordering and paging...")
+
+    response = requests.get(f"{BACKEND_URL}{path}", params=params)
+    if response.status_code != 200:
+        print(f"❌ Listing failed: HTTP {response.status_code} - {response.text}")
+        return False
+    full = response.json()
+
+    keys = [listing_key(item) for item in full]
+    if keys != sorted(keys):
+        print("❌ Listing is not ordered by material type then size")
+        return False
+
+    paged = get_all_pages(path, params, 5)
+    if paged is None:
+        return False
+    rows, pages = paged
+    if [item["id"] for item in rows] != [item["id"] for item in full]:
+        print(f"❌ Paged rows differ from the full listing: {len(rows)} / {len(full)}")
+        return False
+
+    print(f"✅ {len(full)} rows in order, {pages} pages")
+    return True
+
+if __name__ == "__main__":
+    print("📦 Raw Material Listing Test")
+    print("=" * 40)
+
+    materials_ok = test_listing_order_and_pages("/raw-materials", {"company_id": get_company_id()})
+    inventory_ok = test_listing_order_and_pages("/inventory", {})
+
+    if materials_ok and inventory_ok:
+        print("\n✅ Indexed listings working!")
+    else:
+        print("\n❌ Indexed listings need work")
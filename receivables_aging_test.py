@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Test for the customer receivables aging report
+- A new deferred invoice lands in the 0-30 day bucket of its customer
+- Bucket totals add up to the overall outstanding amount
+"""
+
+import uuid
+import requests
+
+BACKEND_URL = "https://seal-inventory.preview.emergentagent.com/api"
+
+def get_aging():
+    response = requests.get(f"{BACKEND_URL}/reports/receivables-aging")
+    if response.status_code != 200:
+        print(f"❌ Aging report failed: HTTP {response.status_code} - {response.text}")
+        return None
+    return response.json()
+
+def test_new_deferred_invoice_is_current():
+    """A deferred invoice issued today is 0-30 days old"""
+    print("Testing new deferred invoice bucket...")
+
+    customer_name = f"عميل آجل {uuid.uuid4().hex[:6]}"
+    response = requests.post(f"{BACKEND_URL}/invoices", json={
+        "customer_name": customer_name,
+        "items": [{
+            "product_type": "local",
+            "product_name": "منتج اختبار",
+            "quantity": 1,
+            "unit_price": 60.0,
+            "total_price": 60.0
+        }],
+        "payment_method": "آجل"
+    })
+    if response.status_code != 200:
+        print(f"❌ Could not create invoice: HTTP {response.status_code}")
+        return False
+
+    report = get_aging()
+    if report is None:
+        return False
+
+    customer = next((c for c in report["customers"] if c["customer_name"] == customer_name), None)
+    if not customer or abs(customer["0_30"] - 60.0) > 0.01 or customer["total"] != customer["0_30"]:
+        print(f"❌ Customer not in the 0-30 bucket: {customer}")
+        return False
+
+    print(f"✅ {customer_name} owes {customer['0_30']} in the 0-30 bucket")
+    return True
+
+def test_bucket_totals():
+    """The four buckets add up to the total outstanding"""
+    print("Testing aging totals...")
+
+    report = get_aging()
+    if report is None:
+        return False
+
+    totals = report["totals"]
+    bucket_sum = totals["0_30"] + totals["31_60"] + totals["61_90"] + totals["90_plus"]
+    customer_sum = sum(c["total"] for c in report["customers"])
+    if abs(bucket_sum - totals["total"]) > 0.01 or abs(customer_sum - totals["total"]) > 0.01:
+        print(f"❌ Totals do not add up: buckets {bucket_sum}, customers {customer_sum}, total {totals['total']}")
+        return False
+
+    print(f"✅ {len(report['customers'])} customers owe {totals['total']}")
+    return True
+
+if __name__ == "__main__":
+    print("⏳ Receivables Aging Test")
+    print("=" * 40)
+
+    current_ok = test_new_deferred_invoice_is_current()
+    totals_ok = test_bucket_totals()
+
+    if current_ok and totals_ok:
+        print("\n✅ Receivables aging working!")
+    else:
+        print("\n❌ Receivables aging needs work")
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Test for the period-aware revenue report
+- A new invoice and expense are added to today's figures
+- Rebuilding the daily rollups gives the same report
+"""
+
+import requests
+
+BACKEND_URL = "https://seal-inventory.preview.emergentagent.com/api"
+
+def get_report(period):
+    response = requests.get(f"{BACKEND_URL}/reports/revenue", params={"period": period})
+    if response.status_code != 200:
+        print(f"❌ Report failed: HTTP {response.status_code} - {response.text}")
+        return None
+    return response.json()
+
+def test_daily_report_updates():
+    """Today's report grows by a new invoice and expense"""
+    print("Testing daily revenue report...")
+
+    before = get_report("daily")
+    invoice = requests.post(f"{BACKEND_URL}/invoices", json={
+        "customer_name": "عميل اختبار التقارير",
+        "items": [{
+            "product_type": "local",
+            "product_name": "منتج اختبار",
+            "quantity": 1,
+            "unit_price": 40.0,
+            "total_price": 40.0
+        }],
+        "payment_method": "نقدي"
+    })
+    expense = requests.post(f"{BACKEND_URL}/expenses", json={
+        "description": "اختبار التقارير",
+        "amount": 15.0,
+        "category": "خامات"
+    })
+    if invoice.status_code != 200 or expense.status_code != 200:
+        print(f"❌ Could not create invoice/expense: HTTP {invoice.status_code}/{expense.status_code}")
+        return False
+
+    after = get_report("daily")
+    if before is None or after is None:
+        return False
+
+    revenue_change = after["total_revenue"] - before["total_revenue"]
+    material_change = after["material_cost"] - before["material_cost"]
+    if abs(revenue_change - 40.0) > 0.01 or abs(material_change - 15.0) > 0.01:
+        print(f"❌ Unexpected changes: revenue {revenue_change}, material cost {material_change}")
+        return False
+
+    print(f"✅ Today's revenue {after['total_revenue']}, material cost {after['material_cost']}")
+    return True
+
+def test_rebuild_matches_incremental():
+    """Rollups rebuilt from the source collections match the incremental ones"""
+    print("Testing rollup rebuild...")
+
+    periods = ("daily", "weekly", "monthly", "yearly")
+    before = {period: get_report(period) for period in periods}
+    response = requests.post(f"{BACKEND_URL}/reports/rollups/rebuild")
+    if response.status_code != 200:
+        print(f"❌ Rebuild failed: HTTP {response.status_code}")
+        return False
+    after = {period: get_report(period) for period in periods}
+
+    for period in periods:
+        for field in ("total_revenue", "total_expenses", "material_cost"):
+            if abs(before[period][field] - after[period][field]) > 0.01:
+                print(f"❌ {period} {field}: {before[period][field]} vs rebuilt {after[period][field]}")
+                return False
+
+    print(f"✅ Rebuilt {response.json()['days']} days, reports unchanged")
+    return True
+
+if __name__ == "__main__":
+    print("📊 Revenue Rollup Test")
+    print("=" * 40)
+
+    daily_ok = test_daily_report_updates()
+    rebuild_ok = test_rebuild_matches_incremental()
+
+    if daily_ok and rebuild_ok:
+        print("\n✅ Revenue report working!")
+    else:
+        print("\n❌ Revenue report needs work")
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Test for materialized treasury balances
+- Postings move GET /api/treasury/balances by exactly their amount
+- The reconcile job finds no drift between stored balances and the ledger
+"""
+
+import time
+import requests
+
+BACKEND_URL = "https://seal-inventory.preview.emergentagent.com/api"
+
+def get_balances():
+    response = requests.get(f"{BACKEND_URL}/treasury/balances")
+    return response.json() if response.status_code == 200 else None
+
+def test_transfer_updates_balances():
+    """A transfer moves money between the two stored balances"""
+    print("Testing balances after a transfer...")
+
+    before = get_balances()
+    response = requests.post(f"{BACKEND_URL}/treasury/transfer", json={
+        "from_account": "cash",
+        "to_account": "instapay",
+        "amount": 15.0,
+        "notes": "اختبار الأرصدة المخزنة"
+    })
+    if response.status_code != 200:
+        print(f"❌ Transfer failed: HTTP {response.status_code}")
+        return False
+
+    after = get_balances()
+    if abs((before["cash"] - after["cash"]) - 15.0) > 0.01 or abs((after["instapay"] - before["instapay"]) - 15.0) > 0.01:
+        print(f"❌ Balances did not move by 15: {before} -> {after}")
+        return False
+
+    print(f"✅ cash {before['cash']} -> {after['cash']}, instapay {before['instapay']} -> {after['instapay']}")
+    return True
+
+def test_deferred_invoice_updates_balances():
+    """A deferred invoice adds to the deferred account"""
+    print("Testing balances after a deferred invoice...")
+
+    before = get_balances()
+    invoice_data = {
+        "customer_name": "عميل اختبار الأرصدة",
+        "items": [{
+            "product_type": "local",
+            "product_name": "منتج اختبار",
+            "quantity": 1,
+            "unit_price": 55.0,
+            "total_price": 55.0
+        }],
+        "payment_method": "آجل"
+    }
+    response = requests.post(f"{BACKEND_URL}/invoices", json=invoice_data)
+    if response.status_code != 200:
+        print(f"❌ Invoice creation failed: HTTP {response.status_code}")
+        return False
+
+    after = get_balances()
+    if abs((after["deferred"] - before["deferred"]) - 55.0) > 0.01:
+        print(f"❌ Deferred balance did not increase by 55: {before['deferred']} -> {after['deferred']}")
+        return False
+
+    print(f"✅ deferred {before['deferred']} -> {after['deferred']}")
+    return True
+
+def test_reconcile_reports_no_drift():
+    """Stored balances match a full rebuild from the ledger"""
+    print("Testing balance reconciliation...")
+
+    # Let outbox side effects of the previous tests settle
+    time.sleep(2)
+    response = requests.post(f"{BACKEND_URL}/treasury/balances/reconcile", params={"apply": "false"})
+    if response.status_code != 200:
+        print(f"❌ Reconcile failed: HTTP {response.status_code}")
+        return False
+
+    drift = response.json()["drift"]
+    if drift:
+        print(f"❌ Drift found: {drift}")
+        return False
+
+    print("✅ No drift between stored balances and ledger")
+    return True
+
+if __name__ == "__main__":
+    print("🏦 Treasury Balances Test")
+    print("=" * 40)
+
+    transfer_ok = test_transfer_updates_balances()
+    deferred_ok = test_deferred_invoice_updates_balances()
+    reconcile_ok = test_reconcile_reports_no_drift()
+
+    if transfer_ok and deferred_ok and reconcile_ok:
+        print("\n✅ Treasury balances working!")
+    else:
+        print("\n❌ Treasury balances need work")
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Test for the server-side duplicate transaction detector
+- Two identical postings are reported by the incremental scan
+- Dismissed findings leave the open report
+"""
+
+import uuid
+import requests
+
+BACKEND_URL = "https://seal-inventory.preview.emergentagent.com/api"
+
+def test_identical_postings_reported():
+    """Same account, type, amount and description twice"""
+    print("Testing duplicate scan...")
+
+    description = f"اختبار التكرار {uuid.uuid4().hex[:8]}"
+    for _ in range(2):
+        response = requests.post(f"{BACKEND_URL}/treasury/transactions", json={
+            "account_id": "cash",
+            "transaction_type": "income",
+            "amount": 17.0,
+            "description": description
+        })
+        if response.status_code != 200:
+            print(f"❌ Could not create transaction: HTTP {response.status_code}")
+            return None
+
+    scan = requests.post(f"{BACKEND_URL}/treasury/duplicates/scan")
+    if scan.status_code != 200:
+        print(f"❌ Scan failed: HTTP {scan.status_code} - {scan.text}")
+        return None
+    print(f"   Scanned {scan.json()['scanned']} new transactions")
+
+    findings = requests.get(f"{BACKEND_URL}/treasury/duplicates").json()
+    finding = next((f for f in findings if f["key"].get("description") == description), None)
+    if not finding or finding["count"] != 2:
+        print("❌ Duplicate postings were not reported")
+        return None
+
+    print(f"✅ Duplicate group reported with {finding['count']} transactions")
+    return finding
+
+def test_dismiss_finding(finding):
+    """A dismissed group is no longer open"""
+    print("Testing dismissing a finding...")
+
+    response = requests.put(f"{BACKEND_URL}/treasury/duplicates/{finding['id']}/dismiss", params={"username": "Elsawy"})
+    if response.status_code != 200:
+        print(f"❌ Dismiss failed: HTTP {response.status_code}")
+        return False
+
+    findings = requests.get(f"{BACKEND_URL}/treasury/duplicates").json()
+    if any(f["id"] == finding["id"] for f in findings):
+        print("❌ Dismissed finding still listed as open")
+        return False
+
+    print("✅ Finding dismissed")
+    return True
+
+if __name__ == "__main__":
+    print("🔍 Treasury Duplicate Scan Test")
+    print("=" * 40)
+
+    finding = test_identical_postings_reported()
+    dismiss_ok = test_dismiss_finding(finding) if finding else False
+
+    if finding and dismiss_ok:
+        print("\n✅ Duplicate detection working!")
+    else:
+        print("\n❌ Duplicate detection needs work")
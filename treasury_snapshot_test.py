@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Test for treasury closing snapshots
+- A closing stores the balances of every account
+- Balances read after a closing still match the current balances
+- The snapshot list shows closings newest first
+"""
+
+import requests
+from datetime import datetime, timedelta
+
+BACKEND_URL = "https://seal-inventory.preview.emergentagent.com/api"
+
+def get_balances(params=None):
+    response = requests.get(f"{BACKEND_URL}/treasury/balances", params=params or {})
+    return response.json() if response.status_code == 200 else None
+
+def test_closing_snapshot():
+    """Closing now stores balances equal to the current balances"""
+    print("Testing treasury closing snapshot...")
+
+    response = requests.post(f"{BACKEND_URL}/treasury/closings", params={"username": "Elsawy"})
+    if response.status_code != 200:
+        print(f"❌ Closing failed: HTTP {response.status_code} - {response.text}")
+        return False
+
+    snapshot = response.json()
+    totals = {}
+    for entry in snapshot["balances"]:
+        totals[entry["account_id"]] = totals.get(entry["account_id"], 0) + entry["balance"]
+
+    current = get_balances()
+    different = {account: (totals.get(account, 0), current[account]) for account in current
+                 if abs(totals.get(account, 0) - current[account]) > 0.01}
+    if different:
+        print(f"❌ Snapshot differs from current balances: {different}")
+        return False
+
+    print(f"✅ Closing {snapshot['id']} stored {len(snapshot['balances'])} account balances")
+    return True
+
+def test_as_of_after_closing():
+    """Balances as of now read the snapshot plus later postings"""
+    print("Testing as-of balances after a closing...")
+
+    response = requests.post(f"{BACKEND_URL}/treasury/transactions", json={
+        "account_id": "cash",
+        "transaction_type": "income",
+        "amount": 9.0,
+        "description": "اختبار بعد الإقفال"
+    })
+    if response.status_code != 200:
+        print(f"❌ Could not create transaction: HTTP {response.status_code}")
+        return False
+
+    current = get_balances()
+    as_of = get_balances({"as_of": (datetime.utcnow() + timedelta(minutes=1)).isoformat()})
+    if abs(current["cash"] - as_of["cash"]) > 0.01:
+        print(f"❌ As-of cash {as_of['cash']} differs from current cash {current['cash']}")
+        return False
+
+    print(f"✅ Cash after closing: {as_of['cash']}")
+    return True
+
+def test_snapshot_list():
+    """Snapshots are listed newest first"""
+    print("Testing snapshot list...")
+
+    response = requests.get(f"{BACKEND_URL}/treasury/snapshots", params={"limit": 10})
+    if response.status_code != 200:
+        print(f"❌ Snapshot list failed: HTTP {response.status_code}")
+        return False
+
+    dates = [snapshot["closed_at"] for snapshot in response.json()]
+    if dates != sorted(dates, reverse=True):
+        print(f"❌ Snapshots not sorted newest first: {dates}")
+        return False
+
+    print(f"✅ {len(dates)} snapshots listed")
+    return True
+
+if __name__ == "__main__":
+    print("📸 Treasury Snapshot Test")
+    print("=" * 40)
+
+    closing_ok = test_closing_snapshot()
+    as_of_ok = test_as_of_after_closing()
+    list_ok = test_snapshot_list()
+
+    if closing_ok and as_of_ok and list_ok:
+        print("\n✅ Treasury snapshots working!")
+    else:
+        print("\n❌ Treasury snapshots need work")
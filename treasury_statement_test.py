@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Test for the treasury account statement
+- Every row carries a running balance
+- Paging with X-Next-Cursor continues the running balance
+"""
+
+import requests
+
+BACKEND_URL = "https://seal-inventory.preview.emergentagent.com/api"
+
+ACCOUNT_ID = "cash"
+
+def get_statement(params):
+    response = requests.get(f"{BACKEND_URL}/treasury/accounts/{ACCOUNT_ID}/statement", params=params)
+    if response.status_code != 200:
+        print(f"❌ Statement failed: HTTP {response.status_code} - {response.text}")
+        return None, None
+    return response.json(), response.headers.get("X-Next-Cursor")
+
+def check_running_balance(statement, opening_balance):
+    balance = opening_balance
+    for row in statement["transactions"]:
+        balance += row["signed_amount"]
+        if abs(balance - row["running_balance"]) > 0.01:
+            print(f"❌ Running balance mismatch at {row['id']}: expected {balance}, got {row['running_balance']}")
+            return None
+    return balance
+
+def test_running_balance_across_pages():
+    """Pages of 20 rows chain their running balances"""
+    print("Testing statement running balance across pages...")
+
+    statement, cursor = get_statement({"limit": 20})
+    if statement is None:
+        return False
+
+    balance = check_running_balance(statement, statement["opening_balance"])
+    pages = 1
+    while cursor and balance is not None and pages < 10:
+        statement, cursor = get_statement({"limit": 20, "after": cursor})
+        if statement is None:
+            return False
+        balance = check_running_balance(statement, balance)
+        pages += 1
+
+    if balance is None:
+        return False
+
+    print(f"✅ Running balance consistent over {pages} pages, last balance {balance}")
+    return True
+
+if __name__ == "__main__":
+    print("📒 Treasury Statement Test")
+    print("=" * 40)
+
+    statement_ok = test_running_balance_across_pages()
+
+    if statement_ok:
+        print("\n✅ Account statement working!")
+    else:
+        print("\n❌ Account statement needs work")
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Test for treasury posting batches
+- A transfer writes both linked legs
+- The legs of a transfer net to zero across the two accounts
+"""
+
+import requests
+
+BACKEND_URL = "https://seal-inventory.preview.emergentagent.com/api"
+
+def test_transfer_writes_linked_legs():
+    """transfer_out and transfer_in reference each other"""
+    print("Testing transfer legs...")
+
+    response = requests.post(f"{BACKEND_URL}/treasury/transfer", json={
+        "from_account": "vodafone_elsawy",
+        "to_account": "cash",
+        "amount": 33.0,
+        "notes": "اختبار دفعة القيود"
+    })
+    if response.status_code != 200:
+        print(f"❌ Transfer failed: HTTP {response.status_code} - {response.text}")
+        return False
+
+    transfer_id = response.json()["transfer_id"]
+    transactions = requests.get(f"{BACKEND_URL}/treasury/transactions").json()
+    out_leg = next((t for t in transactions if t["id"] == transfer_id), None)
+    in_leg = next((t for t in transactions if out_leg and t["id"] == out_leg.get("related_transaction_id")), None)
+
+    if not out_leg or not in_leg:
+        print("❌ Transfer legs not found")
+        return False
+    if in_leg.get("related_transaction_id") != out_leg["id"]:
+        print("❌ Transfer legs are not linked both ways")
+        return False
+    if out_leg["amount"] != in_leg["amount"]:
+        print(f"❌ Legs do not balance: {out_leg['amount']} / {in_leg['amount']}")
+        return False
+
+    print(f"✅ Linked legs {out_leg['account_id']} -> {in_leg['account_id']} for {in_leg['amount']}")
+    return True
+
+def test_transfer_keeps_total_balance():
+    """A transfer does not change the sum of all account balances"""
+    print("Testing transfer keeps the total balance...")
+
+    before = sum(requests.get(f"{BACKEND_URL}/treasury/balances").json().values())
+    requests.post(f"{BACKEND_URL}/treasury/transfer", json={
+        "from_account": "cash",
+        "to_account": "instapay",
+        "amount": 21.0
+    })
+    after = sum(requests.get(f"{BACKEND_URL}/treasury/balances").json().values())
+
+    if abs(before - after) > 0.01:
+        print(f"❌ Total balance changed: {before} -> {after}")
+        return False
+
+    print(f"✅ Total balance unchanged: {after}")
+    return True
+
+if __name__ == "__main__":
+    print("🔁 Treasury Posting Batch Test")
+    print("=" * 40)
+
+    legs_ok = test_transfer_writes_linked_legs()
+    total_ok = test_transfer_keeps_total_balance()
+
+    if legs_ok and total_ok:
+        print("\n✅ Treasury posting batches working!")
+    else:
+        print("\n❌ Treasury posting batches need work")
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Test for per-spec unit code counters
+- Concurrent raw material creates for the same spec get distinct unit codes
+- New codes continue after the highest code of the spec
+"""
+
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_URL = "https://seal-inventory.preview.emergentagent.com/api"
+
+def get_company_id():
+    companies = requests.get(f"{BACKEND_URL}/companies").json()
+    return companies[0]["id"] if companies else None
+
+def find_stocked_spec():
+    """An inventory item with enough pieces to create a few raw materials"""
+    inventory = requests.get(f"{BACKEND_URL}/inventory").json()
+    return next((item for item in inventory if item.get("available_pieces", 0) >= 4), None)
+
+def create_material(company_id, spec):
+    return requests.post(f"{BACKEND_URL}/raw-materials", params={"company_id": company_id}, json={
+        "material_type": spec["material_type"],
+        "inner_diameter": spec["inner_diameter"],
+        "outer_diameter": spec["outer_diameter"],
+        "height": 10.0,
+        "pieces_count": 1,
+        "cost_per_mm": 1.0
+    })
+
+def test_concurrent_unit_codes():
+    """Four parallel creates produce four different, increasing codes"""
+    print("Testing concurrent unit code generation...")
+
+    company_id = get_company_id()
+    spec = find_stocked_spec()
+    if not spec:
+        print("❌ No inventory item with enough pieces")
+        return False
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        responses = list(executor.map(lambda _: create_material(company_id, spec), range(4)))
+
+    codes = [r.json()["unit_code"] for r in responses if r.status_code == 200]
+    if len(codes) != 4:
+        print(f"❌ Only {len(codes)} of 4 materials were created")
+        return False
+    if len(set(codes)) != 4:
+        print(f"❌ Duplicate unit codes: {codes}")
+        return False
+
+    materials = requests.get(f"{BACKEND_URL}/raw-materials", params={"company_id": company_id}).json()
+    same_spec = [m["unit_code"] for m in materials
+                 if m["material_type"] == spec["material_type"]
+                 and m["inner_diameter"] == spec["inner_diameter"]
+                 and m["outer_diameter"] == spec["outer_diameter"]]
+    print(f"✅ Distinct codes {sorted(codes)} ({len(same_spec)} materials with this spec)")
+    return True
+
+if __name__ == "__main__":
+    print("🔢 Unit Code Counter Test")
+    print("=" * 40)
+
+    codes_ok = test_concurrent_unit_codes()
+
+    if codes_ok:
+        print("\n✅ Unit code counters working!")
+    else:
+        print("\n❌ Unit code counters need work")